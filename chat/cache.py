@@ -0,0 +1,197 @@
+# purpose: small in-memory and on-disk caches shared by the chat pipeline
+import os
+import threading
+import time
+from collections import OrderedDict
+from chat.serialization import dumpb, loads
+
+
+class TTLCache:
+    """thread safe least recently used cache where each entry expires after its time to live"""
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires_at, value), ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            # evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache:
+    """
+    least recently used cache that keeps each entry in its own json file, so it
+    survives restarts and can be shared by processes on the same machine. keys are
+    strings that are safe to use as file names and values must be json serializable
+
+    Args:
+        directory (str): The directory the entries are written to, created on first use.
+        max_size (int): The number of entries kept, the least recently used are removed.
+        ttl (float): Seconds an entry stays valid, None keeps entries until they are evicted.
+    """
+
+    def __init__(self, directory: str, max_size: int = 1024, ttl: float | None = None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # the entries in the directory, counted on first use and kept up to date by
+        # set, so the directory is only scanned again when the count passes max_size
+        self.count = None
+        self.lock = threading.Lock()
+
+    def filepath(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str, default=None):
+        filepath = self.filepath(key)
+        try:
+            with open(filepath, "rb") as f:
+                entry = loads(f.read())
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return default
+
+        # the expiry is wall clock time, it has to mean the same in every process
+        expires_at = entry["expires_at"]
+        if expires_at is not None and expires_at <= time.time():
+            removed = self.remove(filepath)
+            with self.lock:
+                self.misses += 1
+                if removed and self.count:
+                    self.count -= 1
+            return default
+
+        # the modification time orders the entries from least to most recently used
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return entry["value"]
+
+    def set(self, key: str, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        os.makedirs(self.directory, exist_ok=True)
+        filepath = self.filepath(key)
+        with self.lock:
+            if self.count is None:
+                self.count = len(self.entries())
+        added = not os.path.exists(filepath)
+
+        # write to a temporary file first, readers see either the old or the new entry
+        temp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(dumpb({"expires_at": expires_at, "value": value}))
+        os.replace(temp_filepath, filepath)
+
+        with self.lock:
+            if added:
+                self.count += 1
+            if self.count > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries beyond max_size. it scans the directory,
+        which also counts the entries other processes added, called with the lock held
+        """
+        entries = self.entries()
+        self.count = len(entries)
+        if len(entries) <= self.max_size:
+            return
+        entries.sort(key=lambda entry: entry[0])
+        for _, filepath in entries[: len(entries) - self.max_size]:
+            if self.remove(filepath):
+                self.count -= 1
+
+    def entries(self) -> list[tuple[float, str]]:
+        """(modification time, file path) of every entry"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    @staticmethod
+    def remove(filepath: str) -> bool:
+        try:
+            os.remove(filepath)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def clear(self):
+        for _, filepath in self.entries():
+            self.remove(filepath)
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.count = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self.entries())
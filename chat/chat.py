@@ -1,47 +1,165 @@
 import json
+import asyncio
 import logging
 from chat.entities import ChatConversation, ChatTurn
-from chat.gemini import process_gemini_response
-from chat.openai import process_openai_response
-from chat.presenter import TerminalContentPresenter
+from chat.config import (
+    PRESENTER_FLUSH_CHARS,
+    PRESENTER_FRAME_RATE,
+    configure_logging,
+)
+from chat.events import FinalTurn, PromptDone, StatusUpdate
+from chat.presenter import (
+    BufferedContentPresenter,
+    TerminalContentPresenter,
+    async_present_events,
+    present_events,
+)
+from chat.providers import get_provider
+from chat.semantic_cache import get_semantic_cache
+from chat.stats import PromptLimits, PromptStats
+from chat.summary import schedule_summary
 
 
 logger = logging.getLogger(__name__)
 
 
 def prompt_handler(
-    prompt, conversation, tools, excluded_from_history, Presenter, model="openai"
+    prompt,
+    conversation,
+    tools,
+    excluded_from_history,
+    Presenter,
+    model="openai",
+    limits=None,
+    stats=None,
 ):
 
-    logger.info(f"prompt: '{prompt}'")
-
     # display user message in chat history
     Presenter("user", prompt, excluded_from_history=excluded_from_history)
 
+    # consider using st.spinner or st.write_stream while waiting
+    message_placeholder = create_message_placeholder(Presenter, excluded_from_history)
+
+    # process the request, the presenter is a thin adapter over the event stream
+    try:
+        present_events(
+            stream_prompt(
+                prompt,
+                conversation,
+                tools,
+                excluded_from_history,
+                model=model,
+                limits=limits,
+                stats=stats,
+            ),
+            message_placeholder,
+        )
+    finally:
+        # make sure the last buffered update is shown
+        message_placeholder.flush()
+    return conversation
+
+
+def stream_prompt(
+    prompt,
+    conversation,
+    tools,
+    excluded_from_history=False,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """
+    add the prompt to the conversation and yield the typed events of the answer
+    as they stream, without a presenter. the conversation is updated in place
+
+    Args:
+        prompt (str): The user message.
+        excluded_from_history (bool): Whether the prompt and answer are left out of later requests.
+        limits (PromptLimits): Bounds on the tool loop, defaults come from chat.config.
+        stats (PromptStats): Filled in with the round trips, tokens and stop reason.
+
+    Yields:
+        StreamEvent: TextDelta, StatusUpdate, ToolCallStart, ToolResult and FinalTurn
+        events from chat.events, then a PromptDone with the stop reason.
+    """
+
+    logger.info(f"prompt: '{prompt}'")
+
     # create a user message
     user_message = ChatTurn(role="user", content=prompt, excluded=excluded_from_history)
 
     # add the user message to the conversation
     conversation.add(user_message)
 
-    # consider using st.spinner or st.write_stream while waiting
+    try:
+        yield from stream_prompt_request(
+            conversation,
+            tools,
+            excluded_from_history,
+            model=model,
+            limits=limits,
+            stats=stats,
+        )
+    finally:
+        # write the turns of this prompt to the journal in one batch
+        conversation.flush()
+
+
+def create_message_placeholder(Presenter, excluded_from_history=False):
+    """create the streaming assistant message, coalescing updates when PRESENTER_FRAME_RATE is set"""
+
     message_placeholder = Presenter(
         role="assistant",
         content="thinking...",
         static=False,
         excluded_from_history=excluded_from_history,
     )
+    if PRESENTER_FRAME_RATE:
+        message_placeholder = BufferedContentPresenter(
+            message_placeholder,
+            frame_rate=PRESENTER_FRAME_RATE,
+            flush_chars=PRESENTER_FLUSH_CHARS,
+        )
+    return message_placeholder
 
-    # process the request
-    conversation = handle_prompt_request(
-        conversation, message_placeholder, tools, excluded_from_history, model=model
+
+def handle_prompt_request(
+    conversation,
+    message_placeholder,
+    tools={},
+    excluded=False,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """
+    calls the api and keeps calling it with the tool outputs until the model
+    answers or one of the limits is reached, showing the events with a presenter
+
+    Args:
+        limits (PromptLimits): Bounds on the tool loop, defaults come from chat.config.
+        stats (PromptStats): Filled in with the round trips, tokens and stop reason.
+    """
+
+    present_events(
+        stream_prompt_request(conversation, tools, excluded, model, limits, stats),
+        message_placeholder,
     )
+
+    # return conversation, stream_data, event
     return conversation
 
 
-def handle_prompt_request(
-    conversation, message_placeholder, tools={}, excluded=False, model="openai"
+def stream_prompt_request(
+    conversation,
+    tools={},
+    excluded=False,
+    model="openai",
+    limits=None,
+    stats=None,
 ):
+    """the tool loop of handle_prompt_request, yields the typed events instead of showing them"""
 
     logger.debug("=" * 20)
     logger.debug("====== starting_chat_request ======")
@@ -49,37 +167,253 @@ def handle_prompt_request(
 
     logger.info(f"using model: {model}")
 
-    if model == "gemini":
-        conversation = process_gemini_response(
-            conversation, tools, message_placeholder, excluded=False
-        )
+    limits = limits or PromptLimits()
+    stats = stats if stats is not None else PromptStats()
+    stats.model = model
 
-    elif model == "openai":
-        conversation = process_openai_response(
-            conversation, tools, message_placeholder, excluded=False
+    # a prompt that means the same as an earlier one is answered from the semantic cache
+    semantic_cache = get_semantic_cache()
+    prompt_turn = semantic_cache.prompt(conversation) if semantic_cache else None
+    if prompt_turn is not None:
+        cached_turn = serve_from_semantic_cache(
+            semantic_cache, conversation, model, stats
         )
+        if cached_turn is not None:
+            yield FinalTurn(turn=cached_turn)
+            yield PromptDone(stop_reason=stats.stop_reason)
+            return
+
+    # the provider module and its sdk are imported the first time they are used
+    stream_response = get_provider(model, stream=True)
 
-    else:
-        raise ValueError(f"Unknown model: {model}")
+    while True:
 
-    if not conversation.is_user_turn:
+        yield from stream_response(conversation, tools, excluded=False, stats=stats)
+        stats.round_trips += 1
 
-        logger.info(f"recursive_call: -- calling api again with tool outputs --")
+        if conversation.is_user_turn:
+            stats.finish("completed")
+            if prompt_turn is not None:
+                semantic_cache.store(conversation, model, prompt_turn)
+            # compact the older cycles while the user reads the response
+            schedule_summary(conversation, model)
+            yield PromptDone(stop_reason=stats.stop_reason)
+            break
+
+        warn_pending_tool_calls(conversation)
+
+        stopped = stop_tool_loop(stats, limits)
+        if stopped:
+            yield stopped
+            break
+
+        logger.info(f"tool_loop: -- calling api again with tool outputs --")
 
         # add the tool outputs to the conversation
-        message_placeholder.update("verifying data...")
+        yield StatusUpdate(text="verifying data...")
+
+
+def serve_from_semantic_cache(semantic_cache, conversation, model, stats):
+    """answer with the cached assistant turn of a similar earlier prompt, if there is one"""
 
-        # call the api again with the tool outputs and the conversation
-        conversation = handle_prompt_request(
-            conversation, message_placeholder, tools, excluded, model=model
+    cached_turn = semantic_cache.lookup(conversation, model, stats)
+    if cached_turn is None:
+        return None
+
+    conversation.add(cached_turn)
+    stats.finish("completed")
+    return cached_turn
+
+
+def warn_pending_tool_calls(conversation):
+    """every tool call needs an output before the api is called again"""
+    for tool_call in conversation.pending_tool_calls:
+        logger.warning(
+            f"tool_call_without_output: '{tool_call.name}' ({tool_call.call_id})"
         )
 
-    # return conversation, stream_data, event
-    return conversation
+
+def stop_tool_loop(stats, limits) -> PromptDone | None:
+    """check the limits before another round trip, the event lets the user know if we have to stop"""
+
+    stop_reason = stats.exceeded_limit(limits)
+    if not stop_reason:
+        return None
+
+    stats.finish(stop_reason)
+    logger.warning(
+        f"tool_loop_stopped: '{stop_reason}' after {stats.round_trips} round trips, "
+        f"{stats.total_tokens} tokens, {stats.elapsed_seconds:.1f}s"
+    )
+    return PromptDone(
+        stop_reason=stop_reason,
+        message=f"sorry, i had to stop before finishing ({stop_reason.replace('_', ' ')})",
+    )
+
+
+async def async_prompt_handler(
+    prompt,
+    conversation,
+    tools,
+    excluded_from_history,
+    Presenter,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """async version of prompt_handler, yields the typed events after they are shown
+
+    the conversation is updated in place
+    """
+
+    # display user message in chat history
+    Presenter("user", prompt, excluded_from_history=excluded_from_history)
+
+    message_placeholder = create_message_placeholder(Presenter, excluded_from_history)
+
+    # process the request
+    try:
+        async for event in async_present_events(
+            async_stream_prompt(
+                prompt,
+                conversation,
+                tools,
+                excluded_from_history,
+                model=model,
+                limits=limits,
+                stats=stats,
+            ),
+            message_placeholder,
+        ):
+            yield event
+    finally:
+        # make sure the last buffered update is shown
+        message_placeholder.flush()
+
+
+async def async_stream_prompt(
+    prompt,
+    conversation,
+    tools,
+    excluded_from_history=False,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """async version of stream_prompt"""
+
+    logger.info(f"prompt: '{prompt}'")
+
+    # create a user message
+    user_message = ChatTurn(role="user", content=prompt, excluded=excluded_from_history)
+
+    # add the user message to the conversation
+    conversation.add(user_message)
+
+    try:
+        async for event in async_stream_prompt_request(
+            conversation,
+            tools,
+            excluded_from_history,
+            model=model,
+            limits=limits,
+            stats=stats,
+        ):
+            yield event
+    finally:
+        # write the turns of this prompt to the journal in one batch, from a thread
+        # so a database that is busy doesn't block the event loop
+        await asyncio.to_thread(conversation.flush)
+
+
+def async_handle_prompt_request(
+    conversation,
+    message_placeholder,
+    tools={},
+    excluded=False,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """async version of handle_prompt_request, yields the typed events after they are shown"""
+
+    return async_present_events(
+        async_stream_prompt_request(
+            conversation, tools, excluded, model, limits, stats
+        ),
+        message_placeholder,
+    )
+
+
+async def async_stream_prompt_request(
+    conversation,
+    tools={},
+    excluded=False,
+    model="openai",
+    limits=None,
+    stats=None,
+):
+    """async version of stream_prompt_request"""
+
+    logger.debug("=" * 20)
+    logger.debug("====== starting_async_chat_request ======")
+    logger.debug(conversation.to_api_format())
+
+    logger.info(f"using model: {model}")
+
+    limits = limits or PromptLimits()
+    stats = stats if stats is not None else PromptStats()
+    stats.model = model
+
+    # a prompt that means the same as an earlier one is answered from the semantic cache
+    semantic_cache = get_semantic_cache()
+    prompt_turn = semantic_cache.prompt(conversation) if semantic_cache else None
+    if prompt_turn is not None:
+        cached_turn = serve_from_semantic_cache(
+            semantic_cache, conversation, model, stats
+        )
+        if cached_turn is not None:
+            yield FinalTurn(turn=cached_turn)
+            yield PromptDone(stop_reason=stats.stop_reason)
+            return
+
+    # the provider module and its sdk are imported the first time they are used
+    stream_response = get_provider(model, asynchronous=True, stream=True)
+
+    while True:
+
+        async for event in stream_response(
+            conversation, tools, excluded=False, stats=stats
+        ):
+            yield event
+        stats.round_trips += 1
+
+        if conversation.is_user_turn:
+            stats.finish("completed")
+            if prompt_turn is not None:
+                semantic_cache.store(conversation, model, prompt_turn)
+            # compact the older cycles while the user reads the response
+            schedule_summary(conversation, model)
+            yield PromptDone(stop_reason=stats.stop_reason)
+            break
+
+        warn_pending_tool_calls(conversation)
+
+        stopped = stop_tool_loop(stats, limits)
+        if stopped:
+            yield stopped
+            break
+
+        logger.info(f"tool_loop: -- calling api again with tool outputs --")
+
+        # add the tool outputs to the conversation
+        yield StatusUpdate(text="verifying data...")
 
 
 if __name__ == "__main__":
 
+    configure_logging()
+
     def prompt_terminal(prompt: str):
 
         logger.info(f"prompt: '{prompt}'")
@@ -1,12 +1,104 @@
+import asyncio
 import logging
+import importlib.util
+import threading
 import os
 
-
 # region config
 
 OPENAI_MODEL_NAME = "gpt-4.1"
 GEMINI_MODEL_NAME = "gemini-2.0-flash"
 
+# run the tool calls from a single model turn concurrently
+PARALLEL_TOOL_CALLS = True
+# maximum number of tools running at the same time across all conversations
+TOOL_MAX_WORKERS = 8
+# seconds before a tool call is abandoned, override per tool with @tool_timeout
+TOOL_TIMEOUT_SECONDS = 30
+# cache the results of tools marked with @cacheable
+TOOL_CACHE_MAX_SIZE = 1024
+TOOL_CACHE_TTL_SECONDS = 60
+# cache every tool unless it is marked with @not_cacheable
+CACHE_TOOLS_BY_DEFAULT = False
+
+# stop calling the api again with tool outputs after this many round trips
+MAX_TOOL_ROUND_TRIPS = 10
+# seconds a prompt may spend in the tool loop before it is stopped
+PROMPT_TIMEOUT_SECONDS = 120
+# input plus output tokens a prompt may use across all round trips, None is unlimited
+PROMPT_TOKEN_BUDGET = None
+
+# replay the recorded response when the same request was answered before, None
+# disables the cache, "memory" keeps it in the process and "disk" shares it between
+# processes through RESPONSE_CACHE_DIRECTORY
+RESPONSE_CACHE = None
+RESPONSE_CACHE_DIRECTORY = ".response_cache"
+RESPONSE_CACHE_MAX_SIZE = 256
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+# only cache prompts sent with history disabled, their payload doesn't depend on the session
+RESPONSE_CACHE_EXCLUDED_ONLY = True
+
+# answer a prompt with the assistant turn of an earlier prompt that means the same,
+# compared by the similarity of their embeddings
+SEMANTIC_CACHE = False
+# cosine similarity a cached prompt needs to be served, close to 1 only matches near copies
+SEMANTIC_CACHE_THRESHOLD = 0.9
+# prompts kept per persona and model, the oldest are replaced first
+SEMANTIC_CACHE_MAX_SIZE = 4096
+# only serve and store prompts sent with history disabled, other answers depend on the session
+SEMANTIC_CACHE_EXCLUDED_ONLY = True
+
+# estimated tokens of conversation history sent with each request, older cycles are
+# left out to stay within it. None sends the whole history
+CONTEXT_TOKEN_BUDGETS = {
+    OPENAI_MODEL_NAME: None,
+    GEMINI_MODEL_NAME: None,
+}
+
+# summarize the older cycles in the background once the history that isn't summarized
+# yet reaches this many estimated tokens, None disables summaries
+SUMMARY_TRIGGER_TOKENS = None
+# the most recent cycles are always sent as they are
+SUMMARY_KEEP_CYCLES = 4
+
+# journaled conversations are fsynced after this many turns or seconds, whichever comes first
+JOURNAL_FSYNC_EVERY_TURNS = 16
+JOURNAL_FSYNC_SECONDS = 1.0
+
+# conversations stored in sqlite are written in one transaction per prompt, or once
+# this many turns are waiting
+SQLITE_FLUSH_EVERY_TURNS = 64
+# seconds a write waits for another process to release the database
+SQLITE_BUSY_TIMEOUT_SECONDS = 5.0
+
+# connections kept to the provider apis, shared by every thread and conversation
+HTTP_MAX_CONNECTIONS = 100
+# idle connections kept open for reuse, and for how many seconds
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_SECONDS = 60
+HTTP_CONNECT_TIMEOUT_SECONDS = 5.0
+# seconds to wait for the next chunk of a streaming response
+HTTP_READ_TIMEOUT_SECONDS = 120.0
+# multiplex requests over one connection per host, needs `pip install h2`
+HTTP2 = True
+# retries for failed connections and retryable status codes
+HTTP_MAX_RETRIES = 2
+
+# conversations the server keeps in memory, the least recently used idle ones are
+# dropped first and reloaded from the store if the server has one
+SERVER_MAX_SESSIONS = 10_000
+# prompts the server sends to each provider at the same time
+SERVER_MAX_CONCURRENT_PROMPTS = 64
+# prompts waiting for a provider before new ones are turned away with a 503
+SERVER_MAX_WAITING_PROMPTS = 256
+# frames waiting for a slow client before new deltas are merged into the last one
+SERVER_MAX_QUEUED_FRAMES = 256
+
+# redraw streaming responses at most this many times per second, None redraws on every delta
+PRESENTER_FRAME_RATE = 30
+# redraw early once this many characters are waiting
+PRESENTER_FLUSH_CHARS = 4096
+
 # endregion config
 
 # region configure logging
@@ -14,17 +106,24 @@ GEMINI_MODEL_NAME = "gemini-2.0-flash"
 CHAT_LOG_FILEPATH = "chat_log.txt"
 # CHAT_LOG_FILEPATH = Path("data") / "chat_log.txt"
 
-
-logging.basicConfig(
-    filename=CHAT_LOG_FILEPATH,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    encoding="utf-8",
-    force=True,
-)
 logger = logging.getLogger(__name__)
 
+
+def configure_logging():
+    """
+    log to CHAT_LOG_FILEPATH, called by the entry points (main.py, streamlit.py and
+    the server app) when they start. a host that already configured logging keeps
+    its handlers
+    """
+    logging.basicConfig(
+        filename=CHAT_LOG_FILEPATH,
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        encoding="utf-8",
+    )
+
+
 # endregion configure logging
 
 
@@ -32,6 +131,9 @@ logger = logging.getLogger(__name__)
 
 
 def load_env():
+    # the keys can also come straight from the environment
+    if not os.path.exists(".env"):
+        return
     with open(".env") as f:
         for line in f:
             if line.strip() and not line.startswith("#"):
@@ -39,15 +141,136 @@ def load_env():
                 os.environ[key] = value.replace('"', "").strip()
 
 
-load_env()
+api_key_names = {
+    "openai": "OPENAI_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+}
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
-gemini_api_key = os.getenv("GEMINI_API_KEY")
 
-if not openai_api_key:
-    raise ValueError(
-        "OpenAI API key not found. Please set the OPENAI_API_KEY environment variable."
-    )
+def get_api_key(provider: str) -> str:
+    """read the api key for a provider, only the providers that are used need a key"""
+    setup()
+    env_name = api_key_names[provider]
+    api_key = os.getenv(env_name)
+    if not api_key:
+        raise ValueError(
+            f"{provider} API key not found. Please set the {env_name} environment variable."
+        )
+    return api_key
+
+
+def __getattr__(name):
+    # openai_api_key and gemini_api_key used to be read at import time
+    if name in ["openai_api_key", "gemini_api_key"]:
+        setup()
+        return os.getenv(api_key_names[name.removesuffix("_api_key")])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # endregion api key handling
+
+
+# region http clients
+
+
+def http_timeout():
+    """the timeouts for api requests, streaming responses only time out between chunks"""
+    import httpx
+
+    return httpx.Timeout(
+        HTTP_READ_TIMEOUT_SECONDS,
+        connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+        pool=HTTP_CONNECT_TIMEOUT_SECONDS,
+    )
+
+
+def http_client_args() -> dict:
+    """the pool, keep-alive, timeout and http/2 settings for the httpx clients"""
+    import httpx
+
+    http2 = HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("http2_unavailable: h2 is not installed, using http/1.1")
+        http2 = False
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+        ),
+        "timeout": http_timeout(),
+        "http2": http2,
+        "follow_redirects": True,
+    }
+
+
+# created on first use, the lock makes threads that start at the same time share one pool
+_http_clients = {}
+_async_http_clients = {}
+# reentrant, since a provider client is created with the http client of its loop
+_http_clients_lock = threading.RLock()
+
+
+def http_client():
+    """
+    the pooled httpx client every provider sends its requests through, created on
+    first use. httpx clients are thread safe, so connections are reused across
+    threads and conversations instead of being opened for every request
+    """
+    with _http_clients_lock:
+        if "client" not in _http_clients:
+            import httpx
+
+            _http_clients["client"] = httpx.Client(**http_client_args())
+        return _http_clients["client"]
+
+
+def async_http_client():
+    """the pooled httpx client for async requests on the running event loop"""
+
+    def create():
+        import httpx
+
+        return httpx.AsyncClient(**http_client_args())
+
+    return loop_local(_async_http_clients, create)
+
+
+def loop_local(clients: dict, create: callable):
+    """
+    the client for the running event loop from `clients`, created on first use.
+    async connections belong to the loop that opened them, so a client can't be
+    reused by a later asyncio.run(). the clients of closed loops are dropped
+
+    Args:
+        clients (dict): The clients by event loop.
+        create (callable): Creates a client for the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _http_clients_lock:
+        for closed in [other for other in clients if other.is_closed()]:
+            del clients[closed]
+        if loop not in clients:
+            clients[loop] = create()
+        return clients[loop]
+
+
+# endregion http clients
+
+
+# region setup
+
+_is_setup = False
+
+
+def setup():
+    """load the .env file, runs once on first use instead of at import"""
+    global _is_setup
+    if _is_setup:
+        return
+    _is_setup = True
+    load_env()
+
+
+# endregion setup
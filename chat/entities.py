@@ -1,5 +1,7 @@
 from pydantic import BaseModel, Field
-import json
+from bisect import bisect_left
+from chat.serialization import dumpb, loads, stable_dumps
+from chat.tokens import estimate_message_tokens, estimate_size_tokens
 
 
 class ChatTurn(BaseModel):
@@ -20,6 +22,13 @@ class ChatTurn(BaseModel):
         return cls(role=data["role"], content=content, excluded=excluded)
 
 
+class ConversationSummary(BaseModel):
+    """a summary that stands in for the cycles that start before turn `through`"""
+
+    text: str
+    through: int
+
+
 class ToolCallTurn(BaseModel):
     call_id: str
     name: str
@@ -35,99 +44,435 @@ class ToolOutputTurn(BaseModel):
     excluded: bool = False
 
 
+class CompactTurn:
+    """
+    slotted storage for a turn that was already validated by its pydantic model,
+    it exposes the same attributes and model_dump() at a fraction of the memory
+    """
+
+    __slots__ = ()
+    model = None
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def from_model(cls, turn: BaseModel):
+        return cls(**{name: getattr(turn, name) for name in cls.__slots__})
+
+    def model_dump(self) -> dict:
+        # the values are shared with the turn, not copied
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_model(self) -> BaseModel:
+        return self.model.model_construct(**self.model_dump())
+
+    def __eq__(self, other):
+        if not isinstance(other, (CompactTurn, BaseModel)):
+            return NotImplemented
+        return self.model_dump() == other.model_dump()
+
+    def __repr__(self):
+        fields = " ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class CompactChatTurn(CompactTurn):
+    __slots__ = ("role", "content", "excluded")
+    model = ChatTurn
+
+
+class CompactToolCallTurn(CompactTurn):
+    __slots__ = ("call_id", "name", "type", "arguments", "excluded")
+    model = ToolCallTurn
+
+
+class CompactToolOutputTurn(CompactTurn):
+    __slots__ = ("call_id", "output", "type", "excluded")
+    model = ToolOutputTurn
+
+
+compact_turn_types = {
+    ChatTurn: CompactChatTurn,
+    ToolCallTurn: CompactToolCallTurn,
+    ToolOutputTurn: CompactToolOutputTurn,
+}
+
+
+def to_compact_turn(turn):
+    """convert a pydantic turn to its compact form, anything else is returned as is"""
+    compact_type = compact_turn_types.get(type(turn))
+    return compact_type.from_model(turn) if compact_type else turn
+
+
+class ApiPayloadBuilder:
+    """incrementally builds the api payload for one provider as turns are added to a conversation"""
+
+    def __init__(self, gemini=False):
+        self.gemini = gemini
+        # number of turns this builder has seen
+        self.count = 0
+        # formatted messages from cycles that can no longer change
+        self.closed = []
+        # formatted messages from the latest cycle, its inclusion depends on what comes next
+        self.cycle = []
+        # the first message or a system message opens a cycle that is always included
+        self.cycle_is_anchor = True
+        # whether the user message that opened the latest cycle is excluded
+        self.cycle_excluded = False
+        # role of the last message in the latest cycle, tool turns count as the assistant
+        self.cycle_last_role = None
+        # map call_id to function name for gemini function responses
+        self.call_id_to_name_map = {}
+        # index of the turn that opened the latest cycle, and the anchor cycle
+        self.cycle_turn_start = 0
+        self.anchor_turn_start = 0
+        # [start, end, tokens, is_anchor, turn_start] of each cycle in closed, used to trim
+        # to a token budget or a summary. tokens are estimated the first time they are needed
+        self.closed_cycles = []
+        # turn_start of each closed cycle, to find where a summary ends
+        self.closed_turn_starts = []
+        # number of closed cycles left out by the last build
+        self.dropped_cycles = 0
+        # utf-8 size of closed[:idx] at each idx, measured the first time it is needed
+        self.closed_offsets = [0]
+        # (anchor_end, start, messages) of the last build, it sent closed[:anchor_end],
+        # then closed[start:] after the summary, then the messages after them
+        self.built = None
+
+    def add(self, turn: ChatTurn | ToolCallTurn | ToolOutputTurn | dict):
+        """format a single turn and place it in the payload"""
+
+        # convert the message to a dict, copying so we never modify the source
+        message = dict(turn) if isinstance(turn, dict) else turn.model_dump()
+
+        # clean up the message for the api
+        message_excluded = message.pop("excluded", None)
+        role = message.get("role")
+
+        if message.get("type") == "function_call":
+            self.call_id_to_name_map[message["call_id"]] = message["name"]
+
+        message = self.format(message)
+
+        # if this is a system message or the first message, everything before it is dropped
+        if self.count == 0 or role == "system":
+            self.closed = []
+            self.closed_cycles = []
+            self.closed_turn_starts = []
+            self.closed_offsets = [0]
+            self.cycle = [message]
+            self.cycle_is_anchor = True
+            self.cycle_turn_start = self.count
+            self.anchor_turn_start = self.count
+
+        # a user message closes the previous cycle, so we can decide whether to keep it
+        elif role == "user":
+            self.close_cycle()
+            self.cycle = [message]
+            self.cycle_is_anchor = False
+            self.cycle_turn_start = self.count
+            self.cycle_excluded = message_excluded
+
+        # otherwise, add the message to the current cycle
+        else:
+            self.cycle.append(message)
+
+        self.cycle_last_role = role or "assistant"
+        self.count += 1
+
+    def extend(self, turns: list):
+        for turn in turns:
+            self.add(turn)
+
+    def close_cycle(self):
+        """move the latest cycle to closed if it should be sent to the api"""
+        included = self.included_cycle()
+        if not included:
+            return
+        start = len(self.closed)
+        self.closed.extend(included)
+        self.closed_cycles.append(
+            [start, len(self.closed), None, self.cycle_is_anchor, self.cycle_turn_start]
+        )
+        self.closed_turn_starts.append(self.cycle_turn_start)
+
+    def closed_cycle_tokens(self, idx: int) -> int:
+        """estimated tokens of a closed cycle, cached since closed cycles can't change"""
+        closed_cycle = self.closed_cycles[idx]
+        if closed_cycle[2] is None:
+            start, end = closed_cycle[0], closed_cycle[1]
+            offsets = self.measure_closed(end)
+            closed_cycle[2] = sum(
+                estimate_size_tokens(offsets[position + 1] - offsets[position])
+                for position in range(start, end)
+            )
+        return closed_cycle[2]
+
+    def measure_closed(self, end: int) -> list[int]:
+        """the offsets of the closed messages, measured up to `end`"""
+        offsets = self.closed_offsets
+        for message in self.closed[len(offsets) - 1 : end]:
+            offsets.append(offsets[-1] + len(dumpb(message)))
+        return offsets
+
+    def payload_bytes(self) -> int:
+        """
+        the utf-8 size of the payload the last build returned, encoded as json. the
+        closed messages are only measured once, so this doesn't grow with the history
+        """
+        if self.built is None:
+            self.build()
+        anchor_end, start, messages = self.built
+        end = len(self.closed)
+        offsets = self.measure_closed(end)
+        size = offsets[anchor_end] + offsets[end] - offsets[start]
+        size += sum(len(dumpb(message)) for message in messages)
+        count = anchor_end + end - start + len(messages)
+        # the brackets and the commas between the messages
+        return size + 2 + max(count - 1, 0)
+
+    def format(self, message: dict) -> dict:
+        if self.gemini:
+            return ChatConversation.gemini_formatter(message, self.call_id_to_name_map)
+
+        if "arguments" in message:
+            # if this is a tool call, we need to convert the args to a string
+            message["arguments"] = stable_dumps(message["arguments"])
+
+        if "output" in message:
+            # if this is a tool call, we need to convert the args to a string
+            message["output"] = str(message["output"])
+
+        return message
+
+    def included_cycle(self) -> list[dict]:
+        """the messages from the latest cycle that should be sent to the api"""
+
+        # the system message and the latest user message must always be included
+        if self.cycle_is_anchor or len(self.cycle) == 1:
+            return self.cycle
+
+        # assume that the assistant response is the end of every turn
+        # if the last message in this turn is not assistant, add it
+        if self.cycle_last_role != "assistant":
+            return self.cycle
+
+        # if the current turn is excluded
+        if self.cycle_excluded:
+            return []
+
+        return self.cycle
+
+    def build(
+        self, token_budget: int | None = None, summary: "ConversationSummary" = None
+    ) -> list[dict]:
+        """
+        the payload for the api
+
+        Args:
+            token_budget (int): Leave out the oldest cycles so the estimated tokens fit
+                the budget. the system message and the latest cycle are always sent,
+                and cycles are kept whole so tool calls stay paired with their outputs.
+            summary (ConversationSummary): Replaces the cycles it covers with a single message.
+        """
+        included = self.included_cycle()
+        self.dropped_cycles = 0
+        if token_budget is None and summary is None:
+            self.built = (len(self.closed), len(self.closed), included)
+            return self.closed + included
+
+        # the cycle opened by the system message is always sent
+        anchors = 0
+        anchor_end = 0
+        if self.closed_cycles and self.closed_cycles[0][3]:
+            anchors = 1
+            anchor_end = self.closed_cycles[0][1]
+
+        # skip the cycles covered by the summary, unless a system message came after it
+        first = anchors
+        summary_messages = []
+        if summary is not None and summary.through > self.anchor_turn_start:
+            first = bisect_left(self.closed_turn_starts, summary.through, anchors)
+            summary_messages = [self.format_summary(summary)]
+
+        start = self.closed_cycle_start(first)
+        if token_budget is not None:
+            start = self.fit_to_budget(
+                token_budget, first, anchors, summary_messages + included
+            )
+
+        self.built = (anchor_end, start, summary_messages + included)
+        return (
+            self.closed[:anchor_end] + summary_messages + self.closed[start:] + included
+        )
+
+    def closed_cycle_start(self, idx: int) -> int:
+        """index in closed where a closed cycle starts, the end of closed if there is none"""
+        if idx < len(self.closed_cycles):
+            return self.closed_cycles[idx][0]
+        return len(self.closed)
+
+    def fit_to_budget(
+        self, token_budget: int, first: int, anchors: int, always_sent: list[dict]
+    ) -> int:
+        """
+        returns the index in closed from which the most recent cycles fit the budget,
+        and counts the cycles that are left out
+        """
+
+        tokens = sum(estimate_message_tokens(message) for message in always_sent)
+        if anchors:
+            tokens += self.closed_cycle_tokens(0)
+
+        # keep the most recent cycles that fit
+        start = len(self.closed)
+        kept = 0
+        for idx in range(len(self.closed_cycles) - 1, first - 1, -1):
+            cycle_tokens = self.closed_cycle_tokens(idx)
+            if tokens + cycle_tokens > token_budget:
+                break
+            tokens += cycle_tokens
+            start = self.closed_cycles[idx][0]
+            kept += 1
+
+        self.dropped_cycles = len(self.closed_cycles) - first - kept
+        return start
+
+    def format_summary(self, summary: "ConversationSummary") -> dict:
+        return self.format(
+            {
+                "role": "system",
+                "content": f"summary of the earlier conversation:\n{summary.text}",
+            }
+        )
+
+    def unsummarized_cycles(
+        self, through: int = 0
+    ) -> list[tuple[int, list[dict], int]]:
+        """
+        the closed cycles a summary that ends at `through` doesn't cover, as
+        (turn_start, messages, tokens) tuples, the anchor cycle is never summarized
+        """
+        anchors = 1 if self.closed_cycles and self.closed_cycles[0][3] else 0
+        first = bisect_left(self.closed_turn_starts, through, anchors)
+        return [
+            (
+                self.closed_cycles[idx][4],
+                self.closed[self.closed_cycles[idx][0] : self.closed_cycles[idx][1]],
+                self.closed_cycle_tokens(idx),
+            )
+            for idx in range(first, len(self.closed_cycles))
+        ]
+
+
 class ChatConversation:
 
-    def __init__(self, messages: list[ChatTurn | dict] = []):
+    def __init__(
+        self, messages: list[ChatTurn | dict] = [], compact: bool = False, journal=None
+    ):
+        self.messages = []
+        # store turns as slotted CompactTurns instead of pydantic models
+        self.compact = compact
+        # a chat.storage JournalStore or SqliteJournal that new turns are written to
+        self.journal = journal
+        # cached api payload builders, keyed by whether they format for gemini
+        self._payload_builders = {}
+        # tool calls that don't have an output yet, keyed by call_id
+        self._pending_tool_calls = {}
+        # number of messages reflected in the turn state
+        self._turn_state_count = 0
+        # replaces the older cycles in the api payload, swapped in whole by chat.summary
+        self.summary = None
+        self._summary_future = None
         if messages and isinstance(messages[0], dict):
-            self.messages = []
             self.load(data=messages)
         else:
-            self.messages = messages
+            self.add(list(messages))
 
     def add(self, turn: list | ChatTurn | ToolCallTurn | ToolOutputTurn):
         """add a turn or list of turns to the conversation"""
 
         if isinstance(turn, list):
+            if self.compact:
+                turn = [to_compact_turn(item) for item in turn]
             self.messages.extend(turn)
         else:
+            if self.compact:
+                turn = to_compact_turn(turn)
             self.messages.append(turn)
 
-    def to_api_format(self, messages=None, gemini=False) -> list[dict]:
-        """Convert the conversation to the API format, removes any excluded messages and format the conversation"""
+        self._update_turn_state()
+        if self.journal is not None:
+            self.journal.sync(self.messages)
 
-        # if data is provided, use that instead of the current messages
-        message_list = messages if messages else self.messages
+    def flush(self):
+        """make the turns added so far durable in the journal, called when a prompt is done"""
+        if self.journal is not None:
+            self.journal.flush()
 
-        output_conv = []
-        current_cycle = []
+    def _update_turn_state(self):
+        """track the tool calls without outputs for the turns we haven't seen yet"""
 
-        if gemini:
-            # first pass: map call_id to function name for outputs
-            call_id_to_name_map = {}
-            for message in message_list:
-                if hasattr(message, "type") and message.type == "function_call":
-                    call_id_to_name_map[message.call_id] = message.name
+        # start over if messages were removed from the conversation
+        if self._turn_state_count > len(self.messages):
+            self._pending_tool_calls = {}
+            self._turn_state_count = 0
 
-        for idx, message in reversed(list(enumerate(message_list))):
+        for message in self.messages[self._turn_state_count :]:
+            message_type = getattr(message, "type", None)
+            if message_type == "function_call":
+                self._pending_tool_calls[message.call_id] = message
+            elif message_type == "function_call_output":
+                self._pending_tool_calls.pop(message.call_id, None)
 
-            # convert the message to a dict if it is not already
-            if not isinstance(message, dict):
-                message = message.model_dump()
+        self._turn_state_count = len(self.messages)
 
-            # clean up the message for the api
-            message_excluded = message.pop("excluded", None)
+    def to_api_format(
+        self, messages=None, gemini=False, token_budget=None
+    ) -> list[dict]:
+        """Convert the conversation to the API format, removes any excluded messages and format the conversation
 
-            if not gemini:
-                if "arguments" in message:
-                    # if this is a tool call, we need to convert the args to a string
-                    message["arguments"] = json.dumps(message["arguments"])
+        the formatted payload is cached per provider, so only turns added since the last call are formatted.
+        with a token_budget, the oldest cycles are left out so the estimated tokens fit within it
+        """
 
-                if "output" in message:
-                    # if this is a tool call, we need to convert the args to a string
-                    message["output"] = str(message["output"])
+        # if data is provided, build a one off payload from that instead of the current messages
+        if messages:
+            builder = ApiPayloadBuilder(gemini=gemini)
+            builder.extend(messages)
+            return builder.build(token_budget)
 
-            # if this is a system message or the first message, thats it, exit
-            if idx == 0 or message.get("role") == "system":
-                current_cycle.append(message)
-                output_conv.extend(current_cycle)
-                break
+        # read the summary once, it can be replaced by another thread at any time
+        summary = self.summary
+        if summary is not None and summary.through > len(self.messages):
+            # the turns it covers were removed
+            summary = None
+
+        return self.payload_builder(gemini).build(token_budget, summary)
+
+    def payload_builder(self, gemini=False) -> ApiPayloadBuilder:
+        """the cached payload builder for a provider, caught up with the conversation"""
 
-            # otherwise, add the message to the current turn
-            current_cycle.append(message)
-
-            # if the message is a user
-            if "role" in message and message["role"] == "user":
-
-                # if this is the last message and its a user it must be included
-                if idx == len(message_list) - 1:
-                    output_conv.append(message)
-                    current_cycle = []
-                    continue
-
-                # assume that the assistant response is the end of every turn
-                # if the last message in this turn is not assistant, add it
-                if current_cycle[0].get("role", "assistant") != "assistant":
-                    output_conv.extend(current_cycle)
-                    current_cycle = []
-                    continue
-
-                # if the current turn is excluded
-                if message_excluded:
-                    current_cycle = []
-                    continue
-
-                # add the current turn to the conversation
-                output_conv.extend(current_cycle)
-                current_cycle = []
-
-        result = list(reversed(output_conv))
-        if gemini:
-            # format the messages for gemini
-            result = [
-                self.gemini_formatter(message, call_id_to_name_map)
-                for message in result
-            ]
-        return result
+        builder = self._payload_builders.get(gemini)
+
+        # start over if messages were removed from the conversation
+        if builder is None or builder.count > len(self.messages):
+            builder = ApiPayloadBuilder(gemini=gemini)
+            self._payload_builders[gemini] = builder
+
+        # format only the turns we haven't seen yet
+        builder.extend(self.messages[builder.count :])
+        return builder
+
+    def api_payload_bytes(self, gemini=False) -> int:
+        """the utf-8 size of the payload to_api_format returned last for a provider"""
+        return self.payload_builder(gemini).payload_bytes()
+
+    def invalidate_api_cache(self):
+        """drop the cached api payloads, call this after modifying turns that are already in the conversation"""
+        self._payload_builders = {}
 
     @staticmethod
     def gemini_formatter(message, call_id_to_name_map):
@@ -168,28 +513,37 @@ class ChatConversation:
         """check if the last message in the conversation is an assistant turn."""
         if not self.messages:
             return False
-        message_json = self.messages[-1].model_dump()
+        # read the attributes directly, this runs after every api call
+        last_message = self.messages[-1]
         # check if the last message is a user turn,
-        if message_json.get("role") == "assistant":
+        if getattr(last_message, "role", None) == "assistant":
             return True
         # check if the last message is a function response
-        if message_json.get("type") == "function_call_output":
+        if getattr(last_message, "type", None) == "function_call_output":
             return False
         return True
 
+    @property
+    def pending_tool_calls(self) -> list[ToolCallTurn]:
+        """tool calls that haven't received an output yet, in the order they were made"""
+        if self._turn_state_count != len(self.messages):
+            self._update_turn_state()
+        return list(self._pending_tool_calls.values())
+
     def asdict(self):
         return [message.model_dump() for message in self.messages]
 
-    def save(self, filename="conversation.json"):
-        with open(filename, "w") as f:
-            json.dump(self.asdict(), f, indent=4)
+    def save(self, filename="conversation.json", indent=False):
+        """write the conversation as compact json, `indent` makes it easier to read"""
+        with open(filename, "wb") as f:
+            f.write(dumpb(self.asdict(), indent=indent))
 
     def load(self, filename="conversation.json", data=None):
         if data:
             data = data
         else:
-            with open(filename, "r") as f:
-                data = json.load(f)
+            with open(filename, "rb") as f:
+                data = loads(f.read())
 
         for item in data:
             if item.get("type") == "function_call":
@@ -0,0 +1,71 @@
+# purpose: the typed events a response streams, shared by every provider
+from pydantic import BaseModel, Field
+from chat.entities import ChatTurn, ToolCallTurn, ToolOutputTurn
+
+
+class TextDelta(BaseModel):
+    """text appended to the response, the text starts over after any other event"""
+
+    text: str
+    type: str = "text_delta"
+
+
+class StatusUpdate(BaseModel):
+    """what the model is doing instead of writing, like searching the web or verifying data"""
+
+    text: str
+    type: str = "status"
+
+
+class ToolCallStart(BaseModel):
+    """the model asked for a tool, it runs right after this event"""
+
+    call_id: str
+    name: str
+    arguments: dict = Field(default_factory=dict)
+    type: str = "tool_call"
+
+
+class ToolResult(BaseModel):
+    call_id: str
+    name: str | None = None
+    output: int | str | list | dict
+    type: str = "tool_result"
+
+
+class FinalTurn(BaseModel):
+    """the assistant turn a response ended with, it was added to the conversation"""
+
+    turn: ChatTurn
+    type: str = "final_turn"
+
+
+class PromptDone(BaseModel):
+    """
+    the last event of a prompt, `message` tells the user why the tool loop stopped
+    when it didn't complete
+    """
+
+    stop_reason: str
+    message: str | None = None
+    type: str = "done"
+
+
+StreamEvent = (
+    TextDelta | StatusUpdate | ToolCallStart | ToolResult | FinalTurn | PromptDone
+)
+
+
+def tool_result_events(turns: list[ToolCallTurn | ToolOutputTurn]) -> list[ToolResult]:
+    """the results of a batch of tool calls, as returned by tool_calls_handler"""
+
+    names = {
+        turn.call_id: turn.name for turn in turns if turn.type != "function_call_output"
+    }
+    return [
+        ToolResult(
+            call_id=turn.call_id, name=names.get(turn.call_id), output=turn.output
+        )
+        for turn in turns
+        if turn.type == "function_call_output"
+    ]
@@ -1,84 +1,303 @@
 import json
-from chat.config import GEMINI_MODEL_NAME, gemini_api_key
+import functools
+from chat.config import (
+    CONTEXT_TOKEN_BUDGETS,
+    GEMINI_MODEL_NAME,
+    HTTP_MAX_RETRIES,
+    HTTP_READ_TIMEOUT_SECONDS,
+    async_http_client,
+    get_api_key,
+    http_client,
+    loop_local,
+)
 import logging
-from google import genai
 from chat.entities import ChatTurn, ToolCallTurn
+from chat.events import FinalTurn, TextDelta, ToolCallStart, tool_result_events
+from chat.presenter import async_present_events, present_events
+from chat.response_cache import async_open_stream, open_stream
 from chat.tools import (
-    generate_tool_schema_gemini,
-    tool_call_handler,
+    async_tool_calls_handler,
+    get_tool_schemas,
+    tool_calls_handler,
 )
 
 logger = logging.getLogger(__name__)
 
-# load the gemini api client
-client = genai.Client(api_key=gemini_api_key)
 
+# region clients
+
+
+def create_client(httpx_client=None, httpx_async_client=None):
+    """create a gemini api client, the sdk is only imported when it's needed"""
+    from google import genai
+    from google.genai import types
+
+    return genai.Client(
+        api_key=get_api_key("gemini"),
+        http_options=types.HttpOptions(
+            httpx_client=httpx_client,
+            httpx_async_client=httpx_async_client,
+            # the sdk sends this with every request in milliseconds, replacing the
+            # client's timeouts, so it also bounds connecting
+            timeout=int(HTTP_READ_TIMEOUT_SECONDS * 1000),
+            retry_options=types.HttpRetryOptions(attempts=HTTP_MAX_RETRIES + 1),
+        ),
+    )
 
-def process_gemini_response(conversation, tools, message_placeholder, excluded=False):
 
-    tool_schemas = [generate_tool_schema_gemini(tool) for tool in tools.values()]
+@functools.cache
+def get_client():
+    """the client for sync calls, created on first use"""
+    return create_client(httpx_client=http_client())
+
+
+# the async clients by event loop
+_async_clients = {}
+
+
+def get_async_client():
+    """the client for async calls through client.aio on the running event loop"""
+    return loop_local(
+        _async_clients,
+        lambda: create_client(httpx_async_client=async_http_client()),
+    )
+
+
+# endregion clients
+
+
+def stream_gemini_response(
+    conversation, tools, excluded=False, stats=None, client=None
+):
+    """
+    call the api and yield the typed events of the response as it streams, the
+    response turns and tool outputs are added to the conversation in place
+
+    Args:
+        conversation (ChatConversation): The conversation to answer.
+        tools (dict[str, callable]): A mapping from tool names to callable functions.
+        excluded (bool): Whether the response turns are excluded from the history.
+        stats (PromptStats): Filled in with the request size, events and tokens.
+        client: The api client, created on first use by default.
+    """
+
+    client = client or get_client()
 
     # call the api with tool definitions
-    response = client.models.generate_content_stream(
-        model=GEMINI_MODEL_NAME,
-        contents=conversation.to_api_format(gemini=True),
-        config={
-            "response_mime_type": "text/plain",
-            "tools": tool_schemas,
-        },
+    request = build_request(conversation, tools)
+    record_request(conversation, stats)
+    response = open_stream(
+        "gemini",
+        conversation,
+        request,
+        lambda: client.models.generate_content_stream(**request),
+        dump_event,
+        stats,
     )
 
     # initialize a dictionary to hold the streaming data
-    stream_data = {"nosave": [], "text": "", "function_calls": []}
+    stream_data = {"nosave": [], "text_parts": [], "function_calls": []}
 
     # process the streaming data
     for idx, event in enumerate(response):
-        logger.debug(f"event: {event}")
+        record_event(event, stats)
+        stream_events, tool_call_turns = handle_stream_event(
+            idx, event, stream_data, excluded
+        )
+        yield from stream_events
+        if tool_call_turns:
+            # call the tool call handler to get the tool outputs
+            turns = tool_calls_handler(tool_call_turns, tools, stats=stats)
+            conversation.add(turns)
+            yield from tool_result_events(turns)
 
-        # check if the event is a delta of a text response
-        if event.function_calls is None:
-            # identify the unique output item index
-            output_index = "text"
+    record_usage(stream_data, stats)
 
-            # add the text delta to the response data
-            if event.text.endswith("\n"):
-                # if the text ends with a newline, remove it
-                stream_data[output_index] += event.text[:-1]
-            else:
-                stream_data[output_index] += event.text
+    assistant_turn = create_assistant_turn(stream_data, excluded)
+    if assistant_turn:
+        conversation.add(assistant_turn)
+        yield FinalTurn(turn=assistant_turn)
 
-            # stream only the new delta to the console
-            # gather for chat parts and display to user
-            full_response = stream_data[output_index]
-            message_placeholder.update(full_response + "▌")
 
-        else:
+async def async_stream_gemini_response(
+    conversation, tools, excluded=False, stats=None, client=None
+):
+    """async version of stream_gemini_response"""
 
-            for fn_idx, fn in enumerate(event.function_calls):
+    client = client or get_async_client()
 
-                message_placeholder.update(f"using tool: {fn.name}...▌")
+    # call the api with tool definitions
+    request = build_request(conversation, tools)
+    record_request(conversation, stats)
+    response = await async_open_stream(
+        "gemini",
+        conversation,
+        request,
+        lambda: client.aio.models.generate_content_stream(**request),
+        dump_event,
+        stats,
+    )
 
-                # create a tool call turn from the output
-                function_call_turn = ToolCallTurn(
-                    call_id=f"fn_{idx:03d}_{fn_idx:03d}",
-                    name=fn.name,
-                    arguments=fn.args,
-                    excluded=excluded,
-                )
-                conversation.add(function_call_turn)
+    # initialize a dictionary to hold the streaming data
+    stream_data = {"nosave": [], "text_parts": [], "function_calls": []}
 
-                # call the tool call handler to get the tool output
-                tool_output_turn = tool_call_handler(function_call_turn, tools)
-                conversation.add(tool_output_turn)
+    # process the streaming data
+    idx = 0
+    async for event in response:
+        record_event(event, stats)
+        stream_events, tool_call_turns = handle_stream_event(
+            idx, event, stream_data, excluded
+        )
+        for stream_event in stream_events:
+            yield stream_event
+        if tool_call_turns:
+            # call the tool call handler to get the tool outputs
+            turns = await async_tool_calls_handler(tool_call_turns, tools, stats=stats)
+            conversation.add(turns)
+            for stream_event in tool_result_events(turns):
+                yield stream_event
+        idx += 1
 
-    if stream_data["text"]:
+    record_usage(stream_data, stats)
 
-        # create a chat turn for the assistant response and add it to the conversation
-        assistant_turn = ChatTurn(
-            role="assistant", content=stream_data["text"], excluded=excluded
-        )
-        logger.info(f"response: '{stream_data['text']}'")
-        message_placeholder.update(stream_data["text"])
+    assistant_turn = create_assistant_turn(stream_data, excluded)
+    if assistant_turn:
         conversation.add(assistant_turn)
+        yield FinalTurn(turn=assistant_turn)
+
+
+def process_gemini_response(
+    conversation, tools, message_placeholder, excluded=False, stats=None, client=None
+):
+    """answer with the gemini api and show the response with a presenter"""
 
+    present_events(
+        stream_gemini_response(conversation, tools, excluded, stats, client),
+        message_placeholder,
+    )
     return conversation
+
+
+def async_process_gemini_response(
+    conversation, tools, message_placeholder, excluded=False, stats=None, client=None
+):
+    """async version of process_gemini_response, yields each event after it is shown
+
+    the conversation is updated in place
+    """
+
+    return async_present_events(
+        async_stream_gemini_response(conversation, tools, excluded, stats, client),
+        message_placeholder,
+    )
+
+
+def build_request(conversation, tools) -> dict:
+    """assemble the keyword arguments for generate_content_stream"""
+
+    tool_schemas = get_tool_schemas(tools, "gemini")
+
+    return {
+        "model": GEMINI_MODEL_NAME,
+        "contents": conversation.to_api_format(
+            gemini=True, token_budget=CONTEXT_TOKEN_BUDGETS.get(GEMINI_MODEL_NAME)
+        ),
+        "config": {
+            "response_mime_type": "text/plain",
+            "tools": tool_schemas,
+        },
+    }
+
+
+def record_request(conversation, stats=None):
+    """record the size of the conversation sent to the api"""
+    if stats is not None:
+        # measured by the payload builder, the closed cycles aren't encoded again
+        stats.record_request(conversation.api_payload_bytes(gemini=True))
+
+
+def record_event(event, stats=None):
+    if stats is not None:
+        stats.record_event(text=event.function_calls is None)
+
+
+def record_usage(stream_data, stats=None):
+    """add the token usage of a completed stream to the prompt stats"""
+    usage = stream_data.get("usage")
+    if stats is not None and usage is not None:
+        stats.record_usage(usage.prompt_token_count, usage.candidates_token_count)
+
+
+def dump_event(event) -> dict:
+    """
+    the parts of the event the stream processing reads, as json for the response
+    cache. the usage is left out since a replay costs no tokens
+    """
+    if event.function_calls is None:
+        return {"text": event.text, "function_calls": None}
+    return {
+        "text": None,
+        "function_calls": [
+            {"name": fn.name, "args": fn.args} for fn in event.function_calls
+        ],
+    }
+
+
+def handle_stream_event(
+    idx, event, stream_data, excluded=False
+) -> tuple[list[TextDelta | ToolCallStart], list[ToolCallTurn]]:
+    """
+    assemble a single streaming event into stream_data, return the events it shows
+    the user and any tool calls it contains
+    """
+
+    logger.debug(f"event: {event}")
+
+    # usage is cumulative, so the last chunk that reports it has the totals
+    if getattr(event, "usage_metadata", None) is not None:
+        stream_data["usage"] = event.usage_metadata
+
+    # check if the event is a delta of a text response
+    if event.function_calls is None:
+        # if the text ends with a newline, remove it
+        delta = event.text[:-1] if event.text.endswith("\n") else event.text
+
+        # the parts are joined once the stream is complete, so a delta costs the same
+        # at the end of a long response as at the start
+        stream_data["text_parts"].append(delta)
+        return [TextDelta(text=delta)], []
+
+    stream_events = []
+    tool_call_turns = []
+    for fn_idx, fn in enumerate(event.function_calls):
+
+        # create a tool call turn from the output
+        function_call_turn = ToolCallTurn(
+            call_id=f"fn_{idx:03d}_{fn_idx:03d}",
+            name=fn.name,
+            arguments=fn.args,
+            excluded=excluded,
+        )
+        tool_call_turns.append(function_call_turn)
+        stream_events.append(
+            ToolCallStart(
+                call_id=function_call_turn.call_id,
+                name=fn.name,
+                arguments=function_call_turn.arguments,
+            )
+        )
+
+    return stream_events, tool_call_turns
+
+
+def create_assistant_turn(stream_data, excluded=False):
+    """create the assistant turn from the streamed text, if there was any"""
+
+    text = "".join(stream_data["text_parts"])
+    if not text:
+        return None
+
+    # create a chat turn for the assistant response and add it to the conversation
+    assistant_turn = ChatTurn(role="assistant", content=text, excluded=excluded)
+    logger.info(f"response: '{text}'")
+    return assistant_turn
@@ -0,0 +1,169 @@
+# purpose: export prompt instrumentation as json lines or prometheus metrics
+import threading
+from bisect import bisect_left
+from chat.stats import DELTA_GAP_BUCKETS_MS
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS_SECONDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class JsonLinesExporter:
+    """
+    prompt hook that appends the stats of every finished prompt to a file as a json line
+
+    Args:
+        filepath (str): The file the lines are appended to.
+    """
+
+    def __init__(self, filepath: str = "prompt_stats.jsonl"):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+
+    def __call__(self, event_name, stats, data):
+        if event_name != "finish":
+            return
+        line = stats.model_dump_json()
+        with self.lock:
+            with open(self.filepath, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class PrometheusExporter:
+    """
+    prompt hook that aggregates finished prompts into prometheus metrics, serve
+    the output of render() from a /metrics endpoint
+    """
+
+    def __init__(self, prefix: str = "chat"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> {"buckets": [...], "counts": [...], "sum": float, "count": int}
+        self.histograms = {}
+
+    def __call__(self, event_name, stats, data):
+        if event_name != "finish":
+            return
+
+        model = (("model", stats.model or "unknown"),)
+        with self.lock:
+            self.increment(
+                "prompts_total", model + (("stop_reason", stats.stop_reason),)
+            )
+            self.increment("round_trips_total", model, stats.round_trips)
+            self.increment("cached_round_trips_total", model, stats.cached_round_trips)
+            self.increment(
+                "tokens_total", model + (("direction", "input"),), stats.input_tokens
+            )
+            self.increment(
+                "tokens_total", model + (("direction", "output"),), stats.output_tokens
+            )
+            self.increment("request_bytes_total", model, sum(stats.request_bytes))
+            if stats.semantic_cache is not None:
+                self.increment(
+                    "semantic_cache_lookups_total",
+                    model + (("result", stats.semantic_cache),),
+                )
+
+            self.observe(
+                "prompt_duration_seconds",
+                model,
+                LATENCY_BUCKETS_SECONDS,
+                stats.elapsed_seconds,
+            )
+            if stats.first_event_seconds is not None:
+                self.observe(
+                    "time_to_first_event_seconds",
+                    model,
+                    LATENCY_BUCKETS_SECONDS,
+                    stats.first_event_seconds,
+                )
+            if stats.first_text_seconds is not None:
+                self.observe(
+                    "time_to_first_text_seconds",
+                    model,
+                    LATENCY_BUCKETS_SECONDS,
+                    stats.first_text_seconds,
+                )
+            self.merge_delta_gaps(model, stats)
+            for timing in stats.tool_timings:
+                self.observe(
+                    "tool_duration_seconds",
+                    (("tool", timing.name),),
+                    LATENCY_BUCKETS_SECONDS,
+                    timing.seconds,
+                )
+                if timing.timed_out:
+                    self.increment("tool_timeouts_total", (("tool", timing.name),))
+
+    def increment(self, name: str, labels: tuple, value: float = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, labels: tuple, buckets: list) -> dict:
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = {
+                "buckets": buckets,
+                "counts": [0] * (len(buckets) + 1),
+                "sum": 0.0,
+                "count": 0,
+            }
+        return self.histograms[key]
+
+    def observe(self, name: str, labels: tuple, buckets: list, value: float):
+        histogram = self.histogram(name, labels, buckets)
+        histogram["counts"][bisect_left(buckets, value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def merge_delta_gaps(self, labels: tuple, stats):
+        """the gaps are already bucketed by the stats, so add the counts directly"""
+        histogram = self.histogram(
+            "delta_gap_milliseconds", labels, DELTA_GAP_BUCKETS_MS
+        )
+        for idx, count in enumerate(stats.delta_gap_counts):
+            histogram["counts"][idx] += count
+        histogram["sum"] += stats.delta_gap_total_seconds * 1000
+        histogram["count"] += sum(stats.delta_gap_counts)
+
+    def format_labels(self, labels: tuple) -> str:
+        if not labels:
+            return ""
+        pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+        return "{" + pairs + "}"
+
+    def render(self) -> str:
+        """the metrics in the prometheus text exposition format"""
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (key, labels), value in self.counters.items():
+                    if key == name:
+                        lines.append(f"{metric}{self.format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for (key, labels), histogram in self.histograms.items():
+                    if key != name:
+                        continue
+                    # prometheus buckets are cumulative
+                    cumulative = 0
+                    bounds = histogram["buckets"] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram["counts"]):
+                        cumulative += count
+                        bucket_labels = self.format_labels(labels + (("le", bound),))
+                        lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+                    lines.append(
+                        f"{metric}_sum{self.format_labels(labels)} {histogram['sum']}"
+                    )
+                    lines.append(
+                        f"{metric}_count{self.format_labels(labels)} {histogram['count']}"
+                    )
+
+        return "\n".join(lines) + "\n"
@@ -1,106 +1,361 @@
-import json
-from chat.config import OPENAI_MODEL_NAME, openai_api_key
+import functools
+from chat.config import (
+    CONTEXT_TOKEN_BUDGETS,
+    HTTP_MAX_RETRIES,
+    OPENAI_MODEL_NAME,
+    async_http_client,
+    get_api_key,
+    http_client,
+    http_timeout,
+    loop_local,
+)
 import logging
-import openai
 from chat.entities import ChatTurn, ToolCallTurn, ToolOutputTurn
+from chat.events import (
+    FinalTurn,
+    StatusUpdate,
+    StreamEvent,
+    TextDelta,
+    ToolCallStart,
+    tool_result_events,
+)
+from chat.presenter import async_present_events, present_events
+from chat.response_cache import async_open_stream, dump_value, open_stream
+from chat.serialization import loads
 from chat.tools import (
-    generate_tool_schema_openai,
-    tool_call_handler,
+    async_tool_calls_handler,
+    get_tool_schemas,
+    tool_calls_handler,
 )
 
 logger = logging.getLogger(__name__)
 
-# load the openai api client
-client = openai.OpenAI(api_key=openai_api_key)
 
+# region clients
 
-def process_openai_response(conversation, tools, message_placeholder, excluded=False):
 
-    tool_schemas = [generate_tool_schema_openai(tool) for tool in tools.values()]
-    tool_schemas += [{"type": "web_search_preview", "search_context_size": "low"}]
+@functools.cache
+def get_client():
+    """create the openai api client on first use, the sdk is only imported when it's needed"""
+    import openai
+
+    return openai.OpenAI(
+        api_key=get_api_key("openai"),
+        http_client=http_client(),
+        timeout=http_timeout(),
+        max_retries=HTTP_MAX_RETRIES,
+    )
+
+
+# the async clients by event loop
+_async_clients = {}
+
+
+def get_async_client():
+    """the async client for the running event loop, each loop needs its own connections"""
+
+    def create():
+        import openai
+
+        return openai.AsyncOpenAI(
+            api_key=get_api_key("openai"),
+            http_client=async_http_client(),
+            timeout=http_timeout(),
+            max_retries=HTTP_MAX_RETRIES,
+        )
+
+    return loop_local(_async_clients, create)
+
+
+# endregion clients
+
+
+def stream_openai_response(
+    conversation, tools, excluded=False, stats=None, client=None
+):
+    """
+    call the api and yield the typed events of the response as it streams, the
+    response turns and tool outputs are added to the conversation in place
+
+    Args:
+        conversation (ChatConversation): The conversation to answer.
+        tools (dict[str, callable]): A mapping from tool names to callable functions.
+        excluded (bool): Whether the response turns are excluded from the history.
+        stats (PromptStats): Filled in with the request size, events and tokens.
+        client: The api client, created on first use by default.
+    """
+
+    client = client or get_client()
 
     # call the api with tool definitions
-    response = client.responses.create(
-        model=OPENAI_MODEL_NAME,
-        input=conversation.to_api_format(),
-        store=False,
-        stream=True,
-        tools=tool_schemas,
+    request = build_request(conversation, tools)
+    record_request(conversation, stats)
+    response = open_stream(
+        "openai",
+        conversation,
+        request,
+        lambda: client.responses.create(**request),
+        dump_event,
+        stats,
     )
 
     # initialize a dictionary to hold the streaming data
     stream_data = {"nosave": []}
 
-    # for event in response:
-    #     stream_data["nosave"].append(event)
-    #     logger.info(f"event: {event.type} - {event}")
-
     # process the streaming data
     for event in response:
-        logger.debug(f"event: {event.type} - {event}")
-
-        # this is the start of any response
-        if event.type == "response.output_item.added":
-            # we add the response to the response data so we can assemble it
-            stream_data[event.output_index] = event.item
-
-        # this is the start of a streaming text response
-        elif event.type == "response.content_part.added":
-            # we add the response to the response data so we can assemble it
-            stream_data[event.output_index].content = event.part
-
-        # check if the event is a delta of a text response
-        elif event.type == "response.output_text.delta":
-            # identify the unique output item index
-            output_index = event.output_index
-
-            # ensure that the index exists in the response data
-            if not stream_data[output_index]:
-                raise ValueError(
-                    "received 'response.output_text.delta' before 'response.output_item.added'"
-                )
+        record_event(event, stats)
+        stream_event = handle_stream_event(event, stream_data)
+        if stream_event is not None:
+            yield stream_event
 
-            # add the text delta to the response data
-            stream_data[output_index].content.text += event.delta
-
-            # web search results are not aligned with our personality, so we dont want to stream them to the user
-            if stream_data[output_index].type == "web_search_call":
-                message_placeholder.update("searching...▌")
-                continue
-            if (
-                output_index > 0
-                and stream_data.get(output_index - 1).type == "web_search_call"
-            ):
-                message_placeholder.update("searching...▌")
-                continue
-
-            # stream only the new delta to the console
-            # gather for chat parts and display to user
-            full_response = stream_data[output_index].content.text
-            message_placeholder.update(full_response + "▌")
-
-        # check if the event is a delta of a function call
-        elif event.type == "response.function_call_arguments.delta":
-            # identify the unique response item index
-            index = event.output_index
-            # assemble the function call arguments to the response data
-            if stream_data[index]:
-                stream_data[index].arguments += event.delta
-
-            message_placeholder.update("checking tools...▌")
+    # extract the final response from the stream data, this contains the full response
+    final_event = event.response
+    record_usage(final_event, stats)
+
+    # after handling the streaming data, we use the response objects instead of the stream data
+    for item in parse_final_response(final_event, excluded):
+        if isinstance(item, list):
+            # call the tool call handler to get the tool outputs
+            turns = tool_calls_handler(item, tools, stats=stats)
+            conversation.add(turns)
+            yield from tool_result_events(turns)
+        elif isinstance(item, StreamEvent):
+            yield item
         else:
-            stream_data["nosave"].append(event)
+            yield from add_turn(conversation, item)
+
+
+async def async_stream_openai_response(
+    conversation, tools, excluded=False, stats=None, client=None
+):
+    """async version of stream_openai_response"""
+
+    client = client or get_async_client()
+
+    # call the api with tool definitions
+    request = build_request(conversation, tools)
+    record_request(conversation, stats)
+    response = await async_open_stream(
+        "openai",
+        conversation,
+        request,
+        lambda: client.responses.create(**request),
+        dump_event,
+        stats,
+    )
+
+    # initialize a dictionary to hold the streaming data
+    stream_data = {"nosave": []}
+
+    # process the streaming data
+    async for event in response:
+        record_event(event, stats)
+        stream_event = handle_stream_event(event, stream_data)
+        if stream_event is not None:
+            yield stream_event
 
     # extract the final response from the stream data, this contains the full response
     final_event = event.response
+    record_usage(final_event, stats)
 
     # after handling the streaming data, we use the response objects instead of the stream data
+    for item in parse_final_response(final_event, excluded):
+        if isinstance(item, list):
+            # call the tool call handler to get the tool outputs
+            turns = await async_tool_calls_handler(item, tools, stats=stats)
+            conversation.add(turns)
+            for stream_event in tool_result_events(turns):
+                yield stream_event
+        elif isinstance(item, StreamEvent):
+            yield item
+        else:
+            for stream_event in add_turn(conversation, item):
+                yield stream_event
+
+
+def process_openai_response(
+    conversation, tools, message_placeholder, excluded=False, stats=None, client=None
+):
+    """answer with the openai api and show the response with a presenter"""
+
+    present_events(
+        stream_openai_response(conversation, tools, excluded, stats, client),
+        message_placeholder,
+    )
+    return conversation
+
+
+def async_process_openai_response(
+    conversation, tools, message_placeholder, excluded=False, stats=None, client=None
+):
+    """async version of process_openai_response, yields each event after it is shown
+
+    the conversation is updated in place
+    """
+
+    return async_present_events(
+        async_stream_openai_response(conversation, tools, excluded, stats, client),
+        message_placeholder,
+    )
+
+
+def build_request(conversation, tools) -> dict:
+    """assemble the keyword arguments for responses.create"""
+
+    tool_schemas = get_tool_schemas(tools, "openai")
+    tool_schemas += [{"type": "web_search_preview", "search_context_size": "low"}]
+
+    return {
+        "model": OPENAI_MODEL_NAME,
+        "input": conversation.to_api_format(
+            token_budget=CONTEXT_TOKEN_BUDGETS.get(OPENAI_MODEL_NAME)
+        ),
+        "store": False,
+        "stream": True,
+        "tools": tool_schemas,
+    }
+
+
+def record_request(conversation, stats=None):
+    """record the size of the conversation sent to the api"""
+    if stats is not None:
+        # measured by the payload builder, the closed cycles aren't encoded again
+        stats.record_request(conversation.api_payload_bytes())
+
+
+def record_event(event, stats=None):
+    if stats is not None:
+        stats.record_event(text=event.type == "response.output_text.delta")
+
+
+def record_usage(final_event, stats=None):
+    """add the token usage of a completed response to the prompt stats"""
+    usage = getattr(final_event, "usage", None)
+    if stats is not None and usage is not None:
+        stats.record_usage(usage.input_tokens, usage.output_tokens)
+
+
+def dump_event(event) -> dict:
+    """the event as json for the response cache, without the usage since a replay costs no tokens"""
+    data = dump_value(event)
+    if data.get("type") == "response.completed":
+        data["response"]["usage"] = None
+    return data
+
+
+def handle_stream_event(event, stream_data) -> TextDelta | StatusUpdate | None:
+    """assemble a single streaming event into stream_data and return what it shows the user"""
+
+    logger.debug(f"event: {event.type} - {event}")
+
+    # this is the start of any response
+    if event.type == "response.output_item.added":
+        # we add the response to the response data so we can assemble it
+        stream_data[event.output_index] = event.item
+
+    # this is the start of a streaming text response
+    elif event.type == "response.content_part.added":
+        # we add the response to the response data so we can assemble it
+        stream_data[event.output_index].content = event.part
+
+    # check if the event is a delta of a text response
+    elif event.type == "response.output_text.delta":
+        # identify the unique output item index
+        output_index = event.output_index
+
+        # ensure that the index exists in the response data
+        if not stream_data[output_index]:
+            raise ValueError(
+                "received 'response.output_text.delta' before 'response.output_item.added'"
+            )
+
+        # the full text is read from the completed response, so the deltas are only
+        # passed on instead of being joined here for every event
+
+        # web search results are not aligned with our personality, so we dont want to stream them to the user
+        if stream_data[output_index].type == "web_search_call":
+            return status_event(stream_data, "searching...")
+        if (
+            output_index > 0
+            and stream_data.get(output_index - 1).type == "web_search_call"
+        ):
+            return status_event(stream_data, "searching...")
+
+        # stream only the new delta
+        stream_data["status"] = None
+        return TextDelta(text=event.delta)
+
+    # check if the event is a delta of a function call
+    elif event.type == "response.function_call_arguments.delta":
+        # identify the unique response item index
+        index = event.output_index
+        # assemble the function call arguments to the response data
+        if stream_data[index]:
+            stream_data[index].arguments += event.delta
+
+        return status_event(stream_data, "checking tools...")
+    else:
+        stream_data["nosave"].append(event)
+
+
+def status_event(stream_data, text: str) -> StatusUpdate | None:
+    """a status update, unless the same status was the last thing shown"""
+    if stream_data.get("status") == text:
+        return None
+    stream_data["status"] = text
+    return StatusUpdate(text=text)
+
+
+def add_turn(conversation, turn):
+    """add a response turn to the conversation and return the events it causes"""
+    conversation.add(turn)
+    if isinstance(turn, ToolOutputTurn):
+        return tool_result_events([turn])
+    if isinstance(turn, ChatTurn):
+        return [FinalTurn(turn=turn)]
+    return []
+
+
+def parse_final_response(final_event, excluded=False):
+    """
+    yields the conversation turns from a completed response in order, consecutive
+    function calls are yielded together as a list so the caller can execute them.
+    the status and tool call events are yielded before the turns they belong to
+    """
+
+    tool_call_turns = []
+
     for idx, output in enumerate(final_event.output):
+
+        # we process function calls in order they are received so we can assemble the conversation
+        if output.type == "function_call":
+            # create a tool call turn from the output
+            function_call_turn = ToolCallTurn(
+                call_id=output.call_id,
+                name=output.name,
+                type=output.type,
+                arguments=loads(output.arguments),
+                excluded=excluded,
+            )
+            tool_call_turns.append(function_call_turn)
+            yield ToolCallStart(
+                call_id=output.call_id,
+                name=output.name,
+                arguments=function_call_turn.arguments,
+            )
+            continue
+
+        # hand over any function calls before moving on to the next output
+        if tool_call_turns:
+            yield tool_call_turns
+            tool_call_turns = []
+
         if output.type == "message":
 
             # web search results are not aligned with our personality, so we treat them as tool responses
             if idx != 0 and final_event.output[idx - 1].type == "web_search_call":
-                message_placeholder.update("verifying data...")
+                yield StatusUpdate(text="verifying data...")
                 # set the output id to the previous web search call id so the model knows which tool call its for
                 web_search_call_id = final_event.output[idx - 1].id
 
@@ -110,7 +365,7 @@ def process_openai_response(conversation, tools, message_placeholder, excluded=F
                     call_id=web_search_call_id, output=text_output, excluded=excluded
                 )
                 logger.info(f"tool_result: '{tool_output_turn.model_dump()}'")
-                conversation.add(tool_output_turn)
+                yield tool_output_turn
 
             else:
                 # get all of the text from the response
@@ -120,41 +375,25 @@ def process_openai_response(conversation, tools, message_placeholder, excluded=F
                     role=output.role, content=text_output, excluded=excluded
                 )
                 logger.info(f"response: '{text_output}'")
-                message_placeholder.update(text_output)
-                conversation.add(assistant_turn)
-
-        # we process function calls in order they are received so we can assemble the conversation
-        elif output.type == "function_call":
-            message_placeholder.update(f"using tool: {output.name}...▌")
-            # create a tool call turn from the output
-            function_call_turn = ToolCallTurn(
-                call_id=output.call_id,
-                name=output.name,
-                type=output.type,
-                arguments=json.loads(output.arguments),
-                excluded=excluded,
-            )
-            conversation.add(function_call_turn)
-
-            # call the tool call handler to get the tool output
-            tool_output_turn = tool_call_handler(function_call_turn, tools)
-            conversation.add(tool_output_turn)
+                yield assistant_turn
 
         # we convert web search calls to tool calls
         elif output.type == "web_search_call":
             logger.info(f"tool_call: '{output.type}'")
-            message_placeholder.update("searching...▌")
+            yield StatusUpdate(text="searching...")
             # apply the necessary attributes to the tool call turn as a web search call
             tool_call_turn = ToolCallTurn(
                 call_id=output.id,
                 name=output.type,
                 excluded=excluded,
             )
-            conversation.add(tool_call_turn)
+            yield tool_call_turn
 
         else:
             # log an error for unknown output types so we have some visibility
             logger.warning(
                 f"unknown output type: {output.type} for output: {str(output)}"
             )
-    return conversation
+
+    if tool_call_turns:
+        yield tool_call_turns
@@ -1,5 +1,34 @@
+import time
+import shutil
+import asyncio
+from collections import deque
+
+
+class StreamedText:
+    """
+    text that grows by appending deltas. the parts are only joined when the whole
+    text is read, so appending doesn't copy the text that is already there
+    """
+
+    def __init__(self, text: str = ""):
+        self.parts = [text]
+
+    def append(self, text: str):
+        self.parts.append(text)
+
+    @property
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0]
+
+
 class ContentPresenter:
-    """displays chat messages to the user"""
+    """
+    displays chat messages to the user. presenters that can show streamed text
+    without the text before it also define `append(text)`, the others get the
+    whole text with every update
+    """
 
     def __init__(
         self,
@@ -20,9 +49,22 @@ class ContentPresenter:
         self.content = content
         pass
 
+    def flush(self):
+        """show any content that is still buffered, called once the response is complete"""
+        pass
+
 
 class TerminalContentPresenter(ContentPresenter):
-    """displays chat messages to the user in the terminal"""
+    """
+    displays chat messages to the user in the terminal
+
+    with `delta` enabled, appended text and updates that extend the displayed text
+    only print the new suffix, so streaming a long response stays linear. when the
+    text is replaced, like "searching...", the wrapped lines are cleared and the
+    message is redrawn. the trailing cursor is left to the terminal in this mode
+    """
+
+    cursor = "▌"
 
     def __init__(
         self,
@@ -30,8 +72,12 @@ class TerminalContentPresenter(ContentPresenter):
         content: str,
         static: bool = True,
         excluded_from_history: bool = False,
+        delta: bool = True,
     ):
         super().__init__(role, content, static, excluded_from_history)
+        self.delta = delta
+        # the text currently on screen after the role prefix
+        self.displayed = StreamedText()
         if static:
             print(f"{role}: {self.content}")
         else:
@@ -39,6 +85,384 @@ class TerminalContentPresenter(ContentPresenter):
 
     def update(self, content: str):
         self.content = content
-        # Move cursor to start of line, clear it, re-print
-        print("\r\033[K", end="", flush=True)
-        print(f"{self.role}: {self.content}", end="", flush=True)
+
+        if not self.delta:
+            # Move cursor to start of line, clear it, re-print
+            print("\r\033[K", end="", flush=True)
+            print(f"{self.role}: {self.content}", end="", flush=True)
+            return
+
+        text = content.removesuffix(self.cursor)
+        displayed = self.displayed.text
+        if text.startswith(displayed):
+            # only write what was appended
+            print(text[len(displayed) :], end="", flush=True)
+        else:
+            self.redraw(text)
+        self.displayed = StreamedText(text)
+
+    def append(self, text: str):
+        """show streamed text at the end of the message"""
+        if not self.delta:
+            self.update(self.content.removesuffix(self.cursor) + text + self.cursor)
+            return
+        print(text, end="", flush=True)
+        self.displayed.append(text)
+
+    def redraw(self, text: str):
+        """clear every row the displayed message wrapped onto and print the new text"""
+        rows = self.count_rows(f"{self.role}: {self.displayed.text}")
+        # move to the first row of the message, then clear to the end of the screen
+        move_up = f"\033[{rows - 1}A" if rows > 1 else ""
+        print(f"\r{move_up}\033[J{self.role}: {text}", end="", flush=True)
+
+    @staticmethod
+    def count_rows(text: str) -> int:
+        """the number of terminal rows the text occupies once wrapped"""
+        width = shutil.get_terminal_size().columns
+        return sum(max(1, -(-len(line) // width)) for line in text.split("\n"))
+
+
+class BufferedContentPresenter:
+    """
+    wraps a presenter and coalesces streaming updates so the wrapped presenter
+    redraws at most `frame_rate` times per second
+
+    appended text and updates that only append to the displayed text are held back
+    until the frame interval has passed or `flush_chars` characters are waiting.
+    anything else, like a status message or the final response without the cursor,
+    is shown straight away. the appended text of a frame is passed on in one
+    `append` when the wrapped presenter has it. there is no background timer, so
+    call flush() when the response is complete
+    """
+
+    cursor = "▌"
+
+    def __init__(
+        self,
+        presenter: ContentPresenter,
+        frame_rate: float = 30,
+        flush_chars: int | None = 4096,
+    ):
+        self.presenter = presenter
+        self.interval = 1 / frame_rate if frame_rate else 0
+        self.flush_chars = flush_chars
+        self.content = getattr(presenter, "content", "")
+        self.displayed = self.content
+        # text appended since the last frame
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+
+    def update(self, content: str):
+        self.content = content
+        # the content includes the text that was appended
+        self.pending = []
+        self.pending_chars = 0
+
+        # status messages and the final response replace the text, show them now
+        if (
+            self.displayed is None
+            or not content.endswith(self.cursor)
+            or not content.startswith(self.displayed.removesuffix(self.cursor))
+        ):
+            self.flush()
+        elif time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+        elif (
+            self.flush_chars and len(content) - len(self.displayed) >= self.flush_chars
+        ):
+            self.flush()
+
+    def append(self, text: str):
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+        elif self.flush_chars and self.pending_chars >= self.flush_chars:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            text = "".join(self.pending)
+            self.pending = []
+            self.pending_chars = 0
+            if hasattr(self.presenter, "append"):
+                # the update that was held back comes before the appended text
+                if self.content != self.displayed:
+                    self.presenter.update(self.content)
+                self.presenter.append(text)
+                # the wrapped presenter shows more than the content kept here, the
+                # next update is shown whatever it is
+                self.content = self.displayed = None
+            else:
+                self.content = (
+                    self.content.removesuffix(self.cursor) + text + self.cursor
+                )
+        if self.content != self.displayed:
+            self.presenter.update(self.content)
+            self.displayed = self.content
+        self.last_flush = time.monotonic()
+        # presenters that don't inherit from ContentPresenter may not have flush
+        if hasattr(self.presenter, "flush"):
+            self.presenter.flush()
+
+    def __getattr__(self, name):
+        # everything else is handled by the wrapped presenter
+        if name == "presenter":
+            raise AttributeError(name)
+        return getattr(self.presenter, name)
+
+
+# region event presenter
+
+
+class EventPresenter:
+    """
+    shows the typed events of a response with a presenter: text deltas are shown
+    with a trailing cursor, status messages and tool calls replace the text, and
+    the final turn is shown without the cursor. presenters with `append` get each
+    delta on its own, the others get the deltas joined so far
+
+    Args:
+        presenter (ContentPresenter): The presenter of the streaming assistant message.
+    """
+
+    cursor = "▌"
+
+    def __init__(self, presenter: ContentPresenter):
+        self.presenter = presenter
+        self.appends = hasattr(presenter, "append")
+        # the text joined so far, for presenters without append
+        self.text = ""
+        self.streaming = False
+
+    def show(self, event):
+        if event.type == "text_delta":
+            if not self.appends:
+                self.text += event.text
+                self.presenter.update(self.text + self.cursor)
+            elif self.streaming:
+                self.presenter.append(event.text)
+            else:
+                # the first delta replaces the status message
+                self.presenter.update(event.text + self.cursor)
+            self.streaming = True
+            return
+
+        # the next text delta starts a new text
+        self.text = ""
+        self.streaming = False
+        if event.type == "status":
+            self.presenter.update(event.text + self.cursor)
+        elif event.type == "tool_call":
+            self.presenter.update(f"using tool: {event.name}...{self.cursor}")
+        elif event.type == "final_turn":
+            self.presenter.update(event.turn.content)
+        elif event.type == "done" and event.message:
+            self.presenter.update(event.message)
+
+
+def present_events(events, presenter: ContentPresenter):
+    """show every event of a stream with a presenter"""
+    event_presenter = EventPresenter(presenter)
+    for event in events:
+        event_presenter.show(event)
+
+
+async def async_present_events(events, presenter: ContentPresenter):
+    """show every event of an async stream with a presenter, yielding each one after it is shown"""
+    event_presenter = EventPresenter(presenter)
+    async for event in events:
+        event_presenter.show(event)
+        yield event
+
+
+# endregion event presenter
+
+
+# region network presenter
+
+
+class FrameQueue:
+    """
+    the frames waiting to be sent over one connection. the producer never waits:
+    a status frame replaces the unsent frames of its message (drop to latest), and
+    once `max_frames` are waiting new deltas are merged into the last frame, so a
+    slow consumer receives fewer, larger frames and the same final text. frames are
+    merged again as they are taken, so every send carries everything that is waiting
+
+    Args:
+        max_frames (int): The frames that may wait before deltas are merged.
+    """
+
+    def __init__(self, max_frames: int = 256):
+        self.max_frames = max_frames
+        self.frames = deque()
+        self.closed = False
+        self.ready = asyncio.Event()
+        # frames that were dropped or merged instead of sent on their own
+        self.dropped = 0
+
+    def put(self, frame: dict):
+        if frame["type"] == "replace":
+            # the text is replaced, so the unsent changes to this message don't matter
+            while self.frames and self.is_change(self.frames[-1], frame["message"]):
+                self.frames.pop()
+                self.dropped += 1
+            self.frames.append(frame)
+        elif (
+            frame["type"] == "delta"
+            and len(self.frames) >= self.max_frames
+            and self.is_change(self.frames[-1], frame["message"])
+        ):
+            self.frames[-1] = self.merge(self.frames[-1], frame)
+            self.dropped += 1
+        else:
+            self.frames.append(frame)
+        self.ready.set()
+
+    @staticmethod
+    def is_change(frame: dict, message: int) -> bool:
+        """whether a frame changes the text of a message"""
+        return frame["message"] == message and frame["type"] in ["delta", "replace"]
+
+    @staticmethod
+    def merge(frame: dict, delta: dict) -> dict:
+        # frames can be shared with the stream history, so they are copied
+        return {**frame, "seq": delta["seq"], "text": frame["text"] + delta["text"]}
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self) -> dict | None:
+        """the next frame with the deltas that follow it, None once the stream is closed"""
+        while not self.frames:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+
+        frame = self.frames.popleft()
+        if frame["type"] in ["delta", "replace"]:
+            while self.frames and self.frames[0]["type"] == "delta":
+                if self.frames[0]["message"] != frame["message"]:
+                    break
+                frame = self.merge(frame, self.frames.popleft())
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        frame = await self.get()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+
+class FrameStream:
+    """
+    the numbered frames of a response, fanned out to every connection that follows
+    it. frames are kept, so a client that reconnects can resume after the last
+    sequence number it received. use it from the event loop thread
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.messages = 0
+        self.history = []
+        self.queues = []
+        self.closed = False
+
+    def publish(self, frame: dict) -> dict:
+        self.seq += 1
+        frame = {"seq": self.seq, **frame}
+        self.history.append(frame)
+        for queue in self.queues:
+            queue.put(frame)
+        return frame
+
+    def subscribe(self, after: int = 0, max_frames: int = 256) -> FrameQueue:
+        """a queue with the frames after sequence number `after`, then the new frames"""
+        queue = FrameQueue(max_frames)
+        for frame in self.history[after:]:
+            queue.put(frame)
+        if self.closed:
+            queue.close()
+        else:
+            self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: FrameQueue):
+        if queue in self.queues:
+            self.queues.remove(queue)
+
+    def close(self):
+        self.closed = True
+        for queue in self.queues:
+            queue.close()
+        self.queues = []
+
+
+class NetworkContentPresenter(ContentPresenter):
+    """
+    publishes messages to a FrameStream for server-sent events or websockets.
+    appended text and updates that extend the text only send the new suffix as a
+    "delta" frame, anything else, like a status message, is sent whole as a
+    "replace" frame, so the bytes sent grow linearly with the response. the
+    trailing cursor is left to the client
+
+    Args:
+        stream (FrameStream): Where the frames are published.
+    """
+
+    cursor = "▌"
+
+    def __init__(
+        self,
+        role: str,
+        content: str,
+        static: bool = True,
+        excluded_from_history: bool = False,
+        stream: FrameStream = None,
+    ):
+        super().__init__(role, content, static, excluded_from_history)
+        self.stream = stream
+        stream.messages += 1
+        self.message = stream.messages
+        self.displayed = StreamedText(content.removesuffix(self.cursor))
+        stream.publish(
+            {
+                "type": "message",
+                "message": self.message,
+                "role": role,
+                "text": self.displayed.text,
+                "static": static,
+                "excluded": excluded_from_history,
+            }
+        )
+
+    def update(self, content: str):
+        self.content = content
+        text = content.removesuffix(self.cursor)
+        displayed = self.displayed.text
+        if text == displayed:
+            return
+        if text.startswith(displayed):
+            frame = {"type": "delta", "text": text[len(displayed) :]}
+        else:
+            frame = {"type": "replace", "text": text}
+        self.stream.publish({**frame, "message": self.message})
+        self.displayed = StreamedText(text)
+
+    def append(self, text: str):
+        """send streamed text as a "delta" frame"""
+        if not text:
+            return
+        self.stream.publish({"type": "delta", "text": text, "message": self.message})
+        self.displayed.append(text)
+
+
+# endregion network presenter
@@ -0,0 +1,103 @@
+# purpose: look up the services that answer prompts, importing them on first use
+import importlib
+from chat.presenter import async_present_events, present_events
+
+
+class Provider:
+    """
+    interface for the services that answer prompts. stream_response and
+    async_stream_response take the conversation, the tool lookup, the excluded
+    flag and the prompt stats, add the response turns to the conversation and
+    yield the typed events from chat.events as the response streams. the
+    process methods show the same events with a presenter
+    """
+
+    def stream_response(self, conversation, tools, excluded=False, stats=None):
+        raise NotImplementedError
+
+    def async_stream_response(self, conversation, tools, excluded=False, stats=None):
+        """an async generator that yields the events as the response streams"""
+        raise NotImplementedError
+
+    def process_response(
+        self, conversation, tools, message_placeholder, excluded=False, stats=None
+    ):
+        present_events(
+            self.stream_response(conversation, tools, excluded, stats),
+            message_placeholder,
+        )
+        return conversation
+
+    def async_process_response(
+        self, conversation, tools, message_placeholder, excluded=False, stats=None
+    ):
+        """an async generator that yields the events after they are shown"""
+        return async_present_events(
+            self.async_stream_response(conversation, tools, excluded, stats),
+            message_placeholder,
+        )
+
+
+class ModuleProvider(Provider):
+    """a provider implemented by a pair of functions in a module, imported on first use"""
+
+    def __init__(self, module_name: str, stream_name: str, async_stream_name: str):
+        self.module_name = module_name
+        self.stream_name = stream_name
+        self.async_stream_name = async_stream_name
+
+    def load(self, name: str) -> callable:
+        module = importlib.import_module(self.module_name)
+        return getattr(module, name)
+
+    def stream_response(self, *args, **kwargs):
+        return self.load(self.stream_name)(*args, **kwargs)
+
+    def async_stream_response(self, *args, **kwargs):
+        return self.load(self.async_stream_name)(*args, **kwargs)
+
+
+# model -> provider
+providers = {
+    "openai": ModuleProvider(
+        "chat.openai",
+        "stream_openai_response",
+        "async_stream_openai_response",
+    ),
+    "gemini": ModuleProvider(
+        "chat.gemini",
+        "stream_gemini_response",
+        "async_stream_gemini_response",
+    ),
+}
+
+
+def register_provider(model: str, provider: Provider):
+    """
+    make a provider available to handle_prompt_request under the given model name
+
+    Args:
+        model (str): The name passed as `model` to prompt_handler.
+        provider (Provider): The provider that answers the prompts.
+    """
+    providers[model] = provider
+
+
+def get_provider(
+    model: str, asynchronous: bool = False, stream: bool = False
+) -> callable:
+    """
+    return the sync or async response processor of the provider for a model, or
+    with `stream` the function that yields the typed events without a presenter
+    """
+    if model not in providers:
+        raise ValueError(f"Unknown model: {model}")
+
+    provider = providers[model]
+    if stream:
+        return (
+            provider.async_stream_response if asynchronous else provider.stream_response
+        )
+    if asynchronous:
+        return provider.async_process_response
+    return provider.process_response
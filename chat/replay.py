@@ -0,0 +1,286 @@
+# purpose: answer prompts offline by replaying recorded provider event streams
+import re
+import json
+import time
+import asyncio
+from types import SimpleNamespace
+from chat.gemini import async_stream_gemini_response, stream_gemini_response
+from chat.openai import async_stream_openai_response, stream_openai_response
+from chat.providers import Provider
+
+# region recordings
+
+
+def split_deltas(text: str) -> list[str]:
+    """split text into word sized deltas, roughly one per token"""
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+def openai_recording(output: list[dict], usage: dict | None = None) -> list[dict]:
+    """
+    build the responses api event stream for a completed response
+
+    Args:
+        output (list[dict]): The output items of the response, the same shape as `response.output`.
+        usage (dict): The `input_tokens` and `output_tokens` of the response.
+    """
+
+    events = []
+    for idx, item in enumerate(output):
+
+        if item["type"] == "message":
+            events.append(
+                {
+                    "type": "response.output_item.added",
+                    "output_index": idx,
+                    "item": {**item, "content": []},
+                }
+            )
+            events.append(
+                {
+                    "type": "response.content_part.added",
+                    "output_index": idx,
+                    "part": {"type": "output_text", "text": ""},
+                }
+            )
+            text = " ".join(part["text"] for part in item["content"])
+            for delta in split_deltas(text):
+                events.append(
+                    {
+                        "type": "response.output_text.delta",
+                        "output_index": idx,
+                        "delta": delta,
+                    }
+                )
+
+        elif item["type"] == "function_call":
+            events.append(
+                {
+                    "type": "response.output_item.added",
+                    "output_index": idx,
+                    "item": {**item, "arguments": ""},
+                }
+            )
+            events.append(
+                {
+                    "type": "response.function_call_arguments.delta",
+                    "output_index": idx,
+                    "delta": item["arguments"],
+                }
+            )
+
+        else:
+            events.append(
+                {
+                    "type": "response.output_item.added",
+                    "output_index": idx,
+                    "item": item,
+                }
+            )
+
+    events.append(
+        {"type": "response.completed", "response": {"output": output, "usage": usage}}
+    )
+    return events
+
+
+def openai_text_recording(text: str, usage: dict | None = None) -> list[dict]:
+    """a responses api event stream that answers with text"""
+    message = {
+        "type": "message",
+        "role": "assistant",
+        "content": [{"type": "output_text", "text": text}],
+    }
+    return openai_recording([message], usage)
+
+
+def openai_tool_recording(calls: list[tuple], usage: dict | None = None) -> list[dict]:
+    """a responses api event stream that calls each (name, arguments) tool in order"""
+    output = [
+        {
+            "type": "function_call",
+            "call_id": f"call_{idx:03d}",
+            "name": name,
+            "arguments": json.dumps(arguments),
+        }
+        for idx, (name, arguments) in enumerate(calls)
+    ]
+    return openai_recording(output, usage)
+
+
+def gemini_recording(
+    text: str = "", function_calls: list[tuple] = None, usage: dict | None = None
+) -> list[dict]:
+    """
+    build the gemini event stream for a response
+
+    Args:
+        text (str): The text of the response, streamed as word sized chunks.
+        function_calls (list[tuple]): The (name, arguments) tool calls sent after the text.
+        usage (dict): The `prompt_token_count` and `candidates_token_count` of the response.
+    """
+
+    events = [{"text": delta, "function_calls": None} for delta in split_deltas(text)]
+    if function_calls:
+        events.append(
+            {
+                "text": None,
+                "function_calls": [
+                    {"name": name, "args": arguments}
+                    for name, arguments in function_calls
+                ],
+            }
+        )
+    if usage and events:
+        events[-1]["usage_metadata"] = usage
+    return events
+
+
+# values that the sdks hand over as plain dicts
+raw_keys = {"args"}
+
+
+def to_namespace(value):
+    """convert recorded dicts to objects with attribute access like the sdk types"""
+    if isinstance(value, dict):
+        return SimpleNamespace(
+            **{
+                key: val if key in raw_keys else to_namespace(val)
+                for key, val in value.items()
+            }
+        )
+    if isinstance(value, list):
+        return [to_namespace(val) for val in value]
+    return value
+
+
+# endregion recordings
+
+
+# region replay client
+
+
+class ReplayStream:
+    """
+    a recorded event stream that can be consumed with `for`, or awaited and
+    consumed with `async for` like the async sdk streams
+    """
+
+    def __init__(self, events: list[dict], interval: float = 0.0, latency: float = 0.0):
+        # the processors modify the events, so every replay gets fresh objects
+        self.events = to_namespace(events)
+        self.interval = interval
+        self.latency = latency
+
+    def __iter__(self):
+        time.sleep(self.latency)
+        for idx, event in enumerate(self.events):
+            if idx and self.interval:
+                time.sleep(self.interval)
+            yield event
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.latency)
+        for idx, event in enumerate(self.events):
+            if idx and self.interval:
+                await asyncio.sleep(self.interval)
+            yield event
+
+    def __await__(self):
+        return self
+        yield
+
+
+class ReplayClient:
+    """
+    stands in for the openai and gemini clients, every request is answered with
+    the next recording and the recordings repeat once they run out
+
+    Args:
+        recordings (list[list[dict]]): The event streams to answer with, in order.
+        tokens_per_second (float): How fast events are sent, None sends them as fast as possible.
+        latency_seconds (float): The delay before the first event of each stream.
+    """
+
+    def __init__(
+        self,
+        recordings: list[list[dict]],
+        tokens_per_second: float | None = None,
+        latency_seconds: float = 0.0,
+    ):
+        if not recordings:
+            raise ValueError("at least one recording is required")
+        self.recordings = recordings
+        self.interval = 1 / tokens_per_second if tokens_per_second else 0.0
+        self.latency = latency_seconds
+        self.requests = []
+
+        # openai: client.responses.create, gemini: client.models.generate_content_stream
+        # and client.aio.models.generate_content_stream
+        self.responses = self
+        self.models = self
+        self.aio = self
+
+    def create(self, **request) -> ReplayStream:
+        recording = self.recordings[len(self.requests) % len(self.recordings)]
+        self.requests.append(request)
+        return ReplayStream(recording, self.interval, self.latency)
+
+    generate_content_stream = create
+
+
+# endregion replay client
+
+
+# region replay provider
+
+
+class ReplayProvider(Provider):
+    """
+    a deterministic provider that runs the real openai or gemini response
+    processing against recorded event streams, so the whole prompt -> stream ->
+    tool -> presenter path can run without network access
+
+    Args:
+        recordings (list[list[dict]]): The event streams to answer with, in order.
+        gemini (bool): Whether the recordings are gemini streams instead of openai streams.
+        tokens_per_second (float): How fast events are sent, None sends them as fast as possible.
+        latency_seconds (float): The delay before the first event of each stream.
+    """
+
+    def __init__(
+        self,
+        recordings: list[list[dict]],
+        gemini: bool = False,
+        tokens_per_second: float | None = None,
+        latency_seconds: float = 0.0,
+    ):
+        self.gemini = gemini
+        self.client = ReplayClient(recordings, tokens_per_second, latency_seconds)
+
+    @classmethod
+    def load(cls, filepath: str, **kwargs) -> "ReplayProvider":
+        """create a provider from a json file with a list of recordings"""
+        with open(filepath, "r") as f:
+            return cls(json.load(f), **kwargs)
+
+    def stream_response(self, conversation, tools, excluded=False, stats=None):
+        stream_response = (
+            stream_gemini_response if self.gemini else stream_openai_response
+        )
+        return stream_response(
+            conversation, tools, excluded=excluded, stats=stats, client=self.client
+        )
+
+    def async_stream_response(self, conversation, tools, excluded=False, stats=None):
+        stream_response = (
+            async_stream_gemini_response
+            if self.gemini
+            else async_stream_openai_response
+        )
+        return stream_response(
+            conversation, tools, excluded=excluded, stats=stats, client=self.client
+        )
+
+
+# endregion replay provider
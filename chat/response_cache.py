@@ -0,0 +1,185 @@
+# purpose: answer repeated requests by replaying the response they got the first time
+import hashlib
+import logging
+from types import SimpleNamespace
+from chat.cache import DiskCache, TTLCache
+from chat.config import (
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_DIRECTORY,
+    RESPONSE_CACHE_EXCLUDED_ONLY,
+    RESPONSE_CACHE_MAX_SIZE,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+from chat.serialization import stable_dumps
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    stores the event stream of each response keyed on a hash of the provider and
+    the request, which holds the model name, the tool schemas and the api payload.
+    a hit is replayed through the regular stream processing, so the presenter, the
+    tools and the conversation see the same events as the first time
+
+    Args:
+        backend (TTLCache | DiskCache): Where the recorded streams are kept, anything with get and set works.
+        excluded_only (bool): Only cache prompts sent with history disabled.
+    """
+
+    def __init__(self, backend, excluded_only: bool = RESPONSE_CACHE_EXCLUDED_ONLY):
+        self.backend = backend
+        self.excluded_only = excluded_only
+
+    @staticmethod
+    def key(provider: str, request: dict) -> str:
+        # the order of the tools doesn't change the answer, so it shouldn't change the key
+        request = dict(request)
+        if "tools" in request:
+            request["tools"] = sort_tools(request["tools"])
+        if isinstance(request.get("config"), dict) and "tools" in request["config"]:
+            request["config"] = {
+                **request["config"],
+                "tools": sort_tools(request["config"]["tools"]),
+            }
+        key = stable_dumps([provider, request], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def cacheable(self, conversation) -> bool:
+        """whether the prompt being answered may be served from the cache"""
+        if not self.excluded_only:
+            return True
+        for message in reversed(conversation.messages):
+            if getattr(message, "role", None) == "user":
+                return bool(message.excluded)
+        return False
+
+    def open_stream(
+        self, provider, conversation, request, create, dump_event, stats=None
+    ):
+        """
+        the recorded stream for a request, or the stream `create` returns, recorded as it is consumed
+
+        Args:
+            provider (str): The provider module that handles the stream, part of the key.
+            conversation (ChatConversation): The conversation being answered.
+            request (dict): The keyword arguments for the api call.
+            create (callable): Calls the api and returns its stream.
+            dump_event (callable): Converts a stream event to a json serializable dict.
+            stats (PromptStats): Counts the round trips that were served from the cache.
+        """
+        if not self.cacheable(conversation):
+            return create()
+
+        key = self.key(provider, request)
+        events = self.lookup(key, stats)
+        if events is not None:
+            return replay_stream(events)
+        return self.record(key, create(), dump_event)
+
+    async def async_open_stream(
+        self, provider, conversation, request, create, dump_event, stats=None
+    ):
+        """async version of open_stream, `create` returns an awaitable stream"""
+        if not self.cacheable(conversation):
+            return await create()
+
+        key = self.key(provider, request)
+        events = self.lookup(key, stats)
+        if events is not None:
+            return replay_stream(events)
+        return self.async_record(key, await create(), dump_event)
+
+    def lookup(self, key: str, stats=None) -> list[dict] | None:
+        events = self.backend.get(key)
+        if events is not None:
+            logger.info(f"response_cache_hit: {key[:12]}")
+            if stats is not None:
+                stats.cached_round_trips += 1
+        return events
+
+    def record(self, key: str, stream, dump_event):
+        events = []
+        for event in stream:
+            events.append(dump_event(event))
+            yield event
+        # only complete streams are stored, an error or an early stop skips this
+        self.backend.set(key, events)
+
+    async def async_record(self, key: str, stream, dump_event):
+        events = []
+        async for event in stream:
+            events.append(dump_event(event))
+            yield event
+        self.backend.set(key, events)
+
+
+def dump_value(value):
+    """convert sdk objects and replayed events back to plain json values"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    if isinstance(value, SimpleNamespace):
+        return {key: dump_value(val) for key, val in vars(value).items()}
+    if isinstance(value, dict):
+        return {key: dump_value(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [dump_value(val) for val in value]
+    return value
+
+
+def sort_tools(tools: list) -> list:
+    return sorted(tools, key=lambda tool: stable_dumps(tool, sort_keys=True))
+
+
+def replay_stream(events: list[dict]):
+    # imported here, chat.replay imports the provider modules that use this one
+    from chat.replay import ReplayStream
+
+    return ReplayStream(events)
+
+
+def create_response_cache(kind: str | None = RESPONSE_CACHE) -> ResponseCache | None:
+    """the response cache described by the config, None when it is disabled"""
+    if kind is None:
+        return None
+    if kind == "memory":
+        backend = TTLCache(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+    elif kind == "disk":
+        backend = DiskCache(
+            RESPONSE_CACHE_DIRECTORY,
+            RESPONSE_CACHE_MAX_SIZE,
+            RESPONSE_CACHE_TTL_SECONDS,
+        )
+    else:
+        raise ValueError(f"Unknown response cache: {kind}")
+    return ResponseCache(backend)
+
+
+# the cache every prompt goes through, replace it with set_response_cache
+response_cache = create_response_cache()
+
+
+def set_response_cache(cache: ResponseCache | None):
+    """use a different response cache for every prompt, None disables it"""
+    global response_cache
+    response_cache = cache
+
+
+def open_stream(provider, conversation, request, create, dump_event, stats=None):
+    """the stream for a request, served from the response cache when it is enabled"""
+    if response_cache is None:
+        return create()
+    return response_cache.open_stream(
+        provider, conversation, request, create, dump_event, stats
+    )
+
+
+async def async_open_stream(
+    provider, conversation, request, create, dump_event, stats=None
+):
+    """async version of open_stream"""
+    if response_cache is None:
+        return await create()
+    return await response_cache.async_open_stream(
+        provider, conversation, request, create, dump_event, stats
+    )
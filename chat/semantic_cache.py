@@ -0,0 +1,290 @@
+# purpose: answer prompts that mean the same as an earlier one from a local vector index
+import re
+import math
+import hashlib
+import functools
+import logging
+import threading
+from array import array
+from chat.config import (
+    SEMANTIC_CACHE,
+    SEMANTIC_CACHE_EXCLUDED_ONLY,
+    SEMANTIC_CACHE_MAX_SIZE,
+    SEMANTIC_CACHE_THRESHOLD,
+)
+from chat.entities import ChatTurn
+
+logger = logging.getLogger(__name__)
+
+
+# region embedders
+
+
+class HashingEmbedder:
+    """
+    a small local embedder without a model, words and character trigrams are hashed
+    into a fixed number of dimensions. it matches rewordings that share most of their
+    words, plug in a sentence embedding model to match real paraphrases
+
+    Args:
+        dimensions (int): The size of the vectors.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def features(self, text: str) -> list[str]:
+        words = re.findall(r"\w+", text.lower())
+        trigrams = [
+            word[idx : idx + 3] for word in words for idx in range(len(word) - 2)
+        ]
+        return words + trigrams
+
+    def __call__(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        for feature in self.features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            # the lowest bit picks the sign, so unrelated features tend to cancel out
+            vector[(value >> 1) % self.dimensions] += 1.0 if value & 1 else -1.0
+        return vector
+
+
+# endregion embedders
+
+
+# region vector index
+
+
+@functools.cache
+def get_numpy():
+    """numpy if it is installed, imported on first use since it is slow to import"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class VectorIndex:
+    """
+    the embeddings of one partition with the value stored for each, searched by
+    cosine similarity. uses a numpy matrix when numpy is installed and plain python
+    arrays otherwise. once it is full the oldest entries are replaced
+
+    Args:
+        dimensions (int): The size of the vectors.
+        max_size (int): The number of entries kept.
+    """
+
+    def __init__(self, dimensions: int, max_size: int = SEMANTIC_CACHE_MAX_SIZE):
+        self.dimensions = dimensions
+        self.max_size = max_size
+        self.values = []
+        # position the next entry is written to once the index is full
+        self.next = 0
+        self.numpy = get_numpy()
+        if self.numpy is not None:
+            # rows are allocated ahead, doubling up to max_size
+            self.vectors = self.numpy.zeros(
+                (min(max_size, 64), dimensions), dtype=self.numpy.float32
+            )
+        else:
+            self.vectors = []
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def normalize(vector: list[float]) -> list[float]:
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else list(vector)
+
+    def add(self, vector: list[float], value):
+        vector = self.normalize(vector)
+        if len(self.values) < self.max_size:
+            idx = len(self.values)
+            self.values.append(value)
+        else:
+            idx = self.next
+            self.values[idx] = value
+            self.next = (self.next + 1) % self.max_size
+
+        if self.numpy is None:
+            if idx == len(self.vectors):
+                self.vectors.append(array("f", vector))
+            else:
+                self.vectors[idx] = array("f", vector)
+            return
+
+        if idx == len(self.vectors):
+            grown = self.numpy.zeros(
+                (min(self.max_size, 2 * len(self.vectors)), self.dimensions),
+                dtype=self.numpy.float32,
+            )
+            grown[:idx] = self.vectors
+            self.vectors = grown
+        self.vectors[idx] = vector
+
+    def search(self, vector: list[float]) -> tuple[float, object]:
+        """the similarity and value of the nearest entry, (0.0, None) if the index is empty"""
+        if not self.values:
+            return 0.0, None
+        vector = self.normalize(vector)
+
+        if self.numpy is not None:
+            query = self.numpy.asarray(vector, dtype=self.numpy.float32)
+            similarities = self.vectors[: len(self.values)] @ query
+            best = int(similarities.argmax())
+            return float(similarities[best]), self.values[best]
+
+        best, best_similarity = 0, -1.0
+        for idx, stored in enumerate(self.vectors):
+            similarity = sum(a * b for a, b in zip(stored, vector))
+            if similarity > best_similarity:
+                best, best_similarity = idx, similarity
+        return best_similarity, self.values[best]
+
+
+# endregion vector index
+
+
+# region semantic cache
+
+
+class SemanticCache:
+    """
+    serves the assistant turn of an earlier prompt when a new prompt's embedding
+    is close enough to it. prompts are partitioned by model and persona, the system
+    message, so personas never answer for each other
+
+    Args:
+        embedder (callable): Turns text into a vector, HashingEmbedder by default.
+        threshold (float): The cosine similarity a cached prompt needs to be served.
+        max_size (int): The number of prompts kept per partition.
+        excluded_only (bool): Only serve and store prompts sent with history disabled.
+    """
+
+    def __init__(
+        self,
+        embedder=None,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_size: int = SEMANTIC_CACHE_MAX_SIZE,
+        excluded_only: bool = SEMANTIC_CACHE_EXCLUDED_ONLY,
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.max_size = max_size
+        self.excluded_only = excluded_only
+        # partition -> VectorIndex
+        self.partitions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def partition(conversation, model: str) -> str:
+        """the model and the latest system message"""
+        persona = ""
+        for message in reversed(conversation.messages):
+            if getattr(message, "role", None) == "system":
+                persona = message.content
+                break
+        return hashlib.sha256(f"{model}\n{persona}".encode("utf-8")).hexdigest()
+
+    def prompt(self, conversation) -> ChatTurn | None:
+        """the user turn being answered, None if this prompt can't use the cache"""
+        if not conversation.messages:
+            return None
+        last_message = conversation.messages[-1]
+        if getattr(last_message, "role", None) != "user":
+            return None
+        if self.excluded_only and not last_message.excluded:
+            return None
+        return last_message
+
+    def lookup(self, conversation, model: str, stats=None) -> ChatTurn | None:
+        """
+        the cached assistant turn for the conversation's latest prompt, None on a miss
+
+        Args:
+            conversation (ChatConversation): The conversation, ending with the user turn.
+            model (str): The provider that would answer, part of the partition.
+            stats (PromptStats): Records whether the lookup was a hit and its similarity.
+        """
+        prompt = self.prompt(conversation)
+        if prompt is None:
+            return None
+
+        vector = self.embedder(prompt.content)
+        with self.lock:
+            index = self.partitions.get(self.partition(conversation, model))
+            similarity, content = index.search(vector) if index else (0.0, None)
+            hit = content is not None and similarity >= self.threshold
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if stats is not None:
+            stats.semantic_cache = "hit" if hit else "miss"
+            stats.semantic_similarity = similarity
+        if not hit:
+            return None
+        logger.info(f"semantic_cache_hit: {similarity:.3f} for '{prompt.content}'")
+        return ChatTurn(role="assistant", content=content, excluded=prompt.excluded)
+
+    def store(self, conversation, model: str, prompt: ChatTurn):
+        """
+        remember the answer to a prompt that was answered without tools, tool outputs
+        can change so those answers aren't reused
+
+        Args:
+            conversation (ChatConversation): The conversation, ending with the answer.
+            model (str): The provider that answered.
+            prompt (ChatTurn): The user turn that was answered.
+        """
+        answer = conversation.messages[-1]
+        if conversation.messages[-2] is not prompt:
+            return
+        if getattr(answer, "role", None) != "assistant":
+            return
+
+        vector = self.embedder(prompt.content)
+        partition = self.partition(conversation, model)
+        with self.lock:
+            if partition not in self.partitions:
+                self.partitions[partition] = VectorIndex(len(vector), self.max_size)
+            self.partitions[partition].add(vector, answer.content)
+
+    def clear(self):
+        with self.lock:
+            self.partitions = {}
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": sum(len(index) for index in self.partitions.values()),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# the cache handle_prompt_request checks, replace it with set_semantic_cache
+semantic_cache = SemanticCache() if SEMANTIC_CACHE else None
+
+
+def set_semantic_cache(cache: SemanticCache | None):
+    """use a different semantic cache for every prompt, None disables it"""
+    global semantic_cache
+    semantic_cache = cache
+
+
+def get_semantic_cache() -> SemanticCache | None:
+    return semantic_cache
+
+
+# endregion semantic cache
@@ -0,0 +1,66 @@
+# purpose: json encoding for storage and api payloads, using orjson when it is installed
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "orjson" or "json", both write the same compact json
+backend = "orjson" if orjson is not None else "json"
+
+
+def set_backend(name: str):
+    """
+    choose the json library, mostly useful to compare them
+
+    Args:
+        name (str): "orjson" or "json".
+    """
+    global backend
+    if name == "orjson" and orjson is None:
+        raise ValueError("orjson is not installed, pip install orjson")
+    if name not in ["orjson", "json"]:
+        raise ValueError(f"Unknown json backend: {name}")
+    backend = name
+
+
+def dumpb(value, sort_keys: bool = False, indent: bool = False) -> bytes:
+    """encode a value as utf-8 json, values json can't represent are converted with str()"""
+    if backend == "orjson":
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(value, default=str, option=option)
+    return dumps(value, sort_keys, indent).encode("utf-8")
+
+
+def dumps(value, sort_keys: bool = False, indent: bool = False) -> str:
+    """encode a value as json text, values json can't represent are converted with str()"""
+    if backend == "orjson":
+        return dumpb(value, sort_keys, indent).decode("utf-8")
+    return json.dumps(
+        value,
+        ensure_ascii=False,
+        default=str,
+        sort_keys=sort_keys,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":"),
+    )
+
+
+def loads(data: str | bytes):
+    if backend == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def stable_dumps(value, sort_keys: bool = False) -> str:
+    """
+    encode a value with the stdlib json defaults, for text that is sent to a provider
+    or hashed. it is the same whether orjson is installed or not, so request bytes
+    and cache keys match across environments
+    """
+    return json.dumps(value, default=str, sort_keys=sort_keys)
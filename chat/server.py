@@ -0,0 +1,526 @@
+# purpose: serve many conversations from one process over http, sse and websockets
+import time
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from uuid import uuid4
+from chat.chat import async_prompt_handler
+from chat.config import (
+    SERVER_MAX_CONCURRENT_PROMPTS,
+    SERVER_MAX_QUEUED_FRAMES,
+    SERVER_MAX_SESSIONS,
+    SERVER_MAX_WAITING_PROMPTS,
+    configure_logging,
+)
+from chat.entities import ChatConversation, ChatTurn
+from chat.presenter import FrameQueue, FrameStream, NetworkContentPresenter
+from chat.serialization import dumpb, dumps, loads
+from chat.stats import PromptStats
+
+logger = logging.getLogger(__name__)
+
+
+class ServerError(Exception):
+    """an error that is sent to the client with its http status"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# region sessions
+
+
+class Session:
+    """a conversation hosted by the server, only one prompt runs in it at a time"""
+
+    def __init__(self, session_id: str, conversation: ChatConversation):
+        self.session_id = session_id
+        self.conversation = conversation
+        self.busy = False
+        self.last_used = time.monotonic()
+        # the frames of the latest prompt, clients that reconnect resume from them
+        self.stream = None
+
+
+class SessionManager:
+    """
+    holds the conversations served by the process. once there are more than
+    `max_sessions`, the least recently used idle sessions are dropped from memory.
+    with a store, idle sessions are checked against it before they are used, so
+    several processes can serve the same sessions. the database is only accessed
+    from worker threads, it never blocks the event loop
+
+    Args:
+        system_prompt (str): The system message new sessions start with.
+        store (SqliteStore): Persists every session so dropped sessions can be loaded
+            again, by this or another process. None keeps sessions in memory only.
+        max_sessions (int): The number of sessions kept in memory.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str = "you are a helpful assistant",
+        store=None,
+        max_sessions: int = SERVER_MAX_SESSIONS,
+    ):
+        self.system_prompt = system_prompt
+        self.store = store
+        self.max_sessions = max_sessions
+        # session_id -> Session, ordered from least to most recently used
+        self.sessions = OrderedDict()
+
+    async def create(self, system_prompt: str | None = None) -> Session:
+        session_id = uuid4().hex
+        journal = self.journal(session_id) if self.store else None
+        conversation = ChatConversation(
+            [ChatTurn(role="system", content=system_prompt or self.system_prompt)],
+            journal=journal,
+        )
+        await asyncio.to_thread(conversation.flush)
+        return self.add(Session(session_id, conversation))
+
+    async def get(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if self.store is not None and (session is None or not session.busy):
+            session = await self.refresh(session_id, session)
+        if session is None:
+            raise ServerError(404, f"Unknown session: {session_id}")
+
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def journal(self, session_id: str):
+        # the turns are only written when a prompt is done, async_stream_prompt
+        # flushes them from a worker thread
+        return self.store.journal(session_id, flush_every=None)
+
+    async def refresh(self, session_id: str, session: Session | None) -> Session | None:
+        """
+        the session as it is stored. when another process answered prompts in it
+        since it was cached here, its conversation is loaded again
+        """
+        count = await asyncio.to_thread(self.store.count, session_id)
+        if session is not None:
+            journal = session.conversation.journal
+            if session.busy or (not journal.stale and journal.count == count):
+                return session
+        if not count:
+            return session
+
+        conversation = await asyncio.to_thread(self.journal(session_id).load)
+        # other requests may have loaded the session or started a prompt in it while
+        # this one waited. there is only ever one Session per id, so its busy check
+        # keeps protecting the conversation
+        current = self.sessions.get(session_id)
+        if current is None:
+            return self.add(Session(session_id, conversation))
+        journal = current.conversation.journal
+        if not current.busy and (
+            journal.stale or journal.count < conversation.journal.count
+        ):
+            current.conversation = conversation
+        return current
+
+    def add(self, session: Session) -> Session:
+        self.sessions[session.session_id] = session
+        self.evict()
+        return session
+
+    def remove(self, session_id: str):
+        self.sessions.pop(session_id, None)
+
+    def evict(self):
+        """drop the least recently used sessions that aren't answering a prompt"""
+        excess = len(self.sessions) - self.max_sessions
+        if excess <= 0:
+            return
+        for session_id in [
+            session.session_id for session in self.sessions.values() if not session.busy
+        ][:excess]:
+            del self.sessions[session_id]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+# endregion sessions
+
+
+# region backpressure
+
+
+class ProviderLimiter:
+    """
+    bounds the prompts sent to one provider at a time. prompts beyond the limit
+    wait, and once `max_waiting` are waiting new prompts are turned away
+
+    Args:
+        max_concurrent (int): The prompts that run at the same time.
+        max_waiting (int): The prompts that may wait for a slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = SERVER_MAX_CONCURRENT_PROMPTS,
+        max_waiting: int = SERVER_MAX_WAITING_PROMPTS,
+    ):
+        self.capacity = max_concurrent + max_waiting
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # prompts that are running or waiting
+        self.reserved = 0
+
+    def reserve(self):
+        """claim a place in line, called before the response starts so a 503 can still be sent"""
+        if self.reserved >= self.capacity:
+            raise ServerError(503, "too many prompts are waiting, try again later")
+        self.reserved += 1
+
+    async def acquire(self):
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.reserved -= 1
+            raise
+
+    def release(self):
+        self.semaphore.release()
+        self.reserved -= 1
+
+
+# endregion backpressure
+
+
+# region asgi app
+
+
+class ChatServer:
+    """
+    an asgi app that hosts many conversations on top of async_prompt_handler, run
+    it with any asgi server, like `uvicorn chat.server:app`
+
+    routes:
+        POST /sessions: create a session, the body may set "system"
+        GET /sessions/{id}: the turns of a session
+        DELETE /sessions/{id}: drop a session from memory
+        POST /sessions/{id}/prompts: answer {"prompt", "excluded", "model"} as server-sent events
+        GET /sessions/{id}/events: resume the latest prompt after the Last-Event-ID header or ?after=
+        WEBSOCKET /sessions/{id}/ws: answer every prompt message with a stream of frames,
+            {"after": seq} resumes the latest prompt
+
+    Args:
+        tools (dict): The tools every session can call.
+        sessions (SessionManager): The sessions, a new in-memory manager by default.
+        model (str): The provider used when a prompt doesn't name one.
+        max_concurrent (int): Prompts sent to each provider at the same time.
+        max_waiting (int): Prompts waiting for each provider before new ones get a 503.
+        max_frames (int): Frames waiting for a slow client before its deltas are merged.
+    """
+
+    def __init__(
+        self,
+        tools: dict = None,
+        sessions: SessionManager = None,
+        model: str = "openai",
+        max_concurrent: int = SERVER_MAX_CONCURRENT_PROMPTS,
+        max_waiting: int = SERVER_MAX_WAITING_PROMPTS,
+        max_frames: int = SERVER_MAX_QUEUED_FRAMES,
+    ):
+        self.tools = tools or {}
+        self.max_frames = max_frames
+        # an empty manager is falsy, it has a length
+        self.sessions = sessions if sessions is not None else SessionManager()
+        self.model = model
+        self.limiters = {}
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        # prompts keep running when their client disconnects, so the history stays complete
+        self.tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.handle_websocket(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+
+    def limiter(self, model: str) -> ProviderLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = ProviderLimiter(
+                self.max_concurrent, self.max_waiting
+            )
+        return self.limiters[model]
+
+    # region prompts
+
+    def start_prompt(self, session: Session, request: dict) -> FrameQueue:
+        """
+        check the prompt can run and start it in the background
+
+        Returns:
+            FrameQueue: The frames to send to the client, ending with "done" or "error".
+        """
+        prompt = request.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise ServerError(400, "the prompt is missing")
+        model = request.get("model") or self.model
+        if session.busy:
+            raise ServerError(409, "a prompt is already running in this session")
+
+        limiter = self.limiter(model)
+        limiter.reserve()
+        session.busy = True
+        session.stream = FrameStream()
+        queue = session.stream.subscribe(max_frames=self.max_frames)
+
+        task = asyncio.create_task(
+            self.run_prompt(
+                session, prompt, bool(request.get("excluded")), model, limiter
+            )
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return queue
+
+    def resume(self, session: Session, after: int) -> FrameQueue:
+        """the frames of the session's latest prompt after sequence number `after`"""
+        if session.stream is None:
+            raise ServerError(404, "this session hasn't answered a prompt yet")
+        return session.stream.subscribe(after, max_frames=self.max_frames)
+
+    async def run_prompt(self, session, prompt, excluded, model, limiter):
+        stream = session.stream
+        stats = PromptStats()
+        try:
+            await limiter.acquire()
+            try:
+                async for _ in async_prompt_handler(
+                    prompt,
+                    session.conversation,
+                    self.tools,
+                    excluded,
+                    functools.partial(NetworkContentPresenter, stream=stream),
+                    model,
+                    stats=stats,
+                ):
+                    pass
+            finally:
+                limiter.release()
+            stream.publish(
+                {
+                    "type": "done",
+                    "stop_reason": stats.stop_reason,
+                    "round_trips": stats.round_trips,
+                    "elapsed_seconds": stats.elapsed_seconds,
+                }
+            )
+        except Exception as e:
+            logger.exception(f"server_prompt_failed: {session.session_id}")
+            stream.publish({"type": "error", "message": str(e)})
+        finally:
+            stream.close()
+            session.busy = False
+            session.last_used = time.monotonic()
+
+    # endregion prompts
+
+    # region http
+
+    async def handle_http(self, scope, receive, send):
+        try:
+            await self.route(scope, receive, send)
+        except ServerError as e:
+            await self.send_json(send, e.status, {"error": e.message})
+        except Exception as e:
+            logger.exception(f"server_error: {scope['method']} {scope['path']}")
+            await self.send_json(send, 500, {"error": str(e)})
+
+    async def route(self, scope, receive, send):
+        method = scope["method"]
+        parts = scope["path"].strip("/").split("/")
+
+        if parts == ["health"] and method == "GET":
+            await self.send_json(send, 200, {"sessions": len(self.sessions)})
+
+        elif parts == ["sessions"] and method == "POST":
+            body = await self.read_json(receive)
+            session = await self.sessions.create(body.get("system"))
+            await self.send_json(send, 201, {"session_id": session.session_id})
+
+        elif len(parts) == 2 and parts[0] == "sessions" and method == "GET":
+            session = await self.sessions.get(parts[1])
+            await self.send_json(send, 200, {"messages": session.conversation.asdict()})
+
+        elif len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+            self.sessions.remove(parts[1])
+            await self.send_json(send, 200, {})
+
+        elif len(parts) == 3 and parts[::2] == ["sessions", "prompts"]:
+            if method != "POST":
+                raise ServerError(405, f"Method not allowed: {method}")
+            session = await self.sessions.get(parts[1])
+            queue = self.start_prompt(session, await self.read_json(receive))
+            await self.send_events(send, queue)
+
+        elif len(parts) == 3 and parts[::2] == ["sessions", "events"]:
+            if method != "GET":
+                raise ServerError(405, f"Method not allowed: {method}")
+            session = await self.sessions.get(parts[1])
+            await self.send_events(
+                send, self.resume(session, self.last_event_id(scope))
+            )
+
+        else:
+            raise ServerError(404, f"Not found: {method} {scope['path']}")
+
+    @staticmethod
+    def last_event_id(scope) -> int:
+        """the sequence number the client received last, from the header or the query"""
+        headers = dict(scope.get("headers") or [])
+        value = headers.get(b"last-event-id", b"").decode("latin-1")
+        if not value:
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            value = query.get("after", ["0"])[0]
+        try:
+            return max(0, int(value))
+        except ValueError:
+            raise ServerError(400, f"Invalid event id: {value}")
+
+    @staticmethod
+    async def read_json(receive) -> dict:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        if not body:
+            return {}
+        try:
+            data = loads(body)
+        except ValueError:
+            raise ServerError(400, "the body is not valid json")
+        if not isinstance(data, dict):
+            raise ServerError(400, "the body must be a json object")
+        return data
+
+    @staticmethod
+    async def send_json(send, status: int, data: dict):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": dumpb(data)})
+
+    async def send_events(self, send, queue: FrameQueue):
+        """stream frames as server-sent events, the sequence number is the event id"""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache"),
+                ],
+            }
+        )
+        try:
+            async for frame in queue:
+                event = f"id: {frame['seq']}\nevent: {frame['type']}\ndata: {dumps(frame)}\n\n"
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": event.encode("utf-8"),
+                        "more_body": True,
+                    }
+                )
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            # the client went away, the prompt still finishes in the background
+            logger.info("server_client_disconnected")
+
+    # endregion http
+
+    # region websocket
+
+    async def handle_websocket(self, scope, receive, send):
+        parts = scope["path"].strip("/").split("/")
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        try:
+            if len(parts) != 3 or parts[0] != "sessions" or parts[2] != "ws":
+                raise ServerError(404, f"Not found: {scope['path']}")
+            session = await self.sessions.get(parts[1])
+        except ServerError:
+            await send({"type": "websocket.close", "code": 4404})
+            return
+        await send({"type": "websocket.accept"})
+
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            try:
+                # another process may have answered prompts in the session meanwhile
+                session = await self.sessions.get(session.session_id)
+                request = loads(message.get("text") or message.get("bytes") or b"{}")
+                if "after" in request:
+                    queue = self.resume(session, int(request["after"]))
+                else:
+                    queue = self.start_prompt(session, request)
+            except (ServerError, ValueError, TypeError) as e:
+                status = getattr(e, "status", 400)
+                await self.send_frame(
+                    send, {"type": "error", "status": status, "message": str(e)}
+                )
+                continue
+            try:
+                async for frame in queue:
+                    await self.send_frame(send, frame)
+            except OSError:
+                # the client went away, the prompt still finishes in the background
+                logger.info("server_client_disconnected")
+                return
+
+    @staticmethod
+    async def send_frame(send, frame: dict):
+        await send({"type": "websocket.send", "text": dumps(frame)})
+
+    # endregion websocket
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # the asgi server has set up its logging by now, it keeps its handlers
+                configure_logging()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # let the running prompts finish so their turns are stored
+                if self.tasks:
+                    await asyncio.gather(*self.tasks, return_exceptions=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+# endregion asgi app
+
+
+# an app without tools for `uvicorn chat.server:app`, create your own ChatServer to add them
+app = ChatServer()
+
+
+if __name__ == "__main__":
+
+    import uvicorn
+
+    uvicorn.run("chat.server:app", host="127.0.0.1", port=8000)
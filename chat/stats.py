@@ -0,0 +1,170 @@
+# purpose: limits, counters and timings for a single prompt across its tool round trips
+import time
+import logging
+from bisect import bisect_left
+from pydantic import BaseModel, Field, PrivateAttr
+from chat.config import (
+    MAX_TOOL_ROUND_TRIPS,
+    PROMPT_TIMEOUT_SECONDS,
+    PROMPT_TOKEN_BUDGET,
+)
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the inter-delta gap histogram buckets, the last bucket is unbounded
+DELTA_GAP_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000]
+
+# called with (event_name, stats, data) for every prompt, see add_prompt_hook
+prompt_hooks = []
+
+
+def add_prompt_hook(hook: callable):
+    """
+    call a function for the instrumentation events of every prompt
+
+    hooks are called with the event name, the PromptStats and a dict of event data.
+    the events are "request" before each api call, "first_event" and "first_text"
+    when the first stream event and the first text delta arrive, "tool" after each
+    tool call and "finish" when the tool loop stops. "tool" can be called from a
+    worker thread
+    """
+    prompt_hooks.append(hook)
+
+
+def remove_prompt_hook(hook: callable):
+    prompt_hooks.remove(hook)
+
+
+class ToolTiming(BaseModel):
+    name: str
+    call_id: str
+    seconds: float
+    cached: bool = False
+    timed_out: bool = False
+
+
+class PromptLimits(BaseModel):
+    """bounds on the tool loop, None disables a limit"""
+
+    max_round_trips: int | None = MAX_TOOL_ROUND_TRIPS
+    timeout_seconds: float | None = PROMPT_TIMEOUT_SECONDS
+    token_budget: int | None = PROMPT_TOKEN_BUDGET
+
+
+class PromptStats(BaseModel):
+    """what a prompt cost and why the tool loop stopped"""
+
+    round_trips: int = 0
+    # round trips answered from the response cache instead of the provider
+    cached_round_trips: int = 0
+    # "hit" or "miss" when the semantic cache was checked, and the best similarity it found
+    semantic_cache: str | None = None
+    semantic_similarity: float | None = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    started_at: float = Field(default_factory=time.monotonic)
+    elapsed_seconds: float = 0.0
+    # "completed", "max_round_trips", "timeout" or "token_budget"
+    stop_reason: str | None = None
+    model: str | None = None
+
+    # seconds from the start of the prompt
+    first_event_seconds: float | None = None
+    first_text_seconds: float | None = None
+    # counts of the gaps between text deltas, one more bucket than DELTA_GAP_BUCKETS_MS
+    delta_count: int = 0
+    delta_gap_counts: list[int] = Field(
+        default_factory=lambda: [0] * (len(DELTA_GAP_BUCKETS_MS) + 1)
+    )
+    delta_gap_total_seconds: float = 0.0
+    max_delta_gap_seconds: float = 0.0
+    # json size of the conversation sent with each api call
+    request_bytes: list[int] = Field(default_factory=list)
+    tool_timings: list[ToolTiming] = Field(default_factory=list)
+
+    # hooks for this prompt only, called before the global prompt_hooks
+    hooks: list = Field(default_factory=list, exclude=True)
+    _last_delta_at: float | None = PrivateAttr(default=None)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def record_usage(self, input_tokens: int | None, output_tokens: int | None):
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+
+    def exceeded_limit(self, limits: PromptLimits) -> str | None:
+        """returns the name of the first limit the prompt has reached"""
+        self.elapsed_seconds = time.monotonic() - self.started_at
+        if limits.max_round_trips and self.round_trips >= limits.max_round_trips:
+            return "max_round_trips"
+        if limits.timeout_seconds and self.elapsed_seconds >= limits.timeout_seconds:
+            return "timeout"
+        if limits.token_budget and self.total_tokens >= limits.token_budget:
+            return "token_budget"
+        return None
+
+    @property
+    def tool_seconds(self) -> float:
+        return sum(timing.seconds for timing in self.tool_timings)
+
+    def emit(self, event_name: str, **data):
+        """call the hooks, a failing hook is logged instead of breaking the prompt"""
+        for hook in self.hooks + prompt_hooks:
+            try:
+                hook(event_name, self, data)
+            except Exception as e:
+                logger.warning(f"prompt_hook_failed: '{event_name}' {e}")
+
+    def record_request(self, payload_bytes: int):
+        """record the size of the conversation sent with an api call"""
+        self.request_bytes.append(payload_bytes)
+        # the gap while the tools ran is not a gap between deltas
+        self._last_delta_at = None
+        self.emit("request", round_trip=self.round_trips, payload_bytes=payload_bytes)
+
+    def record_event(self, text: bool = False):
+        """
+        record a stream event as it arrives
+
+        Args:
+            text (bool): Whether the event is a text delta shown to the user.
+        """
+        now = time.monotonic()
+        if self.first_event_seconds is None:
+            self.first_event_seconds = now - self.started_at
+            self.emit("first_event", seconds=self.first_event_seconds)
+
+        if not text:
+            return
+
+        self.delta_count += 1
+        if self.first_text_seconds is None:
+            self.first_text_seconds = now - self.started_at
+            self.emit("first_text", seconds=self.first_text_seconds)
+
+        if self._last_delta_at is not None:
+            gap = now - self._last_delta_at
+            self.delta_gap_counts[bisect_left(DELTA_GAP_BUCKETS_MS, gap * 1000)] += 1
+            self.delta_gap_total_seconds += gap
+            self.max_delta_gap_seconds = max(self.max_delta_gap_seconds, gap)
+        self._last_delta_at = now
+
+    def record_tool(
+        self, name: str, call_id: str, seconds: float, cached=False, timed_out=False
+    ):
+        timing = ToolTiming(
+            name=name,
+            call_id=call_id,
+            seconds=seconds,
+            cached=cached,
+            timed_out=timed_out,
+        )
+        self.tool_timings.append(timing)
+        self.emit("tool", timing=timing)
+
+    def finish(self, stop_reason: str):
+        self.stop_reason = stop_reason
+        self.elapsed_seconds = time.monotonic() - self.started_at
+        self.emit("finish")
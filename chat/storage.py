@@ -0,0 +1,582 @@
+# purpose: persist conversations as an append-only json lines journal or in sqlite
+import os
+import time
+import sqlite3
+import itertools
+import threading
+from bisect import bisect_left
+from chat.config import (
+    JOURNAL_FSYNC_EVERY_TURNS,
+    JOURNAL_FSYNC_SECONDS,
+    SQLITE_BUSY_TIMEOUT_SECONDS,
+    SQLITE_FLUSH_EVERY_TURNS,
+)
+from chat.entities import ChatConversation
+from chat.serialization import dumpb, loads
+
+# bytes read at a time when reading the journal backwards
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+class JournalStore:
+    """
+    stores the turns of a conversation as one json line each, so saving after every
+    turn only writes the new turns. writes are flushed right away and fsynced in
+    batches. removing turns from the conversation rewrites the journal. an index
+    file next to the journal keeps its line count and where its system messages
+    are, so opening the journal and tail loads only read the lines after the index
+
+    Args:
+        filepath (str): The journal file, created on the first write.
+        fsync_every (int): Fsync after this many turns, None leaves it to the os.
+        fsync_seconds (float): Fsync when this many seconds passed since the last one.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        fsync_every: int | None = JOURNAL_FSYNC_EVERY_TURNS,
+        fsync_seconds: float | None = JOURNAL_FSYNC_SECONDS,
+    ):
+        self.filepath = filepath
+        self.index_filepath = f"{filepath}.index"
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        # number of turns and bytes in the file, and [turn, offset] of its system messages
+        self.count = 0
+        self.size = 0
+        self.systems = []
+        # whether the index is behind the file, it is written with the next fsync
+        self.index_stale = False
+        self.read_index()
+        # a tail load keeps the first `head` turns, then continues from turn `base`
+        self.head = 0
+        self.base = 0
+        self.file = None
+        self.unsynced = 0
+        self.last_fsync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_index(self):
+        """
+        the line count, size and system messages of the journal, read from the index
+        and the lines written after it. the whole journal is only read when there is
+        no index or it doesn't match the journal
+        """
+        if not os.path.exists(self.filepath):
+            return
+        try:
+            with open(self.index_filepath, "rb") as f:
+                index = loads(f.read())
+            count, size, systems = index["count"], index["size"], index["systems"]
+        except (OSError, ValueError, KeyError, TypeError):
+            count, size, systems = 0, 0, []
+        if size > os.path.getsize(self.filepath):
+            count, size, systems = 0, 0, []
+
+        indexed = size
+        with open(self.filepath, "rb") as f:
+            f.seek(size)
+            for line in f:
+                # a line without its newline was cut off by a crash
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    if self.is_system(line):
+                        systems.append([count, size])
+                    count += 1
+                size += len(line)
+
+        self.count, self.size, self.systems = count, size, systems
+        self.index_stale = size != indexed
+
+    def write_index(self):
+        temp_filepath = f"{self.index_filepath}.tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(
+                dumpb({"count": self.count, "size": self.size, "systems": self.systems})
+            )
+        # the index isn't fsynced, one that is behind is caught up from the journal
+        os.replace(temp_filepath, self.index_filepath)
+        self.index_stale = False
+
+    @staticmethod
+    def is_system(line: bytes) -> bool:
+        # only the lines that can be a system message are decoded
+        return b'"system"' in line and loads(line).get("role") == "system"
+
+    # region writing
+
+    def sync(self, messages: list):
+        """write the turns the journal hasn't seen yet, or rewrite it if turns were removed"""
+        written = self.head + self.count - self.base
+        if len(messages) < written:
+            self.compact(messages)
+        elif len(messages) > written:
+            self.append(messages[written:])
+
+    def append(self, turns: list):
+        lines = [self.encode(turn) for turn in turns]
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filepath, "ab")
+            self.file.write(b"".join(lines))
+            # hand the lines to the os right away, the fsync can wait for the batch
+            self.file.flush()
+            for line in lines:
+                if self.is_system(line):
+                    self.systems.append([self.count, self.size])
+                self.count += 1
+                self.size += len(line)
+            self.index_stale = True
+            self.unsynced += len(turns)
+            if self.fsync_due():
+                self.fsync()
+
+    def fsync_due(self) -> bool:
+        if self.fsync_every is not None and self.unsynced >= self.fsync_every:
+            return True
+        if self.fsync_seconds is not None:
+            return time.monotonic() - self.last_fsync >= self.fsync_seconds
+        return False
+
+    def fsync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        if self.index_stale:
+            self.write_index()
+        self.unsynced = 0
+        self.last_fsync = time.monotonic()
+
+    def flush(self):
+        """fsync the turns written so far, called when a prompt is done"""
+        with self.lock:
+            self.fsync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.fsync()
+                self.file.close()
+                self.file = None
+
+    def compact(self, messages: list):
+        """
+        rewrite the journal with the current turns, call this after modifying turns
+        in place. turns that weren't loaded by a tail load are kept. sync compacts
+        when turns were removed, appends never leave stale lines, so there is
+        nothing to compact on a schedule
+        """
+        temp_filepath = f"{self.filepath}.tmp"
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+            count, size, systems = 0, 0, []
+            with open(temp_filepath, "wb") as f:
+                # the turns between the head and the tail were never loaded
+                lines = itertools.islice(self.iter_lines(), self.base)
+                encoded = (self.encode(turn) for turn in messages[self.head :])
+                for line in itertools.chain(lines, encoded):
+                    f.write(line)
+                    if self.is_system(line):
+                        systems.append([count, size])
+                    count += 1
+                    size += len(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # replace the journal in one step, a crash leaves either the old or the new file
+            os.replace(temp_filepath, self.filepath)
+            self.count, self.size, self.systems = count, size, systems
+            self.write_index()
+            self.unsynced = 0
+
+    @staticmethod
+    def encode(turn) -> bytes:
+        data = turn if isinstance(turn, dict) else turn.model_dump()
+        return dumpb(data) + b"\n"
+
+    # endregion writing
+
+    # region reading
+
+    def iter_lines(self):
+        if not os.path.exists(self.filepath):
+            return
+        with open(self.filepath, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+    def iter_turns(self):
+        """stream the turns as dicts from the start of the journal"""
+        for line in self.iter_lines():
+            yield loads(line)
+
+    def read_tail(self, turns: int) -> list[dict]:
+        """
+        read at least the last `turns` turns without reading the whole journal, the
+        tail is extended back to a user message so every cycle is complete
+        """
+        lines = []
+        with open(self.filepath, "rb") as f:
+            position = f.seek(0, os.SEEK_END)
+            remainder = b""
+            while position > 0:
+                size = min(TAIL_BLOCK_SIZE, position)
+                position -= size
+                f.seek(position)
+                parts = (f.read(size) + remainder).split(b"\n")
+                # the first part may be the end of a line from the previous block
+                remainder = parts[0]
+                for line in reversed(parts[1:]):
+                    if not line.strip():
+                        continue
+                    turn = loads(line)
+                    lines.append(turn)
+                    if len(lines) >= turns and turn.get("role") == "user":
+                        return lines[::-1]
+            if remainder.strip():
+                lines.append(loads(remainder))
+        return lines[::-1]
+
+    def latest_system_turn(self, end: int) -> dict | None:
+        """the last system message before turn `end`, the persona the tail continues with"""
+        idx = bisect_left(self.systems, end, key=lambda system: system[0])
+        if idx == 0:
+            return None
+        with open(self.filepath, "rb") as f:
+            f.seek(self.systems[idx - 1][1])
+            return loads(f.readline())
+
+    def load(self, tail: int | None = None, compact: bool = False) -> ChatConversation:
+        """
+        create a conversation from the journal that appends its new turns to it
+
+        Args:
+            tail (int): Only load the last `tail` turns, plus the latest system message
+                before them. None loads every turn.
+            compact (bool): Store the turns as CompactTurns.
+        """
+
+        conversation = ChatConversation(compact=compact)
+        self.head = 0
+        self.base = 0
+
+        if tail is None:
+            turns = list(self.iter_turns())
+        elif self.count == 0:
+            turns = []
+        else:
+            turns = self.read_tail(tail)
+            self.base = self.count - len(turns)
+            system = self.latest_system_turn(self.base)
+            if system is not None:
+                turns.insert(0, system)
+                self.head = 1
+
+        if turns:
+            conversation.load(data=turns)
+        conversation.journal = self
+        return conversation
+
+    # endregion reading
+
+
+# region sqlite
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    data BLOB NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+) WITHOUT ROWID
+"""
+
+
+class SqliteStore:
+    """
+    stores many conversations in one sqlite database, one row per turn keyed by the
+    conversation id and the turn's position. the database runs in wal mode, so
+    several processes can serve the same sessions while others read them
+
+    Args:
+        filepath (str): The database file, created if it doesn't exist.
+        busy_timeout (float): Seconds a write waits for another process to finish its own.
+    """
+
+    def __init__(
+        self,
+        filepath: str = "conversations.db",
+        busy_timeout: float = SQLITE_BUSY_TIMEOUT_SECONDS,
+    ):
+        self.filepath = filepath
+        # transactions are opened explicitly, so sqlite3 shouldn't open its own
+        self.connection = sqlite3.connect(
+            filepath,
+            timeout=busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # with wal, commits are durable against crashes of the process, not the os
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SQLITE_SCHEMA)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def journal(
+        self, conversation_id: str, flush_every: int | None = SQLITE_FLUSH_EVERY_TURNS
+    ) -> "SqliteJournal":
+        """the journal for one conversation, pass it to ChatConversation as `journal`"""
+        return SqliteJournal(self, conversation_id, flush_every)
+
+    def load(
+        self, conversation_id: str, tail: int | None = None, compact: bool = False
+    ) -> ChatConversation:
+        """load a conversation that writes its new turns back to the database"""
+        return self.journal(conversation_id).load(tail, compact)
+
+    def conversation_ids(self) -> list[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT conversation_id FROM turns ORDER BY conversation_id"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, conversation_id: str) -> int:
+        """the number of turns stored for a conversation"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(seq) FROM turns WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def write(self, conversation_id: str, rows: list[tuple], replace_from: int = None):
+        """
+        insert (seq, role, data) rows in one transaction
+
+        Args:
+            conversation_id (str): The conversation the rows belong to.
+            rows (list[tuple]): The rows to insert.
+            replace_from (int): Delete the turns from this position on first.
+        """
+        with self.lock:
+            # take the write lock up front instead of upgrading a read transaction
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if replace_from is not None:
+                    self.connection.execute(
+                        "DELETE FROM turns WHERE conversation_id = ? AND seq >= ?",
+                        (conversation_id, replace_from),
+                    )
+                self.connection.executemany(
+                    "INSERT INTO turns (conversation_id, seq, role, data) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, *row) for row in rows],
+                )
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def window_start(self, conversation_id: str, tail: int) -> int:
+        """
+        the position of the last user turn that leaves at least `tail` turns after it,
+        so the window starts with a complete cycle
+        """
+        count = self.count(conversation_id)
+        with self.lock:
+            # walks the primary key backwards from the bound until it finds a user turn
+            row = self.connection.execute(
+                "SELECT seq FROM turns WHERE conversation_id = ? AND seq <= ? AND role = 'user' "
+                "ORDER BY seq DESC LIMIT 1",
+                (conversation_id, count - tail),
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def latest_system_turn(self, conversation_id: str, end: int) -> dict | None:
+        """the last system message before position `end`, the persona a window continues with"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM turns WHERE conversation_id = ? AND seq < ? AND role = 'system' "
+                "ORDER BY seq DESC LIMIT 1",
+                (conversation_id, end),
+            ).fetchone()
+        return None if row is None else loads(row[0])
+
+    def read(self, conversation_id: str, start: int = 0, end: int = None) -> list[dict]:
+        """the turns from position `start` up to `end` as dicts"""
+        query = "SELECT data FROM turns WHERE conversation_id = ? AND seq >= ?"
+        params = [conversation_id, start]
+        if end is not None:
+            query += " AND seq < ?"
+            params.append(end)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY seq", params).fetchall()
+        return [loads(row[0]) for row in rows]
+
+
+class SqliteJournal:
+    """
+    appends the turns of one conversation to a SqliteStore. new turns are held until
+    the prompt is done and then inserted in one transaction, removing turns rewrites
+    the conversation's rows in one transaction. one process should write to a
+    conversation at a time. when another writer took the positions, the insert
+    fails, the waiting turns are dropped and the journal stops writing until the
+    conversation is loaded again
+
+    Args:
+        store (SqliteStore): The database.
+        conversation_id (str): The conversation the turns belong to.
+        flush_every (int): Insert once this many turns are waiting, None waits for the prompt to finish.
+    """
+
+    def __init__(
+        self,
+        store: SqliteStore,
+        conversation_id: str,
+        flush_every: int | None = SQLITE_FLUSH_EVERY_TURNS,
+    ):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.flush_every = flush_every
+        # number of turns in the database
+        self.count = store.count(conversation_id)
+        # a tail load keeps the first `head` turns, then continues from turn `base`
+        self.head = 0
+        self.base = 0
+        # (seq, role, data) rows waiting for the next flush
+        self.pending = []
+        # set when another writer changed the conversation, nothing is written until it is loaded again
+        self.stale = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # region writing
+
+    def sync(self, messages: list):
+        """queue the turns the database hasn't seen yet, or rewrite them if turns were removed"""
+        with self.lock:
+            if self.stale:
+                return
+            written = self.head + self.count + len(self.pending) - self.base
+            if len(messages) < written:
+                self.pending = []
+                self.compact(messages)
+                return
+            for turn in messages[written:]:
+                self.pending.append(
+                    (self.count + len(self.pending), *self.encode(turn))
+                )
+            if self.flush_every is not None and len(self.pending) >= self.flush_every:
+                self.write_pending()
+
+    def flush(self):
+        """insert the waiting turns in one transaction, called when a prompt is done"""
+        with self.lock:
+            self.write_pending()
+
+    def write_pending(self):
+        if self.stale:
+            raise sqlite3.IntegrityError(
+                f"conversation '{self.conversation_id}' was changed by another writer, "
+                "load it again to continue"
+            )
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            self.store.write(self.conversation_id, rows)
+        except sqlite3.IntegrityError:
+            # another writer took these positions. the rows aren't retried with the same
+            # positions on every flush, the conversation has to be loaded again instead
+            self.stale = True
+            raise
+        self.count += len(rows)
+
+    def close(self):
+        self.flush()
+
+    def compact(self, messages: list):
+        """
+        rewrite the conversation with the current turns, call this after modifying
+        turns in place. turns that weren't loaded by a tail load are kept
+        """
+        rows = [
+            (self.base + idx, *self.encode(turn))
+            for idx, turn in enumerate(messages[self.head :])
+        ]
+        self.store.write(self.conversation_id, rows, replace_from=self.base)
+        self.count = self.base + len(rows)
+
+    @staticmethod
+    def encode(turn) -> tuple[str | None, bytes]:
+        data = turn if isinstance(turn, dict) else turn.model_dump()
+        return data.get("role") or data.get("type"), dumpb(data)
+
+    # endregion writing
+
+    # region reading
+
+    def load(self, tail: int | None = None, compact: bool = False) -> ChatConversation:
+        """
+        create a conversation from the database that adds its new turns to it
+
+        Args:
+            tail (int): Only load the last `tail` turns, extended back to the start of
+                their cycle, plus the latest system message before them. None loads
+                every turn.
+            compact (bool): Store the turns as CompactTurns.
+        """
+
+        conversation = ChatConversation(compact=compact)
+        self.count = self.store.count(self.conversation_id)
+        self.pending = []
+        self.stale = False
+        self.head = 0
+        self.base = 0
+
+        if tail is not None and self.count > tail:
+            self.base = self.store.window_start(self.conversation_id, tail)
+
+        turns = self.store.read(self.conversation_id, self.base)
+        if self.base > 0:
+            system = self.store.latest_system_turn(self.conversation_id, self.base)
+            if system is not None:
+                turns.insert(0, system)
+                self.head = 1
+
+        if turns:
+            conversation.load(data=turns)
+        conversation.journal = self
+        return conversation
+
+    # endregion reading
+
+
+# endregion sqlite
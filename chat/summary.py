@@ -0,0 +1,146 @@
+# purpose: summarize the older cycles of a long conversation in the background
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from chat.config import SUMMARY_KEEP_CYCLES, SUMMARY_TRIGGER_TOKENS
+from chat.entities import ChatConversation, ChatTurn, ConversationSummary
+from chat.providers import get_provider
+from chat.serialization import stable_dumps
+
+logger = logging.getLogger(__name__)
+
+# one summary at a time, they are never on the latency critical path
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+
+SUMMARY_INSTRUCTIONS = (
+    "summarize the conversation below for your own future reference. keep every fact, "
+    "name, number, decision and open question that could matter later, drop small "
+    "talk. answer with the summary only"
+)
+
+
+def format_transcript(messages: list[dict]) -> str:
+    """turn openai formatted messages into plain text for the summary prompt"""
+
+    lines = []
+    for message in messages:
+        if message.get("role"):
+            lines.append(f"{message['role']}: {message['content']}")
+        elif message.get("type") == "function_call":
+            lines.append(f"tool call: {message['name']}({message['arguments']})")
+        elif message.get("type") == "function_call_output":
+            lines.append(f"tool output: {message['output']}")
+        else:
+            lines.append(stable_dumps(message))
+    return "\n".join(lines)
+
+
+def summary_request(
+    conversation: ChatConversation,
+    trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+    keep_cycles: int = SUMMARY_KEEP_CYCLES,
+) -> tuple[str, int] | None:
+    """
+    decide whether the conversation needs a new summary
+
+    Args:
+        conversation (ChatConversation): The conversation to summarize.
+        trigger_tokens (int): Summarize once the cycles that aren't summarized reach this many estimated tokens.
+        keep_cycles (int): The number of recent cycles that are never summarized.
+
+    Returns:
+        tuple[str, int] | None: The summary prompt and the turn the summary will end at, None if no summary is needed.
+    """
+
+    if trigger_tokens is None:
+        return None
+
+    summary = conversation.summary
+    through = summary.through if summary else 0
+    cycles = conversation.payload_builder().unsummarized_cycles(through)
+
+    if len(cycles) <= keep_cycles:
+        return None
+    if sum(tokens for _, _, tokens in cycles) < trigger_tokens:
+        return None
+
+    # summarize everything except the most recent cycles, the new summary builds on the last one
+    summarized = cycles[: len(cycles) - keep_cycles]
+    through = cycles[len(summarized)][0]
+    sections = []
+    if summary:
+        sections.append(f"summary of the conversation so far:\n{summary.text}")
+    sections.append(
+        format_transcript(
+            [message for _, messages, _ in summarized for message in messages]
+        )
+    )
+    return "\n\n".join(sections), through
+
+
+def summarize(prompt: str, model: str = "openai") -> str:
+    """ask the provider for a summary, this is a regular api call without tools"""
+
+    summary_conversation = ChatConversation(
+        [
+            ChatTurn(role="system", content=SUMMARY_INSTRUCTIONS),
+            ChatTurn(role="user", content=prompt),
+        ]
+    )
+    # nobody sees the summary being written, so the events are only drained
+    stream_response = get_provider(model, stream=True)
+    for _ in stream_response(summary_conversation, {}):
+        pass
+
+    last_message = summary_conversation.messages[-1]
+    if getattr(last_message, "role", None) != "assistant":
+        raise ValueError("the summary request did not return any text")
+    return last_message.content
+
+
+def schedule_summary(
+    conversation: ChatConversation,
+    model: str = "openai",
+    trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+    keep_cycles: int = SUMMARY_KEEP_CYCLES,
+) -> Future | None:
+    """
+    summarize the older cycles in a background thread if the history is long enough,
+    the summary replaces them in the api payload once it is ready
+
+    Args:
+        conversation (ChatConversation): The conversation to summarize.
+        model (str): The provider that writes the summary.
+        trigger_tokens (int): Summarize once the cycles that aren't summarized reach this many estimated tokens.
+        keep_cycles (int): The number of recent cycles that are never summarized.
+
+    Returns:
+        Future | None: Resolves to the new ConversationSummary, None if no summary was needed.
+    """
+
+    # only one summary per conversation at a time
+    pending = conversation._summary_future
+    if pending is not None and not pending.done():
+        return None
+
+    # the payload builder isn't thread safe, so the prompt is prepared on the caller's thread
+    request = summary_request(conversation, trigger_tokens, keep_cycles)
+    if request is None:
+        return None
+    prompt, through = request
+
+    def run() -> ConversationSummary:
+        try:
+            text = summarize(prompt, model)
+        except Exception as e:
+            logger.warning(f"summary_failed: {e}")
+            raise
+        summary = ConversationSummary(text=text, through=through)
+        current = conversation.summary
+        # a single assignment, requests read either the old or the new summary
+        if current is None or current.through < through:
+            conversation.summary = summary
+            logger.info(f"summary: through turn {through}, '{text}'")
+        return summary
+
+    conversation._summary_future = summary_executor.submit(run)
+    return conversation._summary_future
@@ -0,0 +1,23 @@
+# purpose: fast local token estimates for trimming the context sent to the api
+from chat.serialization import dumpb
+
+# a rough average for english text with the openai and gemini tokenizers
+CHARS_PER_TOKEN = 4
+# role, separators and other framing the api adds to every message
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """estimate the number of tokens in text without loading a tokenizer"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """estimate the tokens of a formatted api message, including its framing"""
+    return estimate_size_tokens(len(dumpb(message)))
+
+
+def estimate_size_tokens(size: int) -> int:
+    """estimate the tokens of a formatted api message from its encoded size"""
+    # the utf-8 size is close enough to the character count for an estimate
+    return TOKENS_PER_MESSAGE + -(-size // CHARS_PER_TOKEN)
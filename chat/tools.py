@@ -1,17 +1,36 @@
 # purpose: generate tool schemas for api services
 import re
+import time
+import asyncio
 import inspect
 import logging
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from chat.cache import TTLCache
+from chat.config import (
+    CACHE_TOOLS_BY_DEFAULT,
+    PARALLEL_TOOL_CALLS,
+    TOOL_CACHE_MAX_SIZE,
+    TOOL_CACHE_TTL_SECONDS,
+    TOOL_MAX_WORKERS,
+    TOOL_TIMEOUT_SECONDS,
+)
 from chat.entities import ToolCallTurn, ToolOutputTurn
+from chat.serialization import stable_dumps
 
 logger = logging.getLogger(__name__)
 
+# shared between conversations so concurrent tool calls are bounded
+tool_executor = ThreadPoolExecutor(
+    max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool"
+)
+
 
 # region function calling
 
 
 def tool_call_handler(
-    tool_call_turn: ToolCallTurn, tools: dict[str, callable]
+    tool_call_turn: ToolCallTurn, tools: dict[str, callable], stats=None
 ) -> ToolOutputTurn:
     """
     handles a tool call by dynamically invoking the appropriate tool function
@@ -20,30 +39,260 @@ def tool_call_handler(
     Args:
         tool_call_turn (ToolCallTurn): The tool call turn containing the tool name and arguments.
         tools (dict[str, callable]): A mapping from tool names to callable functions.
+        stats (PromptStats): Records how long the tool took.
 
     Returns:
         ToolOutputTurn: The result of the tool call.
     """
+    tool_output_turn, elapsed, cached = run_tool_call(tool_call_turn, tools)
+    record_tool_time(stats, tool_call_turn, elapsed, cached)
+    return tool_output_turn
+
+
+def run_tool_call(
+    tool_call_turn: ToolCallTurn, tools: dict[str, callable]
+) -> tuple[ToolOutputTurn, float, bool]:
+    """runs a tool call, returns its output, how long it took and whether it came from the cache"""
     logger.info(
         f"tool_call: '{tool_call_turn.name}' with args: '{tool_call_turn.arguments}'"
     )
 
+    started_at = time.monotonic()
+    cached = False
     tool_name = tool_call_turn.name
-    tool_args = tool_call_turn.arguments
+    tool_func = tools.get(tool_name)
+    if tool_func:
+        cache_key = tool_cache_key(tool_func, tool_call_turn)
+        tool_result = get_cached_tool_result(cache_key)
+        cached = tool_result is not _missing
+        if not cached:
+            try:
+                if inspect.iscoroutinefunction(tool_func):
+                    tool_result = asyncio.run(
+                        call_tool(tool_func, tool_call_turn.arguments)
+                    )
+                else:
+                    tool_result = call_tool(tool_func, tool_call_turn.arguments)
+                set_cached_tool_result(cache_key, tool_func, tool_result)
+            except Exception as e:
+                tool_result = f"error executing tool '{tool_name}': {e}"
+    else:
+        tool_result = f"tool not recognized: '{tool_name}'"
+
+    elapsed = time.monotonic() - started_at
+    return create_tool_output_turn(tool_call_turn, tool_result), elapsed, cached
+
+
+async def async_tool_call_handler(
+    tool_call_turn: ToolCallTurn, tools: dict[str, callable], stats=None
+) -> ToolOutputTurn:
+    """
+    async version of tool_call_handler, awaits `async def` tools and runs
+    regular tools in a worker thread so the event loop is never blocked
 
+    Args:
+        tool_call_turn (ToolCallTurn): The tool call turn containing the tool name and arguments.
+        tools (dict[str, callable]): A mapping from tool names to callable functions.
+        stats (PromptStats): Records how long the tool took.
+
+    Returns:
+        ToolOutputTurn: The result of the tool call.
+    """
+    logger.info(
+        f"tool_call: '{tool_call_turn.name}' with args: '{tool_call_turn.arguments}'"
+    )
+
+    started_at = time.monotonic()
+    cached = False
+    tool_name = tool_call_turn.name
     tool_func = tools.get(tool_name)
     if tool_func:
-        try:
-            # if tool_args is a dict, unpack as kwargs
-            if isinstance(tool_args, dict):
-                tool_result = tool_func(**tool_args)
-            else:
-                tool_result = tool_func(tool_args)
-        except Exception as e:
-            tool_result = f"error executing tool '{tool_name}': {e}"
+        cache_key = tool_cache_key(tool_func, tool_call_turn)
+        tool_result = get_cached_tool_result(cache_key)
+        cached = tool_result is not _missing
+        if not cached:
+            try:
+                if inspect.iscoroutinefunction(tool_func):
+                    tool_result = await call_tool(tool_func, tool_call_turn.arguments)
+                else:
+                    tool_result = await asyncio.get_running_loop().run_in_executor(
+                        tool_executor, call_tool, tool_func, tool_call_turn.arguments
+                    )
+                set_cached_tool_result(cache_key, tool_func, tool_result)
+            except Exception as e:
+                tool_result = f"error executing tool '{tool_name}': {e}"
     else:
         tool_result = f"tool not recognized: '{tool_name}'"
 
+    record_tool_time(stats, tool_call_turn, time.monotonic() - started_at, cached)
+    return create_tool_output_turn(tool_call_turn, tool_result)
+
+
+def tool_calls_handler(
+    tool_call_turns: list[ToolCallTurn],
+    tools: dict[str, callable],
+    parallel: bool = PARALLEL_TOOL_CALLS,
+    stats=None,
+) -> list[ToolCallTurn | ToolOutputTurn]:
+    """
+    runs a batch of tool calls and returns each call followed by its output
+
+    Args:
+        tool_call_turns (list[ToolCallTurn]): The tool calls from a single model turn.
+        tools (dict[str, callable]): A mapping from tool names to callable functions.
+        parallel (bool): Run the tools concurrently in the shared thread pool.
+        stats (PromptStats): Records how long each tool took.
+
+    Returns:
+        list[ToolCallTurn | ToolOutputTurn]: The calls and outputs in the order they were requested.
+    """
+    if parallel:
+        tool_output_turns = wait_for_tools(tool_call_turns, tools, stats)
+    else:
+        tool_output_turns = [
+            tool_call_handler(tool_call_turn, tools, stats)
+            for tool_call_turn in tool_call_turns
+        ]
+
+    return interleave_tool_turns(tool_call_turns, tool_output_turns)
+
+
+async def async_tool_calls_handler(
+    tool_call_turns: list[ToolCallTurn],
+    tools: dict[str, callable],
+    parallel: bool = PARALLEL_TOOL_CALLS,
+    stats=None,
+) -> list[ToolCallTurn | ToolOutputTurn]:
+    """async version of tool_calls_handler, parallel calls are gathered on the event loop"""
+    if parallel:
+        tool_output_turns = await asyncio.gather(
+            *[
+                async_wait_for_tool(tool_call_turn, tools, stats)
+                for tool_call_turn in tool_call_turns
+            ]
+        )
+    else:
+        tool_output_turns = [
+            await async_wait_for_tool(tool_call_turn, tools, stats)
+            for tool_call_turn in tool_call_turns
+        ]
+
+    return interleave_tool_turns(tool_call_turns, tool_output_turns)
+
+
+def wait_for_tools(
+    tool_call_turns: list[ToolCallTurn], tools, stats=None
+) -> list[ToolOutputTurn]:
+    """
+    runs the tool calls in the shared thread pool. every call's timeout is measured
+    from when the batch was submitted, so a slow tool can't extend the time the
+    tools after it get. the timings are recorded here, once per call
+    """
+    submitted_at = time.monotonic()
+    futures = [
+        tool_executor.submit(run_tool_call, tool_call_turn, tools)
+        for tool_call_turn in tool_call_turns
+    ]
+    timeouts = [
+        get_tool_timeout(tools.get(tool_call_turn.name))
+        for tool_call_turn in tool_call_turns
+    ]
+    deadlines = {
+        future: submitted_at + timeout
+        for future, timeout in zip(futures, timeouts)
+        if timeout is not None
+    }
+
+    pending = set(futures)
+    while pending:
+        # wait until a tool finishes or the next deadline of a running tool passes
+        waiting = [deadlines[future] for future in pending if future in deadlines]
+        timeout = max(0, min(waiting) - time.monotonic()) if waiting else None
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            now = time.monotonic()
+            pending = {
+                future for future in pending if deadlines.get(future, now + 1) > now
+            }
+
+    tool_output_turns = []
+    for future, tool_call_turn, timeout in zip(futures, tool_call_turns, timeouts):
+        if future.done():
+            tool_output_turn, elapsed, cached = future.result()
+            record_tool_time(stats, tool_call_turn, elapsed, cached)
+            tool_output_turns.append(tool_output_turn)
+        else:
+            # the worker thread can't be interrupted, but we stop waiting on it
+            future.cancel()
+            record_tool_timeout(stats, tool_call_turn, timeout)
+            tool_output_turns.append(create_tool_timeout_turn(tool_call_turn, timeout))
+    return tool_output_turns
+
+
+async def async_wait_for_tool(
+    tool_call_turn: ToolCallTurn, tools, stats=None
+) -> ToolOutputTurn:
+    timeout = get_tool_timeout(tools.get(tool_call_turn.name))
+    try:
+        return await asyncio.wait_for(
+            async_tool_call_handler(tool_call_turn, tools, stats), timeout
+        )
+    except asyncio.TimeoutError:
+        record_tool_timeout(stats, tool_call_turn, timeout)
+        return create_tool_timeout_turn(tool_call_turn, timeout)
+
+
+def record_tool_time(stats, tool_call_turn: ToolCallTurn, elapsed, cached=False):
+    if stats is not None:
+        stats.record_tool(
+            tool_call_turn.name, tool_call_turn.call_id, elapsed, cached=cached
+        )
+
+
+def record_tool_timeout(stats, tool_call_turn: ToolCallTurn, timeout):
+    if stats is not None:
+        stats.record_tool(
+            tool_call_turn.name, tool_call_turn.call_id, timeout, timed_out=True
+        )
+
+
+def interleave_tool_turns(tool_call_turns, tool_output_turns) -> list:
+    turns = []
+    for tool_call_turn, tool_output_turn in zip(tool_call_turns, tool_output_turns):
+        turns.append(tool_call_turn)
+        turns.append(tool_output_turn)
+    return turns
+
+
+def tool_timeout(seconds: float | None):
+    """
+    decorator that overrides TOOL_TIMEOUT_SECONDS for a single tool
+
+    Args:
+        seconds (float | None): Seconds to wait for the tool, None waits forever.
+    """
+
+    def decorator(func):
+        func.tool_timeout = seconds
+        return func
+
+    return decorator
+
+
+def get_tool_timeout(tool_func) -> float | None:
+    return getattr(tool_func, "tool_timeout", TOOL_TIMEOUT_SECONDS)
+
+
+def call_tool(tool_func: callable, tool_args):
+    # if tool_args is a dict, unpack as kwargs
+    if isinstance(tool_args, dict):
+        return tool_func(**tool_args)
+    return tool_func(tool_args)
+
+
+def create_tool_output_turn(
+    tool_call_turn: ToolCallTurn, tool_result
+) -> ToolOutputTurn:
     tool_output_turn = ToolOutputTurn(
         call_id=tool_call_turn.call_id,
         output=tool_result,
@@ -56,9 +305,78 @@ def tool_call_handler(
     return tool_output_turn
 
 
+def create_tool_timeout_turn(tool_call_turn: ToolCallTurn, timeout) -> ToolOutputTurn:
+    logger.warning(f"tool_timeout: '{tool_call_turn.name}' after {timeout}s")
+    return create_tool_output_turn(
+        tool_call_turn, f"tool '{tool_call_turn.name}' timed out after {timeout}s"
+    )
+
+
 # endregion function calling
 
 
+# region tool result cache
+
+
+# sentinel for cache misses, tools are allowed to return None
+_missing = object()
+
+# shared by every conversation so repeated calls across users are served from memory
+tool_result_cache = TTLCache(max_size=TOOL_CACHE_MAX_SIZE)
+
+
+def cacheable(func: callable = None, *, ttl: float = TOOL_CACHE_TTL_SECONDS):
+    """
+    decorator that marks a read only tool as safe to cache
+
+    Args:
+        func (callable): The tool function, when used without arguments.
+        ttl (float): Seconds a cached result stays valid.
+    """
+
+    def decorator(func):
+        func.cache_ttl = ttl
+        return func
+
+    return decorator(func) if func else decorator
+
+
+def not_cacheable(func: callable) -> callable:
+    """decorator that keeps a tool out of the cache, even when CACHE_TOOLS_BY_DEFAULT is set"""
+    func.cache_ttl = None
+    return func
+
+
+def get_tool_cache_ttl(tool_func) -> float | None:
+    default_ttl = TOOL_CACHE_TTL_SECONDS if CACHE_TOOLS_BY_DEFAULT else None
+    return getattr(tool_func, "cache_ttl", default_ttl)
+
+
+def tool_cache_key(tool_func, tool_call_turn: ToolCallTurn) -> tuple | None:
+    """key a call on the tool name and its canonicalized arguments, None if the tool isn't cacheable"""
+    if not get_tool_cache_ttl(tool_func):
+        return None
+    arguments = stable_dumps(tool_call_turn.arguments, sort_keys=True)
+    return (tool_call_turn.name, arguments)
+
+
+def get_cached_tool_result(cache_key):
+    if cache_key is None:
+        return _missing
+    tool_result = tool_result_cache.get(cache_key, _missing)
+    if tool_result is not _missing:
+        logger.info(f"tool_cache_hit: '{cache_key[0]}' with args: '{cache_key[1]}'")
+    return tool_result
+
+
+def set_cached_tool_result(cache_key, tool_func, tool_result):
+    if cache_key is not None:
+        tool_result_cache.set(cache_key, tool_result, ttl=get_tool_cache_ttl(tool_func))
+
+
+# endregion tool result cache
+
+
 # region parser
 
 
@@ -134,6 +452,55 @@ def generate_tool_schema(func: callable) -> dict[str, any]:
 # endregion tool schema generation
 
 
+# region tool schema registry
+
+
+# provider name -> schema generator
+schema_generators = {
+    "openai": generate_tool_schema_openai,
+    "gemini": generate_tool_schema_gemini,
+}
+
+# function -> (fingerprint, {provider: schema}), entries go away with the function
+_tool_schema_cache = weakref.WeakKeyDictionary()
+
+
+def get_tool_schemas(tools: dict[str, callable], provider: str) -> list[dict]:
+    """
+    returns the provider schemas for every tool, each schema is generated once
+    per function and reused on later calls
+
+    Args:
+        tools (dict[str, callable]): A mapping from tool names to callable functions.
+        provider (str): The provider the schemas are for, "openai" or "gemini".
+
+    Returns:
+        list[dict]: The tool schemas, these are shared so they must not be modified.
+    """
+    return [get_tool_schema(func, provider) for func in tools.values()]
+
+
+def get_tool_schema(func: callable, provider: str) -> dict:
+    # a new function object, new code or a new docstring all produce a new schema
+    fingerprint = (getattr(func, "__code__", None), func.__doc__, func.__name__)
+    try:
+        cached_fingerprint, schemas = _tool_schema_cache.get(func, (None, None))
+    except TypeError:
+        # functions that can't be weakly referenced are generated every time
+        return schema_generators[provider](func)
+
+    if cached_fingerprint != fingerprint:
+        schemas = {}
+        _tool_schema_cache[func] = (fingerprint, schemas)
+
+    if provider not in schemas:
+        schemas[provider] = schema_generators[provider](func)
+    return schemas[provider]
+
+
+# endregion tool schema registry
+
+
 if __name__ == "__main__":
 
     def get_current_weather(city: str):
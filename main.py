@@ -1,9 +1,11 @@
 import logging
 from pathlib import Path
 from chat.chat import prompt_handler
+from chat.config import configure_logging
 from chat.entities import ChatConversation
 from chat.presenter import TerminalContentPresenter
 
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
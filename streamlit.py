@@ -1,10 +1,13 @@
 # pip install streamlit
 import datetime
 from chat.chat import prompt_handler
+from chat.config import configure_logging
 from chat.presenter import ContentPresenter
 import streamlit as st
 from chat.entities import ChatConversation, ChatTurn
 
+configure_logging()
+
 # streamlit run streamlit.py
 # streamlit run streamlit.py --server.fileWatcherType none
 today_str = datetime.datetime.today().strftime("%Y-%m-%d")
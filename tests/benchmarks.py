@@ -0,0 +1,623 @@
+# purpose: rough performance checks for the hot paths in the chat pipeline
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from chat.events import FinalTurn, TextDelta
+from chat.presenter import (
+    BufferedContentPresenter,
+    ContentPresenter,
+    TerminalContentPresenter,
+    present_events,
+)
+from chat.replay import ReplayProvider, gemini_recording, openai_text_recording
+from chat.storage import JournalStore, SqliteStore
+from chat import serialization
+from chat.tools import generate_tool_schema_openai, get_tool_schemas
+from chat.entities import (
+    ApiPayloadBuilder,
+    ChatConversation,
+    ChatTurn,
+    ToolCallTurn,
+    ToolOutputTurn,
+)
+
+# region helpers
+
+
+def build_cycle(idx: int, excluded=False) -> list:
+    """a single user -> tool call -> tool output -> assistant cycle"""
+    call_id = f"call_{idx:06d}"
+    return [
+        ChatTurn(
+            role="user", content=f"what is the price of stock {idx}", excluded=excluded
+        ),
+        ToolCallTurn(
+            call_id=call_id,
+            name="get_stock_price",
+            arguments={"symbol": f"S{idx}"},
+        ),
+        ToolOutputTurn(call_id=call_id, output={"symbol": f"S{idx}", "price": 150.0}),
+        ChatTurn(
+            role="assistant",
+            content=f"stock {idx} is trading at 150",
+            excluded=excluded,
+        ),
+    ]
+
+
+def build_conversation(turn_count: int, compact=False) -> ChatConversation:
+    conversation = ChatConversation(
+        [{"role": "system", "content": "you are a helpful assistant"}],
+        compact=compact,
+    )
+    idx = 0
+    while len(conversation.messages) < turn_count:
+        conversation.add(build_cycle(idx, excluded=idx % 3 == 0))
+        idx += 1
+    return conversation
+
+
+def build_tools(tool_count: int) -> dict:
+    """a tool lookup dictionary with tool_count distinct documented functions"""
+
+    def make_tool(idx):
+        def tool(symbol: str, quantity: int):
+            return {"symbol": symbol, "quantity": quantity}
+
+        tool.__name__ = f"tool_{idx:03d}"
+        tool.__doc__ = f"""look up record {idx}
+
+        Args:
+            symbol (str): The stock symbol
+            quantity (int): How many shares
+        """
+        return tool
+
+    return {f"tool_{idx:03d}": make_tool(idx) for idx in range(tool_count)}
+
+
+def build_text(word_count: int) -> str:
+    return " ".join(f"word{idx % 100}" for idx in range(word_count))
+
+
+class CountingWriter(io.TextIOBase):
+    """a stdout replacement that only counts what would have been written"""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, text: str) -> int:
+        self.bytes_written += len(text.encode())
+        return len(text)
+
+
+# endregion helpers
+
+
+# region benchmarks
+
+
+def bench_to_api_format(
+    sizes=(1_000, 10_000), rounds=50, gemini=False, token_budget=8_000
+):
+    """
+    time to add one cycle and build the next request, cached vs rebuilt from scratch
+    vs cached and trimmed to a token budget
+    """
+
+    results = []
+    for size in sizes:
+        conversation = build_conversation(size)
+        # warm the cache so we only measure the incremental cost
+        conversation.to_api_format(gemini=gemini)
+
+        start = time.perf_counter()
+        for idx in range(rounds):
+            conversation.add(build_cycle(size + idx))
+            conversation.to_api_format(gemini=gemini)
+        cached = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            builder = ApiPayloadBuilder(gemini=gemini)
+            builder.extend(conversation.messages)
+            builder.build()
+        uncached = (time.perf_counter() - start) / rounds
+
+        # trimmed to a context window, the cycle token estimates are cached after the first call
+        conversation.to_api_format(gemini=gemini, token_budget=token_budget)
+        start = time.perf_counter()
+        for idx in range(rounds):
+            conversation.add(build_cycle(size + rounds + idx))
+            conversation.to_api_format(gemini=gemini, token_budget=token_budget)
+        budgeted = (time.perf_counter() - start) / rounds
+
+        results.append(
+            {
+                "turns": size,
+                "cached_ms": cached * 1000,
+                "uncached_ms": uncached * 1000,
+                "budgeted_ms": budgeted * 1000,
+            }
+        )
+    return results
+
+
+def bench_tool_schemas(tool_counts=(10, 30, 100), rounds=200):
+    """time to build the tool schemas for one request, cached vs generated every time"""
+
+    results = []
+    for tool_count in tool_counts:
+        tools = build_tools(tool_count)
+        # warm the cache so we only measure lookups
+        get_tool_schemas(tools, "openai")
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            get_tool_schemas(tools, "openai")
+        cached = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            [generate_tool_schema_openai(tool) for tool in tools.values()]
+        uncached = (time.perf_counter() - start) / rounds
+
+        results.append(
+            {
+                "tools": tool_count,
+                "cached_ms": cached * 1000,
+                "uncached_ms": uncached * 1000,
+            }
+        )
+    return results
+
+
+def bench_turn_storage(turn_count=10_000, rounds=5):
+    """memory and serialization cost of pydantic turns vs compact slotted turns"""
+
+    results = []
+    for compact in [False, True]:
+        # the pydantic turns are thrown away after add() in compact mode
+        tracemalloc.start()
+        conversation = ChatConversation(compact=compact)
+        for idx in range(turn_count // 4):
+            conversation.add(build_cycle(idx))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            conversation.asdict()
+        asdict = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            conversation.invalidate_api_cache()
+            conversation.to_api_format()
+        to_api_format = (time.perf_counter() - start) / rounds
+
+        results.append(
+            {
+                "storage": "compact" if compact else "pydantic",
+                "turns": len(conversation.messages),
+                "bytes_per_turn": memory / len(conversation.messages),
+                "asdict_ms": asdict * 1000,
+                "to_api_format_ms": to_api_format * 1000,
+            }
+        )
+    return results
+
+
+def bench_stream_processing(word_counts=(100, 1_000, 10_000), rounds=3):
+    """
+    events per second through the openai and gemini processors, replayed without a
+    network, shown with a presenter and consumed as typed events
+    """
+
+    results = []
+    for gemini in [False, True]:
+        for word_count in word_counts:
+            text = build_text(word_count)
+            recording = (
+                gemini_recording(text) if gemini else openai_text_recording(text)
+            )
+            provider = ReplayProvider([recording], gemini=gemini)
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                conversation = ChatConversation([{"role": "user", "content": "hi"}])
+                provider.process_response(
+                    conversation, {}, ContentPresenter("assistant", "")
+                )
+            elapsed = (time.perf_counter() - start) / rounds
+
+            # the typed events alone, as stream_prompt hands them to a caller
+            start = time.perf_counter()
+            for _ in range(rounds):
+                conversation = ChatConversation([{"role": "user", "content": "hi"}])
+                for _ in provider.stream_response(conversation, {}):
+                    pass
+            stream_elapsed = (time.perf_counter() - start) / rounds
+
+            results.append(
+                {
+                    "provider": "gemini" if gemini else "openai",
+                    "events": len(recording),
+                    "ms": elapsed * 1000,
+                    "events_per_second": len(recording) / elapsed,
+                    "stream_ms": stream_elapsed * 1000,
+                }
+            )
+    return results
+
+
+def bench_presenters(word_counts=(1_000, 10_000)):
+    """
+    time to stream a response of word_count text deltas to each terminal presenter,
+    through the event adapter like a prompt does
+    """
+
+    presenters = {
+        "redraw": lambda: TerminalContentPresenter(
+            "assistant", "", static=False, delta=False
+        ),
+        "delta": lambda: TerminalContentPresenter("assistant", "", static=False),
+        "buffered": lambda: BufferedContentPresenter(
+            TerminalContentPresenter("assistant", "", static=False)
+        ),
+    }
+
+    results = []
+    for word_count in word_counts:
+        deltas = [delta + " " for delta in build_text(word_count).split(" ")]
+        events = [TextDelta(text=delta) for delta in deltas]
+        events.append(
+            FinalTurn(turn=ChatTurn(role="assistant", content="".join(deltas)))
+        )
+        for name, create_presenter in presenters.items():
+            output = CountingWriter()
+            with redirect_stdout(output):
+                presenter = create_presenter()
+                start = time.perf_counter()
+                present_events(events, presenter)
+                presenter.flush()
+                elapsed = time.perf_counter() - start
+
+            results.append(
+                {
+                    "presenter": name,
+                    "words": word_count,
+                    "ms": elapsed * 1000,
+                    "us_per_update": elapsed / len(deltas) * 1_000_000,
+                    "bytes_written": output.bytes_written,
+                }
+            )
+    return results
+
+
+def bench_save_load(sizes=(1_000, 10_000), rounds=3):
+    """turns per second written by save and read back by load"""
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "conversation.json")
+        for size in sizes:
+            conversation = build_conversation(size)
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                conversation.save(filename)
+            save = (time.perf_counter() - start) / rounds
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                ChatConversation().load(filename)
+            load = (time.perf_counter() - start) / rounds
+
+            turns = len(conversation.messages)
+            results.append(
+                {
+                    "turns": turns,
+                    "bytes": os.path.getsize(filename),
+                    "save_ms": save * 1000,
+                    "load_ms": load * 1000,
+                    "save_turns_per_second": turns / save,
+                    "load_turns_per_second": turns / load,
+                }
+            )
+    return results
+
+
+def bench_session_persistence(cycle_counts=(100, 400)):
+    """total time to persist a session after every cycle, full save vs journal append vs sqlite"""
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for cycle_count in cycle_counts:
+            cycles = [build_cycle(idx) for idx in range(cycle_count)]
+
+            filename = os.path.join(directory, f"conversation_{cycle_count}.json")
+            conversation = ChatConversation()
+            start = time.perf_counter()
+            for cycle in cycles:
+                conversation.add(cycle)
+                conversation.save(filename)
+            save = time.perf_counter() - start
+
+            filename = os.path.join(directory, f"conversation_{cycle_count}.jsonl")
+            start = time.perf_counter()
+            with JournalStore(filename) as journal:
+                conversation = ChatConversation(journal=journal)
+                for cycle in cycles:
+                    conversation.add(cycle)
+            journal_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            JournalStore(filename).load(tail=40)
+            tail_load = time.perf_counter() - start
+
+            # one transaction per cycle, like one per prompt
+            filename = os.path.join(directory, f"conversations_{cycle_count}.db")
+            with SqliteStore(filename) as store:
+                start = time.perf_counter()
+                conversation = ChatConversation(journal=store.journal("session"))
+                for cycle in cycles:
+                    conversation.add(cycle)
+                    conversation.flush()
+                sqlite_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                store.load("session", tail=40)
+                window_load = time.perf_counter() - start
+
+            results.append(
+                {
+                    "cycles": cycle_count,
+                    "save_ms": save * 1000,
+                    "journal_ms": journal_time * 1000,
+                    "tail_load_ms": tail_load * 1000,
+                    "sqlite_ms": sqlite_time * 1000,
+                    "sqlite_window_load_ms": window_load * 1000,
+                }
+            )
+    return results
+
+
+def bench_serialization(sizes=(10_000, 50_000), rounds=3):
+    """save, load and payload build time for large conversations with each json backend"""
+
+    backends = ["json"] + (["orjson"] if serialization.orjson else [])
+    previous = serialization.backend
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "conversation.json")
+        for size in sizes:
+            conversation = build_conversation(size)
+
+            # the indented stdlib format save used to write
+            start = time.perf_counter()
+            for _ in range(rounds):
+                with open(filename, "w") as f:
+                    json.dump(conversation.asdict(), f, indent=4)
+            indented_save = (time.perf_counter() - start) / rounds
+
+            try:
+                for backend in backends:
+                    serialization.set_backend(backend)
+
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        conversation.save(filename)
+                    save = (time.perf_counter() - start) / rounds
+
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        ChatConversation().load(filename)
+                    load = (time.perf_counter() - start) / rounds
+
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        builder = ApiPayloadBuilder()
+                        builder.extend(conversation.messages)
+                        builder.build()
+                    to_api_format = (time.perf_counter() - start) / rounds
+
+                    results.append(
+                        {
+                            "backend": backend,
+                            "turns": len(conversation.messages),
+                            "bytes": os.path.getsize(filename),
+                            "indented_save_ms": indented_save * 1000,
+                            "save_ms": save * 1000,
+                            "load_ms": load * 1000,
+                            "uncached_to_api_format_ms": to_api_format * 1000,
+                        }
+                    )
+            finally:
+                serialization.set_backend(previous)
+    return results
+
+
+# endregion benchmarks
+
+
+# region report
+
+
+def get_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def collect_results(quick=False) -> dict:
+    """
+    run every benchmark and return the results with enough context to compare runs
+
+    Args:
+        quick (bool): Use smaller inputs, for checking that the benchmarks still run.
+    """
+
+    if quick:
+        benchmarks = {
+            "to_api_format_openai": lambda: bench_to_api_format(sizes=(200,), rounds=5),
+            "to_api_format_gemini": lambda: bench_to_api_format(
+                sizes=(200,), rounds=5, gemini=True
+            ),
+            "tool_schemas": lambda: bench_tool_schemas(tool_counts=(10,), rounds=5),
+            "turn_storage": lambda: bench_turn_storage(turn_count=200, rounds=1),
+            "stream_processing": lambda: bench_stream_processing(
+                word_counts=(100,), rounds=1
+            ),
+            "presenters": lambda: bench_presenters(word_counts=(100,)),
+            "save_load": lambda: bench_save_load(sizes=(200,), rounds=1),
+            "session_persistence": lambda: bench_session_persistence(
+                cycle_counts=(50,)
+            ),
+            "serialization": lambda: bench_serialization(sizes=(200,), rounds=1),
+        }
+    else:
+        benchmarks = {
+            "to_api_format_openai": bench_to_api_format,
+            "to_api_format_gemini": lambda: bench_to_api_format(gemini=True),
+            "tool_schemas": bench_tool_schemas,
+            "turn_storage": bench_turn_storage,
+            "stream_processing": bench_stream_processing,
+            "presenters": bench_presenters,
+            "save_load": bench_save_load,
+            "session_persistence": bench_session_persistence,
+            "serialization": bench_serialization,
+        }
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "benchmarks": {name: benchmark() for name, benchmark in benchmarks.items()},
+    }
+
+
+def print_results(results: dict):
+
+    benchmarks = results["benchmarks"]
+
+    for provider in ["openai", "gemini"]:
+        print(f"to_api_format ({provider})")
+        for result in benchmarks[f"to_api_format_{provider}"]:
+            print(
+                f"  {result['turns']:>6} turns: "
+                f"cached {result['cached_ms']:.3f} ms/request, "
+                f"uncached {result['uncached_ms']:.3f} ms/request, "
+                f"budgeted {result['budgeted_ms']:.3f} ms/request"
+            )
+
+    print("tool schemas (openai)")
+    for result in benchmarks["tool_schemas"]:
+        print(
+            f"  {result['tools']:>6} tools: "
+            f"cached {result['cached_ms']:.3f} ms/request, "
+            f"uncached {result['uncached_ms']:.3f} ms/request"
+        )
+
+    print("turn storage")
+    for result in benchmarks["turn_storage"]:
+        print(
+            f"  {result['storage']:>8}: "
+            f"{result['bytes_per_turn']:.0f} bytes/turn, "
+            f"asdict {result['asdict_ms']:.2f} ms, "
+            f"to_api_format {result['to_api_format_ms']:.2f} ms "
+            f"({result['turns']} turns)"
+        )
+
+    print("stream processing")
+    for result in benchmarks["stream_processing"]:
+        print(
+            f"  {result['provider']:>8} {result['events']:>6} events: "
+            f"{result['events_per_second']:,.0f} events/s"
+        )
+
+    print("presenters")
+    for result in benchmarks["presenters"]:
+        print(
+            f"  {result['presenter']:>8} {result['words']:>6} words: "
+            f"{result['ms']:.1f} ms, {result['us_per_update']:.2f} us/update, "
+            f"{result['bytes_written']:,} bytes written"
+        )
+
+    print("save / load")
+    for result in benchmarks["save_load"]:
+        print(
+            f"  {result['turns']:>6} turns: "
+            f"save {result['save_turns_per_second']:,.0f} turns/s, "
+            f"load {result['load_turns_per_second']:,.0f} turns/s "
+            f"({result['bytes']:,} bytes)"
+        )
+
+    print("session persistence (after every cycle)")
+    for result in benchmarks["session_persistence"]:
+        print(
+            f"  {result['cycles']:>6} cycles: "
+            f"save {result['save_ms']:.1f} ms, "
+            f"journal {result['journal_ms']:.1f} ms, "
+            f"tail load {result['tail_load_ms']:.2f} ms, "
+            f"sqlite {result['sqlite_ms']:.1f} ms, "
+            f"sqlite window load {result['sqlite_window_load_ms']:.2f} ms"
+        )
+
+    print(f"serialization (default backend: {serialization.backend})")
+    for result in benchmarks["serialization"]:
+        print(
+            f"  {result['backend']:>8} {result['turns']:>6} turns: "
+            f"save {result['save_ms']:.1f} ms "
+            f"(indented json {result['indented_save_ms']:.1f} ms), "
+            f"load {result['load_ms']:.1f} ms, "
+            f"uncached to_api_format {result['uncached_to_api_format_ms']:.1f} ms, "
+            f"{result['bytes']:,} bytes"
+        )
+
+
+def run_benchmarks(args=None):
+
+    parser = argparse.ArgumentParser(description="benchmark the chat pipeline")
+    parser.add_argument("--json", help="write the results to this file, - for stdout")
+    parser.add_argument("--quick", action="store_true", help="use small inputs")
+    args = parser.parse_args(args)
+
+    results = collect_results(quick=args.quick)
+
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=4)
+        print()
+        return results
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    return results
+
+
+# endregion report
+
+
+if __name__ == "__main__":
+    run_benchmarks()
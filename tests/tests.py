@@ -1,9 +1,53 @@
 # region test conversations
 
 
-from chat.chat import handle_prompt_request
-from chat.entities import ChatConversation, ChatTurn
-from chat.presenter import TerminalContentPresenter
+from chat.chat import (
+    async_handle_prompt_request,
+    async_stream_prompt,
+    handle_prompt_request,
+    prompt_handler,
+    stream_prompt,
+)
+from chat.entities import ChatConversation, ChatTurn, ToolCallTurn, ToolOutputTurn
+from chat.events import (
+    FinalTurn,
+    PromptDone,
+    StatusUpdate,
+    TextDelta,
+    ToolCallStart,
+)
+from chat.providers import get_provider, register_provider
+from chat.replay import (
+    ReplayProvider,
+    gemini_recording,
+    openai_text_recording,
+    openai_tool_recording,
+)
+from chat.presenter import (
+    BufferedContentPresenter,
+    ContentPresenter,
+    TerminalContentPresenter,
+    present_events,
+)
+from chat.cache import TTLCache
+from chat.storage import JournalStore, SqliteStore
+from chat.summary import schedule_summary
+from chat.metrics import JsonLinesExporter, PrometheusExporter
+from chat.stats import (
+    PromptLimits,
+    PromptStats,
+    add_prompt_hook,
+    remove_prompt_hook,
+)
+from chat.tools import (
+    async_tool_calls_handler,
+    cacheable,
+    get_tool_schemas,
+    tool_call_handler,
+    tool_calls_handler,
+    tool_result_cache,
+    tool_timeout,
+)
 
 
 def testContentPresenter():
@@ -352,6 +396,2116 @@ class ApiConversationConversionTests:
 # endregion test conversations
 
 
+# region test api payload cache
+
+
+class ApiPayloadCacheTests:
+
+    turns = [
+        ChatTurn(role="system", content="you are an assistant"),
+        ChatTurn(role="user", content="Hello, how are you?", excluded=True),
+        ChatTurn(role="assistant", content="I'm good, thank you!", excluded=True),
+        ChatTurn(role="user", content="What is apples stock price"),
+        ToolCallTurn(
+            call_id="fn_000_000", name="get_stock_price", arguments={"symbol": "AAPL"}
+        ),
+        ToolOutputTurn(call_id="fn_000_000", output={"symbol": "AAPL", "price": 150.0}),
+        ChatTurn(role="assistant", content="apple is trading at 150"),
+        ChatTurn(role="user", content="What is the capital of France?", excluded=True),
+        ChatTurn(
+            role="assistant", content="The capital of France is Paris.", excluded=True
+        ),
+        ChatTurn(role="user", content="and microsoft?"),
+        ToolCallTurn(
+            call_id="fn_000_000",
+            name="get_current_weather",
+            arguments={"city": "Paris"},
+        ),
+        ToolOutputTurn(call_id="fn_000_000", output={"temperature": "25°C"}),
+    ]
+
+    @staticmethod
+    def reference_api_format(message_list: list) -> list[dict]:
+        """the openai payload as to_api_format built it before the incremental builder"""
+        import json
+
+        output_conv = []
+        current_cycle = []
+        for idx, message in reversed(list(enumerate(message_list))):
+            message = message.model_dump()
+            message_excluded = message.pop("excluded", None)
+            if "arguments" in message:
+                message["arguments"] = json.dumps(message["arguments"])
+            if "output" in message:
+                message["output"] = str(message["output"])
+
+            # the system message or the first message is the anchor
+            if idx == 0 or message.get("role") == "system":
+                current_cycle.append(message)
+                output_conv.extend(current_cycle)
+                break
+
+            current_cycle.append(message)
+            if message.get("role") == "user":
+                # the latest user message is always sent
+                if idx == len(message_list) - 1:
+                    output_conv.append(message)
+                    current_cycle = []
+                    continue
+                # a cycle that didn't end with an answer is always sent
+                if current_cycle[0].get("role", "assistant") != "assistant":
+                    output_conv.extend(current_cycle)
+                    current_cycle = []
+                    continue
+                if message_excluded:
+                    current_cycle = []
+                    continue
+                output_conv.extend(current_cycle)
+                current_cycle = []
+
+        return list(reversed(output_conv))
+
+    def test_incremental_matches_rebuild(self):
+        Convo = ChatConversation()
+        for idx, turn in enumerate(self.turns):
+            Convo.add(turn)
+            assert Convo.to_api_format() == self.reference_api_format(
+                self.turns[: idx + 1]
+            )
+
+    def test_expected_payloads(self):
+        Convo = ChatConversation(list(self.turns))
+        # the excluded cycles are left out, the system anchor and tool turns are kept
+        assert Convo.to_api_format() == [
+            {"role": "system", "content": "you are an assistant"},
+            {"role": "user", "content": "What is apples stock price"},
+            {
+                "call_id": "fn_000_000",
+                "name": "get_stock_price",
+                "type": "function_call",
+                "arguments": '{"symbol": "AAPL"}',
+            },
+            {
+                "call_id": "fn_000_000",
+                "output": "{'symbol': 'AAPL', 'price': 150.0}",
+                "type": "function_call_output",
+            },
+            {"role": "assistant", "content": "apple is trading at 150"},
+            {"role": "user", "content": "and microsoft?"},
+            {
+                "call_id": "fn_000_000",
+                "name": "get_current_weather",
+                "type": "function_call",
+                "arguments": '{"city": "Paris"}',
+            },
+            {
+                "call_id": "fn_000_000",
+                "output": "{'temperature': '25°C'}",
+                "type": "function_call_output",
+            },
+        ]
+        assert Convo.to_api_format(gemini=True) == [
+            {"parts": [{"text": "you are an assistant"}], "role": "model"},
+            {"parts": [{"text": "What is apples stock price"}], "role": "user"},
+            {
+                "parts": [
+                    {
+                        "function_call": {
+                            "name": "get_stock_price",
+                            "args": {"symbol": "AAPL"},
+                        }
+                    }
+                ],
+                "role": "model",
+            },
+            {
+                "parts": [
+                    {
+                        "function_response": {
+                            "name": "get_stock_price",
+                            "response": {"output": {"symbol": "AAPL", "price": 150.0}},
+                        }
+                    }
+                ],
+                "role": "user",
+            },
+            {"parts": [{"text": "apple is trading at 150"}], "role": "model"},
+            {"parts": [{"text": "and microsoft?"}], "role": "user"},
+            {
+                "parts": [
+                    {
+                        "function_call": {
+                            "name": "get_current_weather",
+                            "args": {"city": "Paris"},
+                        }
+                    }
+                ],
+                "role": "model",
+            },
+            {
+                "parts": [
+                    {
+                        "function_response": {
+                            "name": "get_current_weather",
+                            "response": {"output": {"temperature": "25°C"}},
+                        }
+                    }
+                ],
+                "role": "user",
+            },
+        ]
+
+        # a conversation without a system message is anchored on its first message
+        Convo = ChatConversation(list(self.turns[1:7]))
+        assert Convo.to_api_format()[0] == {
+            "role": "user",
+            "content": "Hello, how are you?",
+        }
+
+    def test_direct_append(self):
+        Convo = ChatConversation(self.turns[:3])
+        assert len(Convo.to_api_format()) == 1
+        # turns appended without add() are still picked up
+        Convo.messages.append(self.turns[3])
+        assert Convo.to_api_format()[-1]["content"] == "What is apples stock price"
+        # removed turns force a rebuild
+        Convo.messages.pop()
+        assert len(Convo.to_api_format()) == 1
+
+    def test_gemini_function_names(self):
+        Convo = ChatConversation(list(self.turns))
+        result = Convo.to_api_format(gemini=True)
+        responses = [
+            part["function_response"]["name"]
+            for message in result
+            for part in message["parts"]
+            if "function_response" in part
+        ]
+        # each output is named after the call it answers, even when call ids are reused
+        assert responses == ["get_stock_price", "get_current_weather"]
+
+
+class ContextWindowTests:
+
+    def conversation(self, cycles: int) -> ChatConversation:
+        conversation = ChatConversation(
+            [ChatTurn(role="system", content="you are an assistant")]
+        )
+        for idx in range(cycles):
+            call_id = f"call_{idx}"
+            conversation.add(
+                [
+                    ChatTurn(role="user", content=f"what is the price of stock {idx}"),
+                    ToolCallTurn(
+                        call_id=call_id,
+                        name="get_stock_price",
+                        arguments={"symbol": f"S{idx}"},
+                    ),
+                    ToolOutputTurn(call_id=call_id, output={"price": idx}),
+                    ChatTurn(role="assistant", content=f"stock {idx} costs {idx}"),
+                ]
+            )
+        conversation.add(ChatTurn(role="user", content="and the next one?"))
+        return conversation
+
+    def test_trims_oldest_cycles(self):
+        from chat.tokens import estimate_message_tokens
+
+        conversation = self.conversation(20)
+        full = conversation.to_api_format()
+        assert conversation.to_api_format(token_budget=1_000_000) == full
+
+        # the system message, the new prompt and the last three cycles
+        tokens = sum(
+            estimate_message_tokens(message) for message in full[:1] + full[-13:]
+        )
+        trimmed = conversation.to_api_format(token_budget=tokens)
+        assert trimmed == full[:1] + full[-13:]
+        assert conversation._payload_builders[False].dropped_cycles == 17
+
+        # a budget that is too small still sends the system message and the prompt
+        assert conversation.to_api_format(token_budget=1) == [full[0], full[-1]]
+
+    def test_tool_pairs_stay_together(self):
+        conversation = self.conversation(10)
+        for gemini in [False, True]:
+            for token_budget in range(0, 800, 7):
+                payload = conversation.to_api_format(
+                    gemini=gemini, token_budget=token_budget
+                )
+                if gemini:
+                    calls = sum("function_call" in m["parts"][0] for m in payload)
+                    outputs = sum("function_response" in m["parts"][0] for m in payload)
+                else:
+                    calls = sum(m.get("type") == "function_call" for m in payload)
+                    outputs = sum(
+                        m.get("type") == "function_call_output" for m in payload
+                    )
+                assert calls == outputs
+
+    def test_payload_bytes(self):
+        from chat.entities import ConversationSummary
+        from chat.serialization import dumpb
+
+        conversation = self.conversation(10)
+        for gemini in [False, True]:
+            for token_budget in [None, 1, 300, 1_000_000]:
+                payload = conversation.to_api_format(
+                    gemini=gemini, token_budget=token_budget
+                )
+                assert conversation.api_payload_bytes(gemini) == len(dumpb(payload))
+
+            conversation.summary = ConversationSummary(text="stocks", through=21)
+            payload = conversation.to_api_format(gemini=gemini)
+            assert conversation.api_payload_bytes(gemini) == len(dumpb(payload))
+            conversation.summary = None
+
+        # a system message starts the payload over
+        conversation.add(ChatTurn(role="system", content="you are a pirate"))
+        payload = conversation.to_api_format()
+        assert conversation.api_payload_bytes() == len(dumpb(payload))
+
+
+class SummaryTests:
+
+    def test_background_summary(self):
+        provider = ReplayProvider(
+            [openai_text_recording("the user asked about stocks 0 to 5")]
+        )
+        register_provider("replay-summary", provider)
+        conversation = ContextWindowTests().conversation(8)
+        full = conversation.to_api_format()
+
+        future = schedule_summary(
+            conversation, "replay-summary", trigger_tokens=10, keep_cycles=2
+        )
+        summary = future.result(timeout=5)
+        assert conversation.summary is summary
+        # 6 summarized cycles of 4 turns after the system message
+        assert summary.through == 25
+        assert (
+            "user: what is the price of stock 5"
+            in provider.client.requests[0]["input"][1]["content"]
+        )
+
+        payload = conversation.to_api_format()
+        assert payload[0] == full[0]
+        assert payload[1]["role"] == "system"
+        assert payload[1]["content"].endswith("the user asked about stocks 0 to 5")
+        # the last two cycles and the new prompt are unchanged
+        assert payload[2:] == full[-9:]
+
+        # nothing new to summarize yet
+        assert (
+            schedule_summary(
+                conversation, "replay-summary", trigger_tokens=10, keep_cycles=2
+            )
+            is None
+        )
+
+        # a summary of turns that were removed is ignored
+        conversation.messages = conversation.messages[:5]
+        assert conversation.to_api_format() == full[:5]
+
+
+class JournalStoreTests:
+
+    def test_append_only(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversation.jsonl")
+            with JournalStore(filepath) as journal:
+                conversation = ChatConversation(journal=journal)
+                conversation.add(ContextWindowTests().conversation(3).messages)
+                with open(filepath, "rb") as f:
+                    before = f.read()
+
+                conversation.add(ChatTurn(role="assistant", content="it costs 3"))
+                with open(filepath, "rb") as f:
+                    after = f.read()
+                # the existing turns are never rewritten
+                assert after.startswith(before)
+                assert after.count(b"\n") == len(conversation.messages) == 15
+
+            reloaded = JournalStore(filepath).load()
+            assert reloaded.asdict() == conversation.asdict()
+
+    def test_tail_and_compaction(self):
+        import os
+        import tempfile
+
+        full = ContextWindowTests().conversation(10)
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversation.jsonl")
+            with JournalStore(filepath) as journal:
+                ChatConversation(full.messages, journal=journal)
+
+            with JournalStore(filepath) as journal:
+                tail = journal.load(tail=6)
+                # the system message, then the tail back to the start of a cycle
+                assert tail.asdict()[0]["role"] == "system"
+                assert tail.asdict()[1]["role"] == "user"
+                assert tail.asdict()[1:] == full.asdict()[-9:]
+
+                tail.add(ChatTurn(role="assistant", content="it costs 10"))
+                expected = full.asdict() + [tail.asdict()[-1]]
+                assert JournalStore(filepath).load().asdict() == expected
+
+                # removing turns rewrites the journal, keeping the turns that weren't loaded
+                tail.messages = tail.messages[:-2]
+                tail.add(ChatTurn(role="assistant", content="i don't know"))
+                expected = expected[:-2] + [tail.asdict()[-1]]
+                assert JournalStore(filepath).load().asdict() == expected
+                assert JournalStore(filepath).count == len(expected)
+
+    def test_tail_keeps_the_latest_persona(self):
+        import os
+        import tempfile
+
+        conversation = ContextWindowTests().conversation(6)
+        conversation.add(ChatTurn(role="system", content="you are a pirate"))
+        conversation.add(ContextWindowTests().conversation(6).messages[1:])
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversation.jsonl")
+            with JournalStore(filepath) as journal:
+                ChatConversation(conversation.messages, journal=journal)
+
+            with JournalStore(filepath) as journal:
+                # the persona switch comes before the window, it replaces the first one
+                tail = journal.load(tail=6)
+                assert tail.asdict()[0]["content"] == "you are a pirate"
+                assert tail.asdict()[1:] == conversation.asdict()[-9:]
+
+                # writes after the tail still line up with the journal
+                tail.add(ChatTurn(role="user", content="ahoy"))
+                expected = conversation.asdict() + [tail.asdict()[-1]]
+                assert JournalStore(filepath).load().asdict() == expected
+
+    def test_index(self):
+        import os
+        import tempfile
+
+        conversation = ContextWindowTests().conversation(6)
+        conversation.add(ChatTurn(role="system", content="you are a pirate"))
+        conversation.add(ContextWindowTests().conversation(6).messages[1:])
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversation.jsonl")
+            with JournalStore(filepath) as journal:
+                ChatConversation(conversation.messages[:30], journal=journal)
+            # lines written after the index, like after a crash, are caught up
+            with open(filepath, "ab") as f:
+                for turn in conversation.messages[30:]:
+                    f.write(JournalStore.encode(turn))
+            with JournalStore(filepath) as journal:
+                assert journal.count == len(conversation.messages)
+                assert [system[0] for system in journal.systems] == [0, 26]
+
+            # the lines before the tail are never decoded, so they can be garbage
+            with open(filepath, "rb") as f:
+                lines = f.readlines()
+            with open(filepath, "wb") as f:
+                for idx, line in enumerate(lines):
+                    if 0 < idx < 26:
+                        line = b'"system"'.ljust(len(line) - 1, b"x") + b"\n"
+                    f.write(line)
+
+            with JournalStore(filepath) as journal:
+                tail = journal.load(tail=6)
+                assert tail.asdict()[0]["content"] == "you are a pirate"
+                assert tail.asdict()[1:] == conversation.asdict()[-9:]
+
+
+class SqliteStoreTests:
+
+    def test_batched_per_prompt(self):
+        import os
+        import tempfile
+
+        register_provider(
+            "replay-sqlite",
+            ReplayProvider([openai_text_recording("apple is trading at 123")]),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversations.db")
+            with SqliteStore(filepath) as store:
+                journal = store.journal("session-1", flush_every=None)
+                conversation = ChatConversation(
+                    [ChatTurn(role="system", content="you are an assistant")],
+                    journal=journal,
+                )
+                # nothing is written until the prompt is done
+                assert store.count("session-1") == 0
+
+                prompt_handler(
+                    "what is apples stock price",
+                    conversation,
+                    {},
+                    False,
+                    RecordingContentPresenter,
+                    "replay-sqlite",
+                )
+                assert store.count("session-1") == 3
+
+                # another process sees the whole session
+                with SqliteStore(filepath) as other:
+                    mode = other.connection.execute("PRAGMA journal_mode").fetchone()
+                    assert mode[0] == "wal"
+                    assert other.conversation_ids() == ["session-1"]
+                    loaded = other.load("session-1")
+                    assert loaded.asdict() == conversation.asdict()
+
+    def test_window_and_compaction(self):
+        import os
+        import tempfile
+
+        full = ContextWindowTests().conversation(10)
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversations.db")
+            with SqliteStore(filepath) as store:
+                with store.journal("session-1") as journal:
+                    ChatConversation(full.messages, journal=journal)
+                with store.journal("session-2") as journal:
+                    ChatConversation(full.messages[:5], journal=journal)
+
+                journal = store.journal("session-1")
+                tail = journal.load(tail=6)
+                # the system message, then the window back to the start of a cycle
+                assert tail.asdict()[0]["role"] == "system"
+                assert tail.asdict()[1]["role"] == "user"
+                assert tail.asdict()[1:] == full.asdict()[-9:]
+
+                tail.add(ChatTurn(role="assistant", content="it costs 10"))
+                tail.flush()
+                expected = full.asdict() + [tail.asdict()[-1]]
+                assert store.load("session-1").asdict() == expected
+
+                # removing turns rewrites the rows, keeping the turns that weren't loaded
+                tail.messages = tail.messages[:-2]
+                tail.add(ChatTurn(role="assistant", content="i don't know"))
+                tail.flush()
+                expected = expected[:-2] + [tail.asdict()[-1]]
+                assert store.load("session-1").asdict() == expected
+                assert store.count("session-1") == len(expected)
+                assert store.count("session-2") == 5
+
+    def test_tail_keeps_the_latest_persona(self):
+        import os
+        import tempfile
+
+        conversation = ContextWindowTests().conversation(6)
+        conversation.add(ChatTurn(role="system", content="you are a pirate"))
+        conversation.add(ContextWindowTests().conversation(6).messages[1:])
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversations.db")
+            with SqliteStore(filepath) as store:
+                with store.journal("session-1") as journal:
+                    ChatConversation(conversation.messages, journal=journal)
+
+                # the persona switch comes before the window, it replaces the first one
+                tail = store.journal("session-1").load(tail=6)
+                assert tail.asdict()[0]["content"] == "you are a pirate"
+                assert tail.asdict()[1:] == conversation.asdict()[-9:]
+
+    def test_conflicting_writer(self):
+        import os
+        import sqlite3
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "conversations.db")
+            with SqliteStore(filepath) as store:
+                first = store.journal("session-1", flush_every=None).load()
+                second = store.journal("session-1", flush_every=None).load()
+                first.add(ChatTurn(role="user", content="hello"))
+                first.flush()
+
+                # the second writer's positions are taken, its turns are dropped
+                second.add(ChatTurn(role="user", content="hi"))
+                for _ in range(2):
+                    try:
+                        second.flush()
+                        assert False, "the write should fail"
+                    except sqlite3.IntegrityError:
+                        pass
+                second.add(ChatTurn(role="assistant", content="how can i help"))
+                assert second.journal.pending == []
+                assert store.load("session-1").asdict() == first.asdict()
+
+                # loading the conversation again picks up the other writer's turns
+                second = second.journal.load()
+                second.add(ChatTurn(role="user", content="hi"))
+                second.flush()
+                assert store.load("session-1").asdict() == second.asdict()
+                assert [turn["content"] for turn in second.asdict()] == ["hello", "hi"]
+
+
+class SerializationTests:
+
+    def test_backends_match(self):
+        from chat import serialization
+
+        value = {"b": [1, 2.5, None, True], "a": "café ✓", "nested": {"x": "y"}}
+        backends = ["json"] + (["orjson"] if serialization.orjson else [])
+        previous = serialization.backend
+        try:
+            encoded = []
+            for backend in backends:
+                serialization.set_backend(backend)
+                encoded.append(serialization.dumps(value, sort_keys=True))
+                assert serialization.loads(serialization.dumpb(value)) == value
+        finally:
+            serialization.set_backend(previous)
+        # every backend writes the same compact json
+        assert len(set(encoded)) == 1
+        assert encoded[0].startswith('{"a":"café ✓","b":[1,2.5')
+
+    def test_stable_across_backends(self):
+        import json
+        from chat import serialization
+
+        value = {"symbol": "café", "price": 1e16, "tags": ["a", "b"]}
+        backends = ["json"] + (["orjson"] if serialization.orjson else [])
+        previous = serialization.backend
+        try:
+            encoded = []
+            for backend in backends:
+                serialization.set_backend(backend)
+                encoded.append(serialization.stable_dumps(value, sort_keys=True))
+                # the tool arguments sent to the provider
+                payload = ChatConversation(
+                    [
+                        ChatTurn(role="user", content="hi"),
+                        ToolCallTurn(call_id="call_0", name="quote", arguments=value),
+                    ]
+                ).to_api_format()
+                assert payload[-1]["arguments"] == json.dumps(value)
+        finally:
+            serialization.set_backend(previous)
+        assert encoded == [json.dumps(value, sort_keys=True)] * len(backends)
+
+    def test_save_load(self):
+        import os
+        import json
+        import tempfile
+
+        conversation = ContextWindowTests().conversation(3)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "conversation.json")
+            conversation.save(filename)
+            with open(filename) as f:
+                assert "\n" not in f.read()
+            assert ChatConversation().load(filename) is None
+            loaded = ChatConversation()
+            loaded.load(filename)
+            assert loaded.asdict() == conversation.asdict()
+
+            # files written by older versions are still readable
+            with open(filename, "w") as f:
+                json.dump(conversation.asdict(), f, indent=4)
+            loaded = ChatConversation()
+            loaded.load(filename)
+            assert loaded.asdict() == conversation.asdict()
+
+
+class TurnStateTests:
+
+    def test_turn_state(self):
+        Convo = ChatConversation()
+        assert not Convo.is_user_turn
+        Convo.add(ApiPayloadCacheTests.turns[:4])
+        assert Convo.is_user_turn
+        assert Convo.pending_tool_calls == []
+
+        Convo.add(ApiPayloadCacheTests.turns[4])
+        assert [turn.name for turn in Convo.pending_tool_calls] == ["get_stock_price"]
+
+        Convo.add(ApiPayloadCacheTests.turns[5])
+        assert not Convo.is_user_turn
+        assert Convo.pending_tool_calls == []
+
+        # turns appended without add() are picked up as well
+        Convo.messages.append(ApiPayloadCacheTests.turns[10])
+        assert Convo.pending_tool_calls[0].name == "get_current_weather"
+
+
+class CompactTurnTests:
+
+    def test_matches_pydantic(self):
+        turns = ApiPayloadCacheTests.turns
+        Convo = ChatConversation(list(turns))
+        Compact = ChatConversation(list(turns), compact=True)
+        assert type(Compact.messages[0]).__name__ == "CompactChatTurn"
+        assert Compact.asdict() == Convo.asdict()
+        for gemini in [False, True]:
+            assert Compact.to_api_format(gemini=gemini) == Convo.to_api_format(
+                gemini=gemini
+            )
+        assert Compact.pending_tool_calls == Convo.pending_tool_calls
+        assert Compact.messages[4].to_model() == turns[4]
+
+
+# endregion test api payload cache
+
+
+# region test tool calls
+
+
+class ToolCallTests:
+
+    @staticmethod
+    def slow_tool(seconds: float):
+        """sleeps before answering
+
+        Args:
+            seconds (float): how long to sleep
+        """
+        import time
+
+        time.sleep(seconds)
+        return {"slept": seconds}
+
+    @staticmethod
+    async def async_slow_tool(seconds: float):
+        """sleeps before answering
+
+        Args:
+            seconds (float): how long to sleep
+        """
+        import asyncio
+
+        await asyncio.sleep(seconds)
+        return {"slept": seconds}
+
+    def tool_call_turns(self, name, delays):
+        return [
+            ToolCallTurn(call_id=f"call_{idx}", name=name, arguments={"seconds": delay})
+            for idx, delay in enumerate(delays)
+        ]
+
+    def test_parallel_preserves_order(self):
+        import time
+
+        tools = {"slow_tool": self.slow_tool}
+        start = time.perf_counter()
+        turns = tool_calls_handler(
+            self.tool_call_turns("slow_tool", [0.3, 0.1, 0.2]), tools
+        )
+        elapsed = time.perf_counter() - start
+        assert elapsed < 0.5
+        assert [turn.call_id for turn in turns] == [
+            "call_0",
+            "call_0",
+            "call_1",
+            "call_1",
+            "call_2",
+            "call_2",
+        ]
+        assert [turn.output["slept"] for turn in turns[1::2]] == [0.3, 0.1, 0.2]
+
+    def test_timeout(self):
+        tools = {
+            "slow_tool": tool_timeout(0.05)(lambda seconds: self.slow_tool(seconds))
+        }
+        turns = tool_calls_handler(self.tool_call_turns("slow_tool", [0.2]), tools)
+        assert "timed out" in turns[1].output
+
+    def test_timeouts_share_one_deadline(self):
+        import time
+
+        tools = {
+            "slow_tool": tool_timeout(0.1)(lambda seconds: self.slow_tool(seconds))
+        }
+        stats = PromptStats()
+        start = time.perf_counter()
+        turns = tool_calls_handler(
+            self.tool_call_turns("slow_tool", [0.3, 0.3, 0.3, 0.01]), tools, stats=stats
+        )
+        elapsed = time.perf_counter() - start
+        # every call gets the same 0.1s from submission, not 0.1s after the one before it
+        assert elapsed < 0.25
+        assert ["timed out" in str(turn.output) for turn in turns[1::2]] == [
+            True,
+            True,
+            True,
+            False,
+        ]
+        # the timed out tools finishing later don't record a second timing
+        time.sleep(0.3)
+        assert sorted(timing.call_id for timing in stats.tool_timings) == [
+            "call_0",
+            "call_1",
+            "call_2",
+            "call_3",
+        ]
+        assert [timing.timed_out for timing in stats.tool_timings].count(True) == 3
+
+    def test_async_gather(self):
+        import asyncio
+        import time
+
+        tools = {"slow_tool": self.slow_tool, "async_slow_tool": self.async_slow_tool}
+        tool_call_turns = self.tool_call_turns("async_slow_tool", [0.3, 0.1])
+        tool_call_turns += self.tool_call_turns("slow_tool", [0.2])
+        start = time.perf_counter()
+        turns = asyncio.run(async_tool_calls_handler(tool_call_turns, tools))
+        elapsed = time.perf_counter() - start
+        assert elapsed < 0.5
+        assert [turn.output["slept"] for turn in turns[1::2]] == [0.3, 0.1, 0.2]
+
+
+# endregion test tool calls
+
+
+# region test tool cache
+
+
+class ToolCacheTests:
+
+    def test_cacheable_tool(self):
+        calls = []
+
+        @cacheable(ttl=60)
+        def get_stock_price(symbol: str):
+            """get the current stock price
+
+            Args:
+                symbol (str): The stock symbol
+            """
+            calls.append(symbol)
+            return {"symbol": symbol, "price": 150.00}
+
+        def uncached_tool(symbol: str):
+            """not marked as cacheable"""
+            calls.append(symbol)
+            return symbol
+
+        tools = {"get_stock_price": get_stock_price, "uncached_tool": uncached_tool}
+        tool_result_cache.clear()
+        for arguments in [{"symbol": "AAPL"}, {"symbol": "AAPL"}, {"symbol": "MSFT"}]:
+            for name in tools:
+                tool_call_handler(
+                    ToolCallTurn(call_id="call_1", name=name, arguments=arguments),
+                    tools,
+                )
+        # the cacheable tool only runs once per symbol, the other runs every time
+        assert calls == ["AAPL", "AAPL", "AAPL", "MSFT", "MSFT"]
+        assert tool_result_cache.stats()["hits"] == 1
+
+    def test_ttl_and_lru(self):
+        import time
+
+        cache = TTLCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=0.05)
+        cache.get("a")
+        cache.set("c", 3)
+        # "b" was the least recently used
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        cache.set("d", 4, ttl=0.05)
+        time.sleep(0.1)
+        assert cache.get("d") is None
+        assert cache.stats() == {"hits": 2, "misses": 2, "size": 1, "hit_rate": 0.5}
+
+
+# endregion test tool cache
+
+
+# region test tool schemas
+
+
+class ToolSchemaTests:
+
+    def test_schemas_are_reused(self):
+        def get_stock_price(symbol: str):
+            """get the current stock price
+
+            Args:
+                symbol (str): The stock symbol
+            """
+            return {"symbol": symbol, "price": 150.00}
+
+        tools = {"get_stock_price": get_stock_price}
+        first = get_tool_schemas(tools, "openai")
+        assert first[0]["parameters"]["properties"]["symbol"]["type"] == "string"
+        assert get_tool_schemas(tools, "openai")[0] is first[0]
+        assert "function_declarations" in get_tool_schemas(tools, "gemini")[0]
+
+        # a changed docstring produces a new schema
+        get_stock_price.__doc__ = "get the latest stock price"
+        assert get_tool_schemas(tools, "openai")[0]["description"] == (
+            "get the latest stock price"
+        )
+
+        # so does replacing the function
+        def get_stock_price(ticker: str):
+            """get the current stock price"""
+
+        tools["get_stock_price"] = get_stock_price
+        schema = get_tool_schemas(tools, "openai")[0]
+        assert list(schema["parameters"]["properties"]) == ["ticker"]
+
+
+# endregion test tool schemas
+
+
+# region test presenters
+
+
+class RecordingContentPresenter(ContentPresenter):
+    """keeps every update so tests can check what would have been displayed"""
+
+    def __init__(self, role, content, static=True, excluded_from_history=False):
+        super().__init__(role, content, static, excluded_from_history)
+        self.updates = []
+
+    def update(self, content: str):
+        self.content = content
+        self.updates.append(content)
+
+
+class BufferedPresenterTests:
+
+    def test_coalesces_deltas(self):
+        recorder = RecordingContentPresenter("assistant", "thinking...", static=False)
+        presenter = BufferedContentPresenter(recorder, frame_rate=1, flush_chars=None)
+
+        # the first delta replaces "thinking..." so it is shown straight away
+        full_response = ""
+        for idx in range(1000):
+            full_response += f"word{idx} "
+            presenter.update(full_response + "▌")
+        assert recorder.updates == ["word0 ▌"]
+
+        # status messages are not held back
+        presenter.update("using tool: get_stock_price...▌")
+        assert recorder.updates[-1] == "using tool: get_stock_price...▌"
+
+        presenter.update("the price is")
+        presenter.update("the price is 150▌")
+        presenter.flush()
+        assert recorder.updates[-2:] == ["the price is", "the price is 150▌"]
+
+    def test_flush_chars(self):
+        recorder = RecordingContentPresenter("assistant", "", static=False)
+        presenter = BufferedContentPresenter(recorder, frame_rate=1, flush_chars=10)
+        for idx in range(1, 50):
+            presenter.update("x" * idx + "▌")
+        assert len(recorder.updates) == 5
+
+    def test_appends(self):
+        from chat.presenter import FrameStream, NetworkContentPresenter
+
+        # presenters without append get the whole text once per frame
+        recorder = RecordingContentPresenter("assistant", "thinking...", static=False)
+        presenter = BufferedContentPresenter(recorder, frame_rate=1, flush_chars=None)
+        presenter.update("a▌")
+        for _ in range(1000):
+            presenter.append("b")
+        presenter.flush()
+        assert recorder.updates == ["a▌", "a" + "b" * 1000 + "▌"]
+
+        # the others get the text appended during the frame in one append
+        stream = FrameStream()
+        network = NetworkContentPresenter("assistant", "", False, stream=stream)
+        presenter = BufferedContentPresenter(network, frame_rate=1, flush_chars=10)
+        presenter.update("a▌")
+        for _ in range(25):
+            presenter.append("b")
+        presenter.update("ab")
+        frames = [(frame["type"], frame["text"]) for frame in stream.history]
+        assert frames == [
+            ("message", ""),
+            ("delta", "a"),
+            ("delta", "b" * 10),
+            ("delta", "b" * 10),
+            # the final text replaces the appended text that was still waiting
+            ("replace", "ab"),
+        ]
+
+
+class TerminalPresenterTests:
+
+    def render(self, updates):
+        import contextlib
+        import io
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            presenter = TerminalContentPresenter(
+                "assistant", "thinking...", static=False
+            )
+            for content in updates:
+                presenter.update(content)
+        return output.getvalue()
+
+    def test_appends_deltas(self):
+        output = self.render(["hello▌", "hello world▌", "hello world!"])
+        assert output == "assistant: hello world!"
+
+    def test_appends_events(self):
+        import contextlib
+        import io
+
+        words = [f"word{idx} " for idx in range(2000)]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            presenter = TerminalContentPresenter("assistant", "", static=False)
+            present_events(
+                [TextDelta(text=word) for word in words]
+                + [FinalTurn(turn=ChatTurn(role="assistant", content="".join(words)))],
+                presenter,
+            )
+        # every delta is printed on its own, the final turn adds nothing
+        assert output.getvalue() == "assistant: " + "".join(words)
+
+    def test_redraws_wrapped_lines(self):
+        import os
+
+        columns = os.environ.get("COLUMNS")
+        os.environ["COLUMNS"] = "20"
+        try:
+            # "assistant: " plus 25 characters wraps onto two rows
+            output = self.render(["x" * 25 + "▌", "searching...▌"])
+        finally:
+            if columns is None:
+                del os.environ["COLUMNS"]
+            else:
+                os.environ["COLUMNS"] = columns
+        assert output.endswith("\r\033[1A\033[Jassistant: searching...")
+
+
+class NetworkPresenterTests:
+
+    def test_deltas(self):
+        from chat.presenter import FrameStream, NetworkContentPresenter
+
+        stream = FrameStream()
+        presenter = NetworkContentPresenter(
+            "assistant", "thinking...", False, stream=stream
+        )
+        for content in ["searching...▌", "Hel▌", "Hello▌", "Hello▌", "Hello world"]:
+            presenter.update(content)
+
+        frames = [(frame["type"], frame.get("text")) for frame in stream.history]
+        assert frames == [
+            ("message", "thinking..."),
+            ("replace", "searching..."),
+            ("replace", "Hel"),
+            ("delta", "lo"),
+            ("delta", " world"),
+        ]
+        assert [frame["seq"] for frame in stream.history] == [1, 2, 3, 4, 5]
+
+        # the text sent grows with the response, not with the number of updates
+        words = [f"word{idx} " for idx in range(2000)]
+        presenter.update("")
+        for idx in range(len(words)):
+            presenter.update("".join(words[: idx + 1]) + "▌")
+        sent = sum(len(frame.get("text", "")) for frame in stream.history[6:])
+        assert sent == len("".join(words))
+
+    def test_appends_events(self):
+        from chat.presenter import FrameStream, NetworkContentPresenter
+
+        stream = FrameStream()
+        presenter = NetworkContentPresenter(
+            "assistant", "thinking...", False, stream=stream
+        )
+        present_events(
+            [
+                StatusUpdate(text="searching..."),
+                TextDelta(text="Hel"),
+                TextDelta(text="lo"),
+                TextDelta(text=" world"),
+                FinalTurn(turn=ChatTurn(role="assistant", content="Hello world")),
+            ],
+            presenter,
+        )
+        frames = [(frame["type"], frame.get("text")) for frame in stream.history]
+        assert frames == [
+            ("message", "thinking..."),
+            ("replace", "searching..."),
+            ("replace", "Hel"),
+            ("delta", "lo"),
+            ("delta", " world"),
+        ]
+
+    def test_slow_consumer(self):
+        import asyncio
+        from chat.presenter import FrameStream, NetworkContentPresenter
+
+        stream = FrameStream()
+        queue = stream.subscribe(max_frames=4)
+        presenter = NetworkContentPresenter("assistant", "", False, stream=stream)
+        text = ""
+        for idx in range(100):
+            text += f"{idx} "
+            presenter.update(text + "▌")
+        # nothing was sent yet, the waiting deltas were merged
+        assert len(queue.frames) == 4
+
+        # only the latest status is sent, it replaces the text before it
+        presenter.update("searching...▌")
+        presenter.update("verifying data...▌")
+        presenter.update("verifying data... done")
+        stream.close()
+
+        async def consume():
+            return [frame async for frame in queue]
+
+        frames = asyncio.run(consume())
+        assert [frame["type"] for frame in frames] == ["message", "replace"]
+        assert frames[-1]["text"] == "verifying data... done"
+        assert frames[-1]["seq"] == stream.seq
+
+        # a client that resumes gets the frames since, merged to the latest text
+        async def resume(after):
+            return [frame async for frame in stream.subscribe(after)]
+
+        resumed = asyncio.run(resume(50))
+        assert [frame["type"] for frame in resumed] == ["replace"]
+        assert resumed[0]["seq"] == stream.seq
+        assert ServerTests.text(stream.history[:50] + resumed, 1) == (
+            "verifying data... done"
+        )
+
+
+# endregion test presenters
+
+
+# region test prompt limits
+
+
+class PromptLimitTests:
+
+    def test_limits(self):
+        stats = PromptStats(round_trips=3)
+        assert (
+            stats.exceeded_limit(PromptLimits(max_round_trips=3)) == "max_round_trips"
+        )
+        assert stats.exceeded_limit(PromptLimits(max_round_trips=4)) is None
+
+        stats = PromptStats(started_at=0)
+        assert stats.exceeded_limit(PromptLimits(timeout_seconds=1)) == "timeout"
+
+        stats = PromptStats()
+        stats.record_usage(900, 200)
+        stats.record_usage(None, None)
+        assert stats.total_tokens == 1100
+        assert stats.exceeded_limit(PromptLimits(token_budget=1000)) == "token_budget"
+        assert (
+            stats.exceeded_limit(
+                PromptLimits(
+                    max_round_trips=None, timeout_seconds=None, token_budget=None
+                )
+            )
+            is None
+        )
+
+
+# endregion test prompt limits
+
+
+# region test startup
+
+
+class StartupTests:
+
+    def run_python(self, code: str):
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result
+
+    def test_sdks_are_lazy(self):
+        result = self.run_python(
+            "import sys, chat.chat; "
+            "print(sorted(m for m in ('openai', 'google.genai') if m in sys.modules))"
+        )
+        assert result.stdout.strip() == "[]"
+
+    def test_import_time(self, budget_seconds=1.0):
+        result = self.run_python("import chat.chat")
+        # the last line of the report is the cumulative time of the top level import
+        cumulative_us = int(result.stderr.strip().splitlines()[-1].split("|")[1])
+        assert cumulative_us / 1_000_000 < budget_seconds
+
+
+class HttpClientTests:
+
+    def test_pooled_client(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from chat import config
+
+        args = config.http_client_args()
+        assert args["timeout"].connect == config.HTTP_CONNECT_TIMEOUT_SECONDS
+        assert args["timeout"].read == config.HTTP_READ_TIMEOUT_SECONDS
+        assert args["limits"].max_connections == config.HTTP_MAX_CONNECTIONS
+        assert args["limits"].keepalive_expiry == config.HTTP_KEEPALIVE_SECONDS
+
+        # every thread gets the same client and connection pool
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            clients = list(executor.map(lambda _: config.http_client(), range(8)))
+        assert all(client is clients[0] for client in clients)
+
+    def test_providers_share_the_pool(self):
+        import os
+        import subprocess
+        import sys
+
+        code = (
+            "import asyncio, chat.config as config, chat.openai as o, chat.gemini as g\n"
+            "async def shared():\n"
+            "    return (o.get_async_client()._client is config.async_http_client(), "
+            "g.get_async_client()._api_client._async_httpx_client "
+            "is config.async_http_client())\n"
+            "print(o.get_client()._client is config.http_client(), "
+            "*asyncio.run(shared()), "
+            "g.get_client()._api_client._httpx_client is config.http_client(), "
+            "o.get_client().max_retries == config.HTTP_MAX_RETRIES)"
+        )
+        env = {**os.environ, "OPENAI_API_KEY": "test", "GEMINI_API_KEY": "test"}
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=env,
+        )
+        assert result.stdout.strip() == "True True True True True"
+
+    def test_async_clients_per_loop(self):
+        import asyncio
+        from chat import config
+
+        async def get_clients():
+            # the same loop keeps using one pool
+            return config.async_http_client(), config.async_http_client()
+
+        first, again = asyncio.run(get_clients())
+        second, _ = asyncio.run(get_clients())
+        assert first is again
+        # a later loop gets its own pool, the closed loop's pool is dropped
+        assert second is not first
+        assert list(config._async_http_clients.values()) == [second]
+
+
+# endregion test startup
+
+
+# region test replay provider
+
+
+class ReplayProviderTests:
+
+    @staticmethod
+    def get_stock_price(symbol: str):
+        """get the current stock price
+
+        Args:
+            symbol (str): The stock symbol
+        """
+        return {"symbol": symbol, "price": 123}
+
+    def conversation(self):
+        return ChatConversation(
+            [
+                {"role": "system", "content": "you are a helpful assistant"},
+                {"role": "user", "content": "what is apples stock price now"},
+            ]
+        )
+
+    def check_conversation(self, conversation):
+        conversation_list = conversation.asdict()
+        assert conversation_list[2]["name"] == "get_stock_price"
+        assert conversation_list[2]["arguments"]["symbol"] == "AAPL"
+        assert conversation_list[3]["output"]["price"] == 123
+        assert conversation_list[4]["content"] == "apple is trading at 123"
+        assert conversation.is_user_turn
+
+    def test_openai_replay(self):
+        provider = ReplayProvider(
+            [
+                openai_tool_recording(
+                    [("get_stock_price", {"symbol": "AAPL"})],
+                    usage={"input_tokens": 50, "output_tokens": 10},
+                ),
+                openai_text_recording(
+                    "apple is trading at 123",
+                    usage={"input_tokens": 80, "output_tokens": 6},
+                ),
+            ]
+        )
+        register_provider("replay-openai", provider)
+        presenter = RecordingContentPresenter("assistant", "thinking...")
+        stats = PromptStats()
+        conversation = handle_prompt_request(
+            self.conversation(),
+            presenter,
+            tools={"get_stock_price": self.get_stock_price},
+            model="replay-openai",
+            stats=stats,
+        )
+        self.check_conversation(conversation)
+        assert presenter.updates[-1] == "apple is trading at 123"
+        assert stats.round_trips == 2
+        assert stats.total_tokens == 146
+        # the second request includes the tool call and its output
+        assert len(provider.client.requests[1]["input"]) == 4
+
+    def test_gemini_replay_async(self):
+        import asyncio
+
+        register_provider(
+            "replay-gemini",
+            ReplayProvider(
+                [
+                    gemini_recording(
+                        function_calls=[("get_stock_price", {"symbol": "AAPL"})]
+                    ),
+                    gemini_recording("apple is trading at 123"),
+                ],
+                gemini=True,
+            ),
+        )
+
+        async def run():
+            conversation = self.conversation()
+            async for _ in async_handle_prompt_request(
+                conversation,
+                RecordingContentPresenter("assistant", "thinking..."),
+                tools={"get_stock_price": self.get_stock_price},
+                model="replay-gemini",
+            ):
+                pass
+            return conversation
+
+        self.check_conversation(asyncio.run(run()))
+
+    def test_token_rate(self):
+        import time
+
+        provider = ReplayProvider(
+            [openai_text_recording("one two three four five six seven eight")],
+            tokens_per_second=200,
+        )
+        start = time.perf_counter()
+        provider.process_response(
+            self.conversation(), {}, RecordingContentPresenter("assistant", "")
+        )
+        # 11 events, 10 gaps of 5ms
+        assert time.perf_counter() - start >= 0.05
+
+    def test_unknown_model(self):
+        try:
+            get_provider("missing")
+        except ValueError as e:
+            assert "missing" in str(e)
+        else:
+            raise AssertionError("expected a ValueError")
+
+
+# endregion test replay provider
+
+
+# region test stream prompt
+
+
+class StreamPromptTests:
+
+    def recordings(self, gemini: bool) -> list[list[dict]]:
+        if gemini:
+            return [
+                gemini_recording(
+                    function_calls=[("get_stock_price", {"symbol": "AAPL"})]
+                ),
+                gemini_recording("apple is trading at 123"),
+            ]
+        return [
+            openai_tool_recording([("get_stock_price", {"symbol": "AAPL"})]),
+            openai_text_recording("apple is trading at 123"),
+        ]
+
+    def check_events(self, events):
+        # the openai stream also reports the tool arguments while they arrive
+        if events[0].type == "status":
+            assert events.pop(0).text == "checking tools..."
+        assert [event.type for event in events[:3]] == [
+            "tool_call",
+            "tool_result",
+            "status",
+        ]
+        assert events[0].name == "get_stock_price"
+        assert events[0].arguments == {"symbol": "AAPL"}
+        assert events[1].call_id == events[0].call_id
+        assert events[1].output == {"symbol": "AAPL", "price": 123}
+
+        deltas = [event.text for event in events if event.type == "text_delta"]
+        assert "".join(deltas) == "apple is trading at 123"
+        assert len(deltas) == 5
+        assert events[-2].type == "final_turn"
+        assert events[-2].turn.content == "apple is trading at 123"
+        assert events[-1] == PromptDone(stop_reason="completed")
+
+    def test_stream_prompt(self):
+        for gemini in [False, True]:
+            register_provider(
+                "replay-stream", ReplayProvider(self.recordings(gemini), gemini=gemini)
+            )
+            conversation = ChatConversation()
+            events = list(
+                stream_prompt(
+                    "what is apples stock price now",
+                    conversation,
+                    {"get_stock_price": ReplayProviderTests.get_stock_price},
+                    model="replay-stream",
+                )
+            )
+            self.check_events(events)
+            assert conversation.messages[0].content == "what is apples stock price now"
+            assert conversation.is_user_turn
+
+    def test_async_stream_prompt(self):
+        import asyncio
+
+        async def run(gemini):
+            register_provider(
+                "replay-stream", ReplayProvider(self.recordings(gemini), gemini=gemini)
+            )
+            return [
+                event
+                async for event in async_stream_prompt(
+                    "what is apples stock price now",
+                    ChatConversation(),
+                    {"get_stock_price": ReplayProviderTests.get_stock_price},
+                    model="replay-stream",
+                )
+            ]
+
+        for gemini in [False, True]:
+            self.check_events(asyncio.run(run(gemini)))
+
+    def test_presenter_adapter(self):
+        presenter = RecordingContentPresenter("assistant", "thinking...")
+        present_events(
+            [
+                StatusUpdate(text="searching..."),
+                TextDelta(text="apple "),
+                TextDelta(text="is up"),
+                ToolCallStart(call_id="call_000", name="get_stock_price"),
+                TextDelta(text="123"),
+                FinalTurn(turn=ChatTurn(role="assistant", content="apple is up 123")),
+                PromptDone(stop_reason="max_round_trips", message="sorry"),
+            ],
+            presenter,
+        )
+        assert presenter.updates == [
+            "searching...▌",
+            "apple ▌",
+            "apple is up▌",
+            "using tool: get_stock_price...▌",
+            # the text starts over after anything that isn't a delta
+            "123▌",
+            "apple is up 123",
+            "sorry",
+        ]
+
+    def test_limits_stop_the_stream(self):
+        register_provider(
+            "replay-stream",
+            ReplayProvider(
+                [openai_tool_recording([("get_stock_price", {"symbol": "AAPL"})])]
+            ),
+        )
+        events = list(
+            stream_prompt(
+                "what is apples stock price now",
+                ChatConversation(),
+                {"get_stock_price": ReplayProviderTests.get_stock_price},
+                model="replay-stream",
+                limits=PromptLimits(max_round_trips=1),
+            )
+        )
+        assert events[-1].stop_reason == "max_round_trips"
+        assert events[-1].message.startswith("sorry, i had to stop")
+
+
+# endregion test stream prompt
+
+
+# region test response cache
+
+
+class ResponseCacheTests:
+
+    def run_prompt(self, model, excluded, stats=None):
+        conversation = ChatConversation(
+            [ChatTurn(role="system", content="you write product descriptions")]
+        )
+        return prompt_handler(
+            "write a product description for a red mug",
+            conversation,
+            {},
+            excluded,
+            RecordingContentPresenter,
+            model,
+            stats=stats,
+        )
+
+    def test_replays_excluded_prompts(self):
+        from chat.response_cache import ResponseCache, set_response_cache
+
+        provider = ReplayProvider(
+            [
+                openai_text_recording(
+                    "a bright red mug", usage={"input_tokens": 40, "output_tokens": 4}
+                ),
+                openai_text_recording("another mug"),
+            ]
+        )
+        register_provider("replay-response-cache", provider)
+        cache = ResponseCache(TTLCache(), excluded_only=True)
+        set_response_cache(cache)
+        try:
+            first = self.run_prompt("replay-response-cache", excluded=True)
+            stats = PromptStats()
+            second = self.run_prompt("replay-response-cache", True, stats)
+            # the second prompt never reached the provider and cost no tokens
+            assert len(provider.client.requests) == 1
+            assert second.asdict() == first.asdict()
+            assert second.messages[-1].content == "a bright red mug"
+            assert stats.cached_round_trips == 1 and stats.total_tokens == 0
+
+            # prompts that are part of the history aren't cached
+            self.run_prompt("replay-response-cache", excluded=False)
+            assert len(provider.client.requests) == 2
+            assert cache.backend.stats()["hits"] == 1
+        finally:
+            set_response_cache(None)
+
+    def test_disk_cache_async_tools(self):
+        import asyncio
+        import tempfile
+        from chat.cache import DiskCache
+        from chat.response_cache import ResponseCache, set_response_cache
+
+        tests = ReplayProviderTests()
+        provider = ReplayProvider(
+            [
+                gemini_recording(
+                    function_calls=[("get_stock_price", {"symbol": "AAPL"})]
+                ),
+                gemini_recording("apple is trading at 123"),
+            ],
+            gemini=True,
+        )
+        register_provider("replay-response-cache-gemini", provider)
+        calls = []
+
+        def get_stock_price(symbol: str):
+            """get the current stock price
+
+            Args:
+                symbol (str): The stock symbol
+            """
+            calls.append(symbol)
+            return {"symbol": symbol, "price": 123}
+
+        async def run():
+            conversation = tests.conversation()
+            async for _ in async_handle_prompt_request(
+                conversation,
+                RecordingContentPresenter("assistant", "thinking..."),
+                tools={"get_stock_price": get_stock_price},
+                model="replay-response-cache-gemini",
+            ):
+                pass
+            return conversation
+
+        with tempfile.TemporaryDirectory() as directory:
+            set_response_cache(ResponseCache(DiskCache(directory), excluded_only=False))
+            try:
+                first = asyncio.run(run())
+                # a new cache on the same directory, like another process
+                set_response_cache(
+                    ResponseCache(DiskCache(directory), excluded_only=False)
+                )
+                second = asyncio.run(run())
+            finally:
+                set_response_cache(None)
+
+        tests.check_conversation(second)
+        assert second.asdict() == first.asdict()
+        assert len(provider.client.requests) == 2
+        # the replayed tool call still runs the tool
+        assert calls == ["AAPL", "AAPL"]
+
+    def test_key(self):
+        from chat.response_cache import ResponseCache
+
+        tools = [{"name": "a"}, {"name": "b"}]
+        request = {"model": "gpt-4.1", "input": [{"role": "user", "content": "hi"}]}
+        key = ResponseCache.key("openai", {**request, "tools": tools})
+        # the order of the tools doesn't matter, the model and provider do
+        assert key == ResponseCache.key("openai", {**request, "tools": tools[::-1]})
+        assert key != ResponseCache.key("gemini", {**request, "tools": tools})
+        assert key != ResponseCache.key(
+            "openai", {**request, "model": "gpt-4.1-mini", "tools": tools}
+        )
+
+    def test_disk_cache(self):
+        import time
+        import tempfile
+        from chat.cache import DiskCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_size=2)
+            cache.set("a", [1])
+            time.sleep(0.01)
+            cache.set("b", [2], ttl=0.05)
+            time.sleep(0.01)
+            cache.get("a")
+            cache.set("c", [3])
+            # "b" was the least recently used
+            assert cache.get("b") is None
+            assert DiskCache(directory).get("a") == [1]
+            cache.set("d", [4], ttl=0.05)
+            time.sleep(0.1)
+            assert cache.get("d") is None
+            assert len(cache) == 1
+
+    def test_disk_cache_scans(self):
+        import time
+        import tempfile
+        from chat.cache import DiskCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            DiskCache(directory).set("a", [1])
+            time.sleep(0.01)
+            cache = DiskCache(directory, max_size=3)
+            scans = []
+            entries = cache.entries
+            cache.entries = lambda: scans.append(1) or entries()
+
+            # the directory is counted once, overwrites and new entries are counted in memory
+            cache.set("b", [2])
+            cache.set("b", [3])
+            cache.set("c", [4])
+            assert len(scans) == 1 and cache.count == 3
+
+            # another process added an entry, the scan that evicts counts it as well
+            DiskCache(directory).set("d", [5])
+            cache.set("e", [6])
+            assert len(scans) == 2
+            assert cache.count == 3 and len(entries()) == 3
+            assert cache.get("a") is None
+
+
+# endregion test response cache
+
+
+# region test semantic cache
+
+
+class SemanticCacheTests:
+
+    def run_prompt(self, prompt, persona="you write product descriptions", stats=None):
+        conversation = ChatConversation([ChatTurn(role="system", content=persona)])
+        return prompt_handler(
+            prompt,
+            conversation,
+            {"get_stock_price": ReplayProviderTests.get_stock_price},
+            True,
+            RecordingContentPresenter,
+            "replay-semantic-cache",
+            stats=stats,
+        )
+
+    def test_serves_similar_prompts(self):
+        from chat.semantic_cache import SemanticCache, set_semantic_cache
+
+        provider = ReplayProvider(
+            [
+                openai_text_recording("a bright red mug"),
+                openai_text_recording("a calm blue teapot"),
+                openai_text_recording("a mug for pirates"),
+            ]
+        )
+        register_provider("replay-semantic-cache", provider)
+        cache = SemanticCache(threshold=0.9)
+        set_semantic_cache(cache)
+        try:
+            self.run_prompt("write a product description for a red coffee mug")
+            stats = PromptStats()
+            conversation = self.run_prompt(
+                "write a product description for a red coffee mug please", stats=stats
+            )
+            # the reworded prompt was answered without calling the provider
+            assert len(provider.client.requests) == 1
+            assert conversation.messages[-1].content == "a bright red mug"
+            assert conversation.messages[-1].excluded
+            assert stats.semantic_cache == "hit" and stats.stop_reason == "completed"
+            assert stats.semantic_similarity >= 0.9
+
+            # a different question, and the same question for another persona
+            self.run_prompt("write a product description for a blue teapot")
+            conversation = self.run_prompt(
+                "write a product description for a red coffee mug",
+                persona="you are a pirate",
+            )
+            assert conversation.messages[-1].content == "a mug for pirates"
+            assert len(provider.client.requests) == 3
+            assert cache.stats() == {
+                "hits": 1,
+                "misses": 3,
+                "size": 3,
+                "hit_rate": 0.25,
+            }
+        finally:
+            set_semantic_cache(None)
+
+    def test_tool_answers_are_not_stored(self):
+        from chat.semantic_cache import SemanticCache, set_semantic_cache
+
+        provider = ReplayProvider(
+            [
+                openai_tool_recording([("get_stock_price", {"symbol": "AAPL"})]),
+                openai_text_recording("apple is trading at 123"),
+            ]
+        )
+        register_provider("replay-semantic-cache", provider)
+        cache = SemanticCache()
+        set_semantic_cache(cache)
+        try:
+            self.run_prompt("what is apples stock price")
+            self.run_prompt("what is apples stock price")
+            # the price can change, so both prompts called the provider and the tool
+            assert len(provider.client.requests) == 4
+            assert cache.stats()["size"] == 0
+        finally:
+            set_semantic_cache(None)
+
+    def test_vector_index(self):
+        from chat.semantic_cache import VectorIndex
+
+        index = VectorIndex(dimensions=2, max_size=2)
+        assert index.search([1.0, 0.0]) == (0.0, None)
+        index.add([1.0, 0.0], "east")
+        index.add([0.0, 2.0], "north")
+        similarity, value = index.search([1.0, 1.0])
+        assert round(similarity, 3) == 0.707 and value in ("east", "north")
+        assert index.search([0.0, 1.0])[1] == "north"
+
+        # the oldest entry is replaced once the index is full
+        index.add([-1.0, 0.0], "west")
+        assert len(index) == 2
+        similarity, value = index.search([1.0, 0.0])
+        assert value != "east" and similarity < 0.5
+
+
+# endregion test semantic cache
+
+
+# region test server
+
+
+class ServerTests:
+
+    async def request(self, app, method, path, body=None, query=b""):
+        """call the asgi app, returns the status and the response body"""
+        from chat.serialization import dumpb
+
+        messages = []
+
+        async def receive():
+            data = dumpb(body) if body is not None else b""
+            return {"type": "http.request", "body": data, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query}
+        await app(scope, receive, send)
+        status = messages[0]["status"]
+        return status, b"".join(message.get("body", b"") for message in messages[1:])
+
+    @staticmethod
+    def parse_events(body: bytes) -> list[dict]:
+        from chat.serialization import loads
+
+        frames = []
+        for event in body.decode("utf-8").strip().split("\n\n"):
+            seq, event_type, data = event.split("\n")
+            frame = loads(data.removeprefix("data: "))
+            assert seq == f"id: {frame['seq']}"
+            assert event_type == f"event: {frame['type']}"
+            frames.append(frame)
+        return frames
+
+    @staticmethod
+    def text(frames: list[dict], message: int) -> str:
+        """the text of a message after applying its frames"""
+        text = ""
+        for frame in frames:
+            if frame.get("message") != message:
+                continue
+            if frame["type"] == "delta":
+                text += frame["text"]
+            else:
+                text = frame["text"]
+        return text
+
+    def test_sessions_and_sse(self):
+        import asyncio
+        from chat.serialization import loads
+        from chat.server import ChatServer
+
+        register_provider(
+            "replay-server",
+            ReplayProvider([openai_text_recording("hello from the server")]),
+        )
+        app = ChatServer(model="replay-server")
+
+        async def run():
+            status, body = await self.request(
+                app, "POST", "/sessions", {"system": "hi"}
+            )
+            assert status == 201
+            session_id = loads(body)["session_id"]
+
+            status, body = await self.request(
+                app, "POST", f"/sessions/{session_id}/prompts", {"prompt": "hello"}
+            )
+            assert status == 200
+            frames = self.parse_events(body)
+            assert frames[0] == {
+                "seq": 1,
+                "type": "message",
+                "message": 1,
+                "role": "user",
+                "text": "hello",
+                "static": True,
+                "excluded": False,
+            }
+            assert frames[1]["role"] == "assistant"
+            assert self.text(frames, 2) == "hello from the server"
+            assert frames[-1]["type"] == "done"
+            assert frames[-1]["stop_reason"] == "completed"
+
+            # a client that reconnects gets the frames after the last one it received
+            status, body = await self.request(
+                app, "GET", f"/sessions/{session_id}/events", query=b"after=2"
+            )
+            assert self.parse_events(body) == frames[2:]
+
+            status, body = await self.request(app, "GET", f"/sessions/{session_id}")
+            messages = loads(body)["messages"]
+            assert [message["role"] for message in messages] == [
+                "system",
+                "user",
+                "assistant",
+            ]
+
+            status, body = await self.request(app, "GET", "/sessions/missing")
+            assert status == 404
+            status, body = await self.request(
+                app, "POST", f"/sessions/{session_id}/prompts", {}
+            )
+            assert status == 400
+
+        asyncio.run(run())
+
+    def test_backpressure(self):
+        import asyncio
+        from chat.serialization import loads
+        from chat.server import ChatServer
+
+        register_provider(
+            "replay-server-slow",
+            ReplayProvider([openai_text_recording("slow")], latency_seconds=0.1),
+        )
+        app = ChatServer(model="replay-server-slow", max_concurrent=1, max_waiting=0)
+
+        async def run():
+            session_ids = []
+            for _ in range(2):
+                _, body = await self.request(app, "POST", "/sessions")
+                session_ids.append(loads(body)["session_id"])
+
+            prompt = {"prompt": "hello"}
+            return await asyncio.gather(
+                self.request(
+                    app, "POST", f"/sessions/{session_ids[0]}/prompts", prompt
+                ),
+                self.request(
+                    app, "POST", f"/sessions/{session_ids[1]}/prompts", prompt
+                ),
+                # a second prompt in a session that is busy
+                self.request(
+                    app, "POST", f"/sessions/{session_ids[0]}/prompts", prompt
+                ),
+            )
+
+        first, second, busy = asyncio.run(run())
+        assert first[0] == 200
+        # the provider was busy and nothing may wait for it
+        assert second[0] == 503
+        assert busy[0] == 409
+
+    def test_websocket(self):
+        import asyncio
+        from chat.serialization import dumps, loads
+        from chat.server import ChatServer
+
+        register_provider(
+            "replay-server",
+            ReplayProvider([openai_text_recording("hello over a websocket")]),
+        )
+        app = ChatServer(model="replay-server")
+
+        async def run():
+            session = await app.sessions.create()
+            incoming = [
+                {"type": "websocket.connect"},
+                {"type": "websocket.receive", "text": dumps({"prompt": "hello"})},
+                {"type": "websocket.receive", "text": "{}"},
+                {"type": "websocket.disconnect"},
+            ]
+            sent = []
+
+            async def receive():
+                return incoming.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "websocket", "path": f"/sessions/{session.session_id}/ws"}
+            await app(scope, receive, send)
+            return sent
+
+        sent = asyncio.run(run())
+        assert sent[0] == {"type": "websocket.accept"}
+        frames = [loads(message["text"]) for message in sent[1:]]
+        done = next(idx for idx, frame in enumerate(frames) if frame["type"] == "done")
+        assert self.text(frames[:done], 2) == "hello over a websocket"
+        # the empty prompt got an error frame, the connection stayed open
+        assert frames[-1]["type"] == "error" and frames[-1]["status"] == 400
+
+    def test_sessions_are_reloaded(self):
+        import os
+        import asyncio
+        import tempfile
+        from chat.server import SessionManager
+
+        with tempfile.TemporaryDirectory() as directory:
+            with SqliteStore(os.path.join(directory, "sessions.db")) as store:
+                sessions = SessionManager(store=store, max_sessions=1)
+
+                async def run():
+                    first = await sessions.create("you are the first")
+                    first.conversation.add(ChatTurn(role="user", content="hello"))
+                    first.conversation.flush()
+                    await sessions.create("you are the second")
+                    # only one session fits in memory, the first is loaded from the store
+                    assert len(sessions) == 1
+                    reloaded = await sessions.get(first.session_id)
+                    assert reloaded is not first
+                    assert reloaded.conversation.asdict() == first.conversation.asdict()
+
+                    # requests that load the same session at the same time share it
+                    await sessions.create("you are the third")
+                    loaded = await asyncio.gather(
+                        sessions.get(first.session_id), sessions.get(first.session_id)
+                    )
+                    assert loaded[0] is loaded[1]
+
+                asyncio.run(run())
+
+    def test_sessions_shared_by_workers(self):
+        import os
+        import asyncio
+        import tempfile
+        from chat.serialization import loads
+        from chat.server import ChatServer, SessionManager
+
+        register_provider(
+            "replay-server-workers",
+            ReplayProvider(
+                [openai_text_recording("first"), openai_text_recording("second")]
+            ),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            with SqliteStore(os.path.join(directory, "sessions.db")) as store:
+                workers = [
+                    ChatServer(
+                        sessions=SessionManager(store=store),
+                        model="replay-server-workers",
+                    )
+                    for _ in range(2)
+                ]
+
+                async def run():
+                    _, body = await self.request(workers[0], "POST", "/sessions")
+                    session_id = loads(body)["session_id"]
+                    path = f"/sessions/{session_id}"
+                    # both workers have the session cached before either answers a prompt
+                    for worker in workers:
+                        await self.request(worker, "GET", path)
+
+                    responses = []
+                    for worker in workers:
+                        _, body = await self.request(
+                            worker, "POST", f"{path}/prompts", {"prompt": "hello"}
+                        )
+                        responses.append(self.parse_events(body))
+                    _, body = await self.request(workers[0], "GET", path)
+                    return responses, loads(body)["messages"]
+
+                responses, messages = asyncio.run(run())
+                # the second worker saw the first worker's turns before its prompt
+                assert [frames[-1]["type"] for frames in responses] == ["done", "done"]
+                assert [message["role"] for message in messages] == [
+                    "system",
+                    "user",
+                    "assistant",
+                    "user",
+                    "assistant",
+                ]
+                assert messages == store.load(store.conversation_ids()[0]).asdict()
+
+
+# endregion test server
+
+
+# region test instrumentation
+
+
+class InstrumentationTests:
+
+    def run_prompt(self, stats, tokens_per_second=None):
+        provider = ReplayProvider(
+            [
+                openai_tool_recording([("get_stock_price", {"symbol": "AAPL"})]),
+                openai_text_recording("apple is trading at 123 today"),
+            ],
+            tokens_per_second=tokens_per_second,
+            latency_seconds=0.02,
+        )
+        register_provider("replay-instrumented", provider)
+        handle_prompt_request(
+            ReplayProviderTests().conversation(),
+            RecordingContentPresenter("assistant", "thinking..."),
+            tools={"get_stock_price": ReplayProviderTests.get_stock_price},
+            model="replay-instrumented",
+            stats=stats,
+        )
+        return stats
+
+    def test_timings(self):
+        events = []
+        stats = self.run_prompt(
+            PromptStats(hooks=[lambda name, stats, data: events.append(name)]),
+            tokens_per_second=100,
+        )
+        assert stats.model == "replay-instrumented"
+        assert stats.stop_reason == "completed"
+        assert 0.02 <= stats.first_event_seconds < stats.first_text_seconds
+        assert stats.first_text_seconds <= stats.elapsed_seconds
+        # 6 words, 5 gaps of about 10ms between them
+        assert stats.delta_count == 6
+        assert sum(stats.delta_gap_counts) == 5
+        assert len(stats.request_bytes) == 2
+        assert stats.request_bytes[1] > stats.request_bytes[0]
+        assert [timing.name for timing in stats.tool_timings] == ["get_stock_price"]
+        assert events[:2] == ["request", "first_event"]
+        assert events.count("request") == 2
+        assert events.count("tool") == 1
+        assert events[-1] == "finish"
+
+    def test_exporters(self):
+        import os
+        import json
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "prompt_stats.jsonl")
+            jsonl = JsonLinesExporter(filepath)
+            prometheus = PrometheusExporter()
+            add_prompt_hook(jsonl)
+            add_prompt_hook(prometheus)
+            try:
+                self.run_prompt(PromptStats())
+                self.run_prompt(PromptStats())
+            finally:
+                remove_prompt_hook(jsonl)
+                remove_prompt_hook(prometheus)
+
+            with open(filepath) as f:
+                lines = [json.loads(line) for line in f]
+            assert len(lines) == 2
+            assert lines[0]["round_trips"] == 2
+            assert lines[0]["tool_timings"][0]["name"] == "get_stock_price"
+
+        metrics = prometheus.render()
+        assert (
+            'chat_prompts_total{model="replay-instrumented",stop_reason="completed"} 2'
+            in metrics
+        )
+        assert 'chat_tool_duration_seconds_count{tool="get_stock_price"} 2' in metrics
+        assert (
+            'chat_delta_gap_milliseconds_bucket{model="replay-instrumented",le="+Inf"} 10'
+            in metrics
+        )
+
+    def test_failing_hook(self):
+        def hook(name, stats, data):
+            raise RuntimeError("broken hook")
+
+        stats = self.run_prompt(PromptStats(hooks=[hook]))
+        assert stats.stop_reason == "completed"
+
+
+# endregion test instrumentation
+
+
+# region test benchmarks
+
+
+class BenchmarkTests:
+
+    def test_quick_run(self):
+        import json
+        from tests.benchmarks import collect_results
+
+        results = collect_results(quick=True)
+        assert set(results["benchmarks"]) == {
+            "to_api_format_openai",
+            "to_api_format_gemini",
+            "tool_schemas",
+            "turn_storage",
+            "stream_processing",
+            "presenters",
+            "save_load",
+            "session_persistence",
+            "serialization",
+        }
+        assert all(results["benchmarks"].values())
+        # the results are meant to be stored and compared
+        json.dumps(results)
+
+
+# endregion test benchmarks
+
+
 # region test api calls
 
 
@@ -567,6 +2721,94 @@ def run_tests():
     conversion.test_five()
     conversion.test_six()
     conversion.test_seven()
+    payload_cache = ApiPayloadCacheTests()
+    payload_cache.test_incremental_matches_rebuild()
+    payload_cache.test_expected_payloads()
+    payload_cache.test_direct_append()
+    payload_cache.test_gemini_function_names()
+    context_window = ContextWindowTests()
+    context_window.test_trims_oldest_cycles()
+    context_window.test_tool_pairs_stay_together()
+    context_window.test_payload_bytes()
+    SummaryTests().test_background_summary()
+    journal = JournalStoreTests()
+    journal.test_append_only()
+    journal.test_tail_and_compaction()
+    journal.test_tail_keeps_the_latest_persona()
+    journal.test_index()
+    sqlite = SqliteStoreTests()
+    sqlite.test_batched_per_prompt()
+    sqlite.test_window_and_compaction()
+    sqlite.test_tail_keeps_the_latest_persona()
+    sqlite.test_conflicting_writer()
+    serialization = SerializationTests()
+    serialization.test_backends_match()
+    serialization.test_save_load()
+    serialization.test_stable_across_backends()
+    TurnStateTests().test_turn_state()
+    CompactTurnTests().test_matches_pydantic()
+    tool_calls = ToolCallTests()
+    tool_calls.test_parallel_preserves_order()
+    tool_calls.test_timeout()
+    tool_calls.test_timeouts_share_one_deadline()
+    tool_calls.test_async_gather()
+    tool_cache = ToolCacheTests()
+    tool_cache.test_cacheable_tool()
+    tool_cache.test_ttl_and_lru()
+    ToolSchemaTests().test_schemas_are_reused()
+    buffered_presenter = BufferedPresenterTests()
+    buffered_presenter.test_coalesces_deltas()
+    buffered_presenter.test_flush_chars()
+    buffered_presenter.test_appends()
+    terminal_presenter = TerminalPresenterTests()
+    terminal_presenter.test_appends_deltas()
+    terminal_presenter.test_redraws_wrapped_lines()
+    terminal_presenter.test_appends_events()
+    network_presenter = NetworkPresenterTests()
+    network_presenter.test_deltas()
+    network_presenter.test_slow_consumer()
+    network_presenter.test_appends_events()
+    PromptLimitTests().test_limits()
+    startup = StartupTests()
+    startup.test_sdks_are_lazy()
+    startup.test_import_time()
+    http_clients = HttpClientTests()
+    http_clients.test_pooled_client()
+    http_clients.test_providers_share_the_pool()
+    http_clients.test_async_clients_per_loop()
+    replay = ReplayProviderTests()
+    replay.test_openai_replay()
+    replay.test_gemini_replay_async()
+    replay.test_token_rate()
+
+    stream = StreamPromptTests()
+    stream.test_stream_prompt()
+    stream.test_async_stream_prompt()
+    stream.test_presenter_adapter()
+    stream.test_limits_stop_the_stream()
+
+    response_cache = ResponseCacheTests()
+    response_cache.test_replays_excluded_prompts()
+    response_cache.test_disk_cache_async_tools()
+    response_cache.test_key()
+    response_cache.test_disk_cache()
+    response_cache.test_disk_cache_scans()
+    semantic_cache = SemanticCacheTests()
+    semantic_cache.test_serves_similar_prompts()
+    semantic_cache.test_tool_answers_are_not_stored()
+    semantic_cache.test_vector_index()
+    server = ServerTests()
+    server.test_sessions_and_sse()
+    server.test_backpressure()
+    server.test_websocket()
+    server.test_sessions_are_reloaded()
+    server.test_sessions_shared_by_workers()
+    replay.test_unknown_model()
+    instrumentation = InstrumentationTests()
+    instrumentation.test_timings()
+    instrumentation.test_exporters()
+    instrumentation.test_failing_hook()
+    BenchmarkTests().test_quick_run()
     api = ApiTests()
     print("running api.test_function_call_real()")
     api.test_function_call_real()
@@ -579,4 +2821,7 @@ def run_tests():
 # %%
 
 if __name__ == "__main__":
+    from chat.config import configure_logging
+
+    configure_logging()
     run_tests()